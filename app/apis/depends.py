@@ -15,7 +15,7 @@ async def get_current_token(
     except Exception:
         raise HTTPCredentialError()
     try:
-        service.database.users.get_by_id(token_data.user.id)
+        await service.database.users.get_by_id(token_data.user.id)
     except errors.UserDoesNotExist:
         raise HTTPCredentialError()
     return token_data
@@ -31,7 +31,7 @@ async def get_current_user(
         raise HTTPCredentialError()
 
     try:
-        return service.database.users.get_by_id(token_data.user.id)
+        return await service.database.users.get_by_id(token_data.user.id)
     except errors.UserDoesNotExist:
         raise HTTPCredentialError()
 
@@ -46,7 +46,7 @@ async def get_current_admin_user(
         raise HTTPCredentialError()
 
     try:
-        user = service.database.users.get_by_id(payload.user.id)
+        user = await service.database.users.get_by_id(payload.user.id)
     except errors.UserDoesNotExist:
         raise HTTPCredentialError()
 
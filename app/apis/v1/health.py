@@ -5,36 +5,56 @@ from app.models.response import StandardResponse
 from app.apis.response import standard_response
 from app.apis.depends import get_current_admin_user
 from app.models.user import RealUser, LegalUser
+from app.models.token import TokenCacheStatsOut
+from app.models.auth import PasswordHasherStatsOut
+from app.core.security import password_hasher
 from app.services import AuthService, get_srv
+from app.services.token import token_cache
 
 
 router = APIRouter(prefix="/health", tags=['Health Checks'])
 
 
 @router.get("/mongodb/", response_model=StandardResponse)
-def check_mongodb_connection(
+async def check_mongodb_connection(
     admin: Union[RealUser, LegalUser] = Depends(get_current_admin_user),
     srv: AuthService = Depends(get_srv)
 ):
     """ Checks MongoDB connection using ping command. """
     try:
-        srv.database.check_connection()
+        await srv.database.check_connection()
         return standard_response('ok')
     except Exception as e:
         return standard_response(str(e))
 
 
 @router.get('/redis/', response_model=StandardResponse)
-def check_redis_connection(
+async def check_redis_connection(
     admin: Union[RealUser, LegalUser] = Depends(get_current_admin_user),
     srv: AuthService = Depends(get_srv)
 ):
     """ Checks redis connection. """
-    if srv.cache.ping():
+    if await srv.cache.ping():
         return standard_response('ok')
     return standard_response("connection error")
 
 
+@router.get('/token-cache/', response_model=TokenCacheStatsOut)
+def get_token_cache_stats(
+    admin: Union[RealUser, LegalUser] = Depends(get_current_admin_user),
+):
+    """ Returns size and hit/miss counters of the verified token cache. """
+    return TokenCacheStatsOut(**token_cache.stats())
+
+
+@router.get('/password-hasher/', response_model=PasswordHasherStatsOut)
+def get_password_hasher_stats(
+    admin: Union[RealUser, LegalUser] = Depends(get_current_admin_user),
+):
+    """ Returns queue depth and timings of the password hashing pool. """
+    return PasswordHasherStatsOut(**password_hasher.stats())
+
+
 # @router.get('/rabbitmq/', response_model=StandardResponse)
 # async def check_rabitmq_connection(
 #     # admin: Union[RealUser, LegalUser] = Depends(get_current_admin_user),
@@ -17,7 +17,7 @@ async def get_provinces(
 ):
     """ Get provinces list """
 
-    return srv.database.provinces.get_all()
+    return await srv.database.provinces.get_all()
 
 
 @router.post("/provinces/", response_model=Province)
@@ -29,4 +29,4 @@ async def create_province(
 
     """ Create a new province with cities """
 
-    return srv.database.provinces.create(province_in.to_model())
+    return await srv.database.provinces.create(province_in.to_model())
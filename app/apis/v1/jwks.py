@@ -0,0 +1,20 @@
+from fastapi import Response
+from fastapi.routing import APIRouter
+from app.core.config import settings
+from app.models.token import JwksOut
+from app.services.token import key_ring
+
+
+router = APIRouter(tags=['Keys'])
+
+
+@router.get('/.well-known/jwks.json', response_model=JwksOut)
+def get_jwks(response: Response):
+    """
+    Public keys for verifying access tokens locally.
+    Empty when tokens are signed with a shared secret.
+    """
+    response.headers['Cache-Control'] = f'public, max-age={settings.jwks_max_age}'
+    if key_ring:
+        return key_ring.jwks()
+    return JwksOut(keys=[])
@@ -1,7 +1,7 @@
 from typing import Union
 from fastapi.routing import APIRouter
 
-from fastapi import Depends
+from fastapi import Depends, Request
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from app.models.auth import LegalUserAuthenticationIn, RealUserAuthenticationIn
 from app.models.token import AccessTokenOut
@@ -15,8 +15,13 @@ router = APIRouter(tags=['Login'])
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/token/")
 
 
+def get_client_ip(request: Request) -> Union[str, None]:
+    return request.client.host if request.client else None
+
+
 @router.post("/token/")
 async def login_for_swagger(
+    request: Request,
     credentials: OAuth2PasswordRequestForm = Depends(),
     srv: AuthService = Depends(get_srv)
 ):
@@ -41,7 +46,7 @@ async def login_for_swagger(
                 platform="*", role="admin")
         )
 
-    user = srv.authenticate(cred)
+    user = await srv.authenticate(cred, get_client_ip(request))
 
     access_token = get_access_token(
         user,
@@ -54,6 +59,7 @@ async def login_for_swagger(
 
 @router.post("/login/", response_model=AccessTokenOut)
 async def login_user(
+    request: Request,
     credentials: Union[RealUserAuthenticationIn, LegalUserAuthenticationIn],
     srv: AuthService = Depends(get_srv)
 ):
@@ -62,7 +68,7 @@ async def login_user(
 
     **platform_name**: Platform that user came from:
     """
-    user = srv.authenticate(credentials)
+    user = await srv.authenticate(credentials, get_client_ip(request))
 
     access_token = get_access_token(
         user,
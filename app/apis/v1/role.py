@@ -25,7 +25,7 @@ async def create_role(
 ):
     """ Create a new role or update one """
 
-    return srv.database.roles.create(role.to_model())
+    return await srv.database.roles.create(role.to_model())
 
 
 @router.get("/", response_model=List[Role])
@@ -35,7 +35,7 @@ async def get_roles(
 ):
     """ Get all roles """
 
-    return srv.database.roles.get_all()
+    return await srv.database.roles.get_all()
 
 
 @router.delete("/{role_id}/", response_model=StandardResponse)
@@ -47,7 +47,7 @@ async def delete_role(
     """ Delete role. """
 
     try:
-        srv.database.roles.delete_by_id(role_id)
+        await srv.database.roles.delete_by_id(role_id)
     except RoleDoesNotExist as e:
         raise HTTPNotFoundError(e)
     return standard_response(_("role deleted"))
@@ -1,8 +1,10 @@
-from typing import Union, List
-from fastapi import Depends
+from typing import AsyncIterator, Union, List, Optional
+from bson import ObjectId
+from fastapi import Depends, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 from fastapi.routing import APIRouter
 from fastapi.exceptions import HTTPException
-from app.models.user import LegalUser, LegalUserCreationIn, RealUser, PasswordUpdateIn, PhoneNumberUpdateIn, UserUpdateIn, ProfileOut
+from app.models.user import LegalUser, LegalUserCreationIn, RealUser, PasswordUpdateIn, PhoneNumberUpdateIn, UserUpdateIn, ProfileOut, UserImportOut
 from app.models.token import JwtPayload
 from app.models.profile import (
     PictureIn, PictureOut)
@@ -13,7 +15,9 @@ from app.models.user import RealUser, LegalUser, RealUserCreationIn
 from app.apis.response import standard_response
 from app.models.verification import RealUserCodeVerificationIn
 from app.utils.translation import _
-from app.services import AuthService, get_srv
+from app.services import AuthService, UserImporter, get_srv
+from app.services.importer import iter_lines
+from app.core.security import password_hasher
 
 
 router = APIRouter(prefix="/users", tags=['Users'])
@@ -25,19 +29,82 @@ async def create_user(
     admin: Union[RealUser, LegalUser] = Depends(get_current_admin_user),
     srv: AuthService = Depends(get_srv)
 ):
-    srv.database.users.create(user_in.to_model())
+    hashed_password = await password_hasher.hash(user_in.password1)
+    await srv.database.users.create(user_in.to_model(hashed_password))
     return standard_response(_("user created"))
 
 
+@router.post('/import/', response_model=UserImportOut)
+async def import_users(
+    request: Request,
+    format: str = Query('csv', regex='^(csv|ndjson)$'),
+    admin: Union[RealUser, LegalUser] = Depends(get_current_admin_user),
+    srv: AuthService = Depends(get_srv)
+):
+    """
+    Bulk create users from the request body, which is read as a stream.
+
+    - **csv**: the first line is the header, e.g.
+    `type,national_code,company_code,phone_number,first_name,last_name,company_name,domain,password,roles`.
+    roles are written as `platform:name1|name2;platform2:name3`.
+    - **ndjson**: one user object per line with the same fields.
+
+    Rows that fail are reported by line number, the other rows are still created.
+    """
+    return await UserImporter(srv.database).run(iter_lines(request.stream()), format)
+
+
+async def stream_profiles(documents: AsyncIterator[dict]) -> AsyncIterator[str]:
+    async for document in documents:
+        yield ProfileOut.from_document(document).json(by_alias=True) + "\n"
+
+
 @router.get('/', response_model=List[ProfileOut])
 async def get_users(
+    response: Response,
+    after: Optional[str] = Query(None, description="id of the last user of the previous page"),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    fields: Optional[str] = Query(None, description="comma separated profile fields"),
+    user_type: Optional[str] = Query(None, alias='type'),
+    platform: Optional[str] = None,
+    role: Optional[str] = None,
+    format: str = Query('json', regex='^(json|ndjson)$'),
     admin: Union[RealUser, LegalUser] = Depends(get_current_admin_user),
     srv: AuthService = Depends(get_srv)
 ):
-    return list(map(
-        lambda user: ProfileOut.from_db(user),  # type: ignore
-        srv.database.users.get_all()
-    ))
+    """
+    List users ordered by id.
+
+    - **after**: pass the X-Next-Cursor header of the previous page to get the next one.
+    - **limit**: page size, defaults to 100 for json. ndjson streams every user unless limited.
+    - **fields**: e.g. `phone_number,real_user`. id and type are always returned.
+    - **format**: `ndjson` streams one profile per line.
+    """
+    if after and not ObjectId.is_valid(after):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=_("invalid cursor"))
+    try:
+        document_fields = ProfileOut.document_fields(
+            fields.split(',')) if fields else None
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
+
+    if format == 'json' and not limit:
+        limit = 100
+
+    documents = srv.database.users.find(
+        after=after, limit=limit, fields=document_fields,
+        user_type=user_type, platform=platform, role=role)
+
+    if format == 'ndjson':
+        return StreamingResponse(
+            stream_profiles(documents), media_type='application/x-ndjson')
+
+    profiles = [ProfileOut.from_document(document) async for document in documents]
+    if limit and len(profiles) == limit:
+        response.headers['X-Next-Cursor'] = str(profiles[-1].id)
+    return profiles
 
 
 @router.get("/me/", response_model=ProfileOut)
@@ -56,7 +123,7 @@ async def get_my_user(
     - **current_platform**: are information about the platform
     that the user originally logged-in from.
     """
-    user = service.database.users.get_by_id(payload.user.id)
+    user = await service.database.users.get_by_id(payload.user.id)
     return ProfileOut.from_db(
         user=user, current_platform=payload.current_platform)
 
@@ -83,7 +150,7 @@ async def update_my_user(
     - - **address_information**: All field in this object are required.
     It means, you either have to send it completely, or not send it at all.
     """
-    service.database.users.update(user_in.to_model(user))
+    await service.database.users.update(user_in.to_model(user))
     return standard_response(_('profile updated successfully'))
 
 
@@ -93,22 +160,22 @@ async def update_my_user(
     responses={400: {'model': StandardResponse,
                      'description': 'Invalid or Expired Verification Code'}}
 )
-def change_password(
+async def change_password(
     password_in: PasswordUpdateIn,
     service: AuthService = Depends(get_srv)
 ):
     """ Change user password. """
-    service.verification.verify(
+    await service.verification.verify(
         password_in.verification, delete_on_success=True)
     if isinstance(password_in.verification, RealUserCodeVerificationIn):
-        user = service.database.users.get_by_national_code(
+        user = await service.database.users.get_by_national_code(
             password_in.verification.national_code)
     else:
-        user = service.database.users.get_by_company_code(
+        user = await service.database.users.get_by_company_code(
             password_in.verification.company_code)
 
-    user.set_password(password_in.password1)
-    service.database.users.update(user)
+    await user.set_password_async(password_in.password1)
+    await service.database.users.update(user)
 
     return standard_response(_("password successfully reset."))
 
@@ -119,7 +186,7 @@ def change_password(
     responses={400: {'model': StandardResponse,
                      'description': 'Invalid or Expired Verification Code'}}
 )
-def change_phone_number(
+async def change_phone_number(
     phone_number_in: PhoneNumberUpdateIn,
     user: Union[RealUser, LegalUser] = Depends(get_current_user),
     service: AuthService = Depends(get_srv)
@@ -134,11 +201,11 @@ def change_phone_number(
     if phone_number_in.phone_number == user.phone_number:
         raise HTTPException(
             status_code=400, detail="can't use the same phone number")
-    service.verification.verify(
+    await service.verification.verify(
         phone_number_in.verification, delete_on_success=True)
 
     user.phone_number = phone_number_in.phone_number
-    service.database.users.update(user)
+    await service.database.users.update(user)
     return standard_response(_("phone number updated successfully."))
 
 
@@ -1 +1,4 @@
-from app.cache.cache import Cache, RedisCache, MemoryCache
+from app.cache.cache import AsyncCache, AsyncRedisCache, Cache, RedisCache, MemoryCache
+from app.cache.principal import PrincipalCache
+from app.cache.tiered import AsyncTieredCache
+from app.cache.threaded import ThreadedCache
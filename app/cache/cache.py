@@ -1,64 +1,602 @@
-from typing import Dict, Union
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Tuple, Union
 from datetime import timedelta
 import json
+import math
+import threading
+import time
+import uuid
 from redis import Redis
+import redis.asyncio as aioredis
+
+
+def ttl_seconds(ttl: Union[float, timedelta, None]) -> float:
+    """ 0 or None means no expiry. """
+    if isinstance(ttl, timedelta):
+        return ttl.total_seconds()
+    return ttl or 0
+
+
+def ttl_milliseconds(ttl: Union[float, timedelta, None]) -> Union[int, None]:
+    # Milliseconds so fractional ttls aren't rejected or rounded down to zero
+    return math.ceil(ttl_seconds(ttl) * 1000) or None
+
+
+class PipelineCommands:
+    """
+    Cache operations queued on a pipeline, results holds one result per operation
+    once the pipeline is executed. written lists the keys of queued set and delete calls.
+    """
+    results: List[Any]
+    written: List[str]
+
+    def get(self, key: str): ...
+
+    def set(self, key: str, value: dict, ttl: Union[float, timedelta]): ...
+
+    def delete(self, key: str): ...
+
+    def has(self, key: str): ...
+
+    def add_event(self, key: str, window: float): ...
+
+    def count_events(self, key: str, window: float): ...
+
+
+class PipelineWrapper(PipelineCommands):
+    """ Queues on another pipeline. """
+
+    def __init__(self, pipeline: PipelineCommands) -> None:
+        self.pipeline = pipeline
+        self.results = []
+        self.written = pipeline.written
+
+    def get(self, key: str):
+        self.pipeline.get(key)
+
+    def set(self, key: str, value: dict, ttl: Union[float, timedelta]):
+        self.pipeline.set(key, value, ttl)
+
+    def delete(self, key: str):
+        self.pipeline.delete(key)
+
+    def has(self, key: str):
+        self.pipeline.has(key)
+
+    def add_event(self, key: str, window: float):
+        self.pipeline.add_event(key, window)
+
+    def count_events(self, key: str, window: float):
+        self.pipeline.count_events(key, window)
+
+
+class CachePipeline(PipelineCommands):
+    """
+    Runs the operations queued in a with block together when it exits,
+    nothing runs if the block raises.
+    """
+
+    def execute(self) -> List[Any]: ...
+
+    def __enter__(self) -> "CachePipeline":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.results = self.execute()
+
+
+class AsyncCachePipeline(PipelineCommands):
+    """ Same as CachePipeline but used with async with. """
+
+    async def execute(self) -> List[Any]: ...
+
+    async def __aenter__(self) -> "AsyncCachePipeline":
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.results = await self.execute()
 
 
 class Cache:
     def get(self, key: str) -> Union[dict, None]: ...
 
+    def get_many(self, keys: List[str]) -> Dict[str, dict]:
+        """ Values of the existing keys. """
+        ...
+
     def set(self, key: str, value: dict, ttl: Union[float, timedelta]): ...
 
+    def set_many(self, values: Dict[str, dict], ttl: Union[float, timedelta]): ...
+
     def delete(self, key: str): ...
 
-    def has(self, key: str) -> bool: ...
+    def delete_many(self, keys: List[str]): ...
+
+    def has(self, key: str) -> bool:
+        """ Doesn't fetch the value. """
+        ...
+
+    def add_event(self, key: str, window: float) -> int:
+        """ Records an event now and returns the number of events in the last window seconds. """
+        ...
+
+    def count_events(self, key: str, window: float) -> int:
+        """ Returns the number of events recorded in the last window seconds. """
+        ...
+
+    def pipeline(self, transaction: bool = True) -> CachePipeline:
+        """
+        Queues operations and runs them in one round trip, e.g.
+        `with cache.pipeline() as pipe: pipe.get(key1); pipe.delete(key2)`, then read pipe.results.
+        With transaction other clients never see part of the operations applied.
+        """
+        ...
 
     def ping(self) -> bool: ...
 
+    def start(self) -> None: ...
+
+    def stop(self) -> None: ...
+
+
+class AsyncCache:
+    """
+    Cache interface used by the services.
+    Blocking Cache implementations are wrapped with ThreadedCache.
+    """
+
+    async def get(self, key: str) -> Union[dict, None]: ...
+
+    async def get_many(self, keys: List[str]) -> Dict[str, dict]: ...
+
+    async def set(self, key: str, value: dict, ttl: Union[float, timedelta]): ...
+
+    async def set_many(self, values: Dict[str, dict], ttl: Union[float, timedelta]): ...
+
+    async def delete(self, key: str): ...
+
+    async def delete_many(self, keys: List[str]): ...
+
+    async def has(self, key: str) -> bool: ...
+
+    async def add_event(self, key: str, window: float) -> int: ...
+
+    async def count_events(self, key: str, window: float) -> int: ...
+
+    def pipeline(self, transaction: bool = True) -> AsyncCachePipeline:
+        """ See Cache.pipeline, used with async with. """
+        ...
+
+    async def ping(self) -> bool: ...
+
+    async def start(self) -> None:
+        """ Starts background work such as invalidation listeners. """
+        ...
+
+    async def stop(self) -> None: ...
+
+
+def decode_value(value: Union[bytes, None]) -> Union[dict, None]:
+    if not value:
+        return None
+    return json.loads(value)
+
+
+class RedisCommands(PipelineCommands):
+    """
+    Translates cache operations to commands on a redis pipeline,
+    shared by the blocking and the asyncio client since queueing never does I/O.
+    """
+
+    def __init__(self, pipeline) -> None:
+        self.pipeline = pipeline
+        # Number of redis replies and how to turn them into the result, per operation
+        self.decoders: List[Tuple[int, Callable[[list], Any]]] = []
+        self.results = []
+        self.written = []
+
+    def get(self, key: str):
+        self.pipeline.get(key)
+        self.decoders.append((1, lambda replies: decode_value(replies[0])))
+
+    def get_with_ttl(self, key: str):
+        self.pipeline.get(key)
+        self.pipeline.pttl(key)
+        self.decoders.append((2, lambda replies: (
+            decode_value(replies[0]), max(replies[1], 0) / 1000 if replies[0] else 0)))
+
+    def set(self, key: str, value: dict, ttl: Union[float, timedelta]):
+        self.pipeline.set(key, json.dumps(value), px=ttl_milliseconds(ttl))
+        self.decoders.append((1, lambda replies: None))
+        self.written.append(key)
+
+    def delete(self, key: str):
+        self.pipeline.delete(key)
+        self.decoders.append((1, lambda replies: None))
+        self.written.append(key)
+
+    def has(self, key: str):
+        self.pipeline.exists(key)
+        self.decoders.append((1, lambda replies: replies[0] > 0))
+
+    def add_event(self, key: str, window: float):
+        now = time.time()
+        self.pipeline.zremrangebyscore(key, '-inf', now - window)
+        self.pipeline.zadd(key, {uuid.uuid4().hex: now})
+        self.pipeline.zcard(key)
+        self.pipeline.expire(key, math.ceil(window))
+        self.decoders.append((4, lambda replies: replies[2]))
+
+    def count_events(self, key: str, window: float):
+        self.pipeline.zcount(key, time.time() - window, '+inf')
+        self.decoders.append((1, lambda replies: replies[0]))
+
+    def decode(self, replies: list) -> List[Any]:
+        results, i = [], 0
+        for count, decoder in self.decoders:
+            results.append(decoder(replies[i:i + count]))
+            i += count
+        return results
+
+
+class RedisCachePipeline(RedisCommands, CachePipeline):
+    def execute(self) -> List[Any]:
+        return self.decode(self.pipeline.execute())
+
+
+class AsyncRedisCachePipeline(RedisCommands, AsyncCachePipeline):
+    async def execute(self) -> List[Any]:
+        return self.decode(await self.pipeline.execute())
+
 
 class RedisCache(Cache):
     def __init__(self, host: str, port: int, db: int, password: str) -> None:
         self.redis = Redis(host, port, db, password)
 
     def get(self, key: str) -> Union[dict, None]:
-        value = self.redis.get(key)
-        if not value:
-            return None
-        return json.loads(value)
+        return decode_value(self.redis.get(key))
+
+    def get_many(self, keys: List[str]) -> Dict[str, dict]:
+        if not keys:
+            return {}
+        values = zip(keys, self.redis.mget(keys))
+        return {k: json.loads(v) for k, v in values if v}
 
     def set(self, key: str, value: dict, ttl: Union[float, timedelta]):
-        self.redis.set(key, json.dumps(value), ttl)
+        self.redis.set(key, json.dumps(value), px=ttl_milliseconds(ttl))
+
+    def set_many(self, values: Dict[str, dict], ttl: Union[float, timedelta]):
+        # MSET can't set a ttl
+        with self.pipeline(transaction=False) as pipeline:
+            for key, value in values.items():
+                pipeline.set(key, value, ttl)
 
     def delete(self, key: str):
         self.redis.delete(key)
 
+    def delete_many(self, keys: List[str]):
+        if keys:
+            self.redis.delete(*keys)
+
     def has(self, key: str) -> bool:
-        if self.redis.get(key):
-            return True
-        return False
+        return self.redis.exists(key) > 0
+
+    def add_event(self, key: str, window: float) -> int:
+        # MULTI/EXEC keeps the window consistent across workers
+        with self.pipeline(transaction=True) as pipeline:
+            pipeline.add_event(key, window)
+        return pipeline.results[0]
+
+    def count_events(self, key: str, window: float) -> int:
+        return self.redis.zcount(key, time.time() - window, '+inf')
+
+    def pipeline(self, transaction: bool = True) -> RedisCachePipeline:
+        return RedisCachePipeline(self.redis.pipeline(transaction=transaction))
 
     def ping(self) -> bool:
         return self.redis.ping()
 
 
+class AsyncRedisCache(AsyncCache):
+    """
+    Redis through the asyncio client, nothing blocks the event loop.
+    At most max_connections are opened, callers wait up to pool_timeout seconds for a free one.
+    """
+
+    def __init__(self,
+                 host: str,
+                 port: int,
+                 db: int,
+                 password: str,
+                 max_connections: int = 50,
+                 pool_timeout: float = 5) -> None:
+        self.redis = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(
+            host=host, port=port, db=db, password=password,
+            max_connections=max_connections, timeout=pool_timeout))
+
+    async def get(self, key: str) -> Union[dict, None]:
+        return decode_value(await self.redis.get(key))
+
+    async def get_many(self, keys: List[str]) -> Dict[str, dict]:
+        if not keys:
+            return {}
+        values = zip(keys, await self.redis.mget(keys))
+        return {k: json.loads(v) for k, v in values if v}
+
+    async def get_with_ttl(self, key: str) -> Tuple[Union[dict, None], float]:
+        """ Value and its remaining ttl in seconds in one round trip, 0 means no expiry. """
+        return (await self.get_many_with_ttl([key])).get(key, (None, 0))
+
+    async def get_many_with_ttl(self, keys: List[str]) -> Dict[str, Tuple[dict, float]]:
+        pipeline = AsyncRedisCachePipeline(self.redis.pipeline(transaction=False))
+        for key in keys:
+            pipeline.get_with_ttl(key)
+        values = zip(keys, await pipeline.execute())
+        return {k: v for k, v in values if v[0] is not None}
+
+    async def set(self, key: str, value: dict, ttl: Union[float, timedelta]):
+        await self.redis.set(key, json.dumps(value), px=ttl_milliseconds(ttl))
+
+    async def set_many(self, values: Dict[str, dict], ttl: Union[float, timedelta]):
+        async with self.pipeline(transaction=False) as pipeline:
+            for key, value in values.items():
+                pipeline.set(key, value, ttl)
+
+    async def delete(self, key: str):
+        await self.redis.delete(key)
+
+    async def delete_many(self, keys: List[str]):
+        if keys:
+            await self.redis.delete(*keys)
+
+    async def has(self, key: str) -> bool:
+        return await self.redis.exists(key) > 0
+
+    async def add_event(self, key: str, window: float) -> int:
+        async with self.pipeline(transaction=True) as pipeline:
+            pipeline.add_event(key, window)
+        return pipeline.results[0]
+
+    async def count_events(self, key: str, window: float) -> int:
+        return await self.redis.zcount(key, time.time() - window, '+inf')
+
+    def pipeline(self, transaction: bool = True) -> AsyncRedisCachePipeline:
+        return AsyncRedisCachePipeline(self.redis.pipeline(transaction=transaction))
+
+    async def ping(self) -> bool:
+        return await self.redis.ping()
+
+    async def stop(self):
+        await self.redis.close()
+        await self.redis.connection_pool.disconnect()
+
+
+class MemoryCachePipeline(CachePipeline):
+    """ Runs the queued operations while holding the cache lock. """
+
+    def __init__(self, cache: "MemoryCache") -> None:
+        self.cache = cache
+        self.operations: List[Tuple[Callable, tuple]] = []
+        self.results = []
+        self.written = []
+
+    def get(self, key: str):
+        self.operations.append((self.cache.get, (key,)))
+
+    def set(self, key: str, value: dict, ttl: Union[float, timedelta]):
+        self.operations.append((self.cache.set, (key, value, ttl)))
+        self.written.append(key)
+
+    def delete(self, key: str):
+        self.operations.append((self.cache.delete, (key,)))
+        self.written.append(key)
+
+    def has(self, key: str):
+        self.operations.append((self.cache.has, (key,)))
+
+    def add_event(self, key: str, window: float):
+        self.operations.append((self.cache.add_event, (key, window)))
+
+    def count_events(self, key: str, window: float):
+        self.operations.append((self.cache.count_events, (key, window)))
+
+    def execute(self) -> List[Any]:
+        with self.cache.lock:
+            return [operation(*args) for operation, args in self.operations]
+
+
 class MemoryCache(Cache):
-    def __init__(self) -> None:
-        self.cache: Dict[str, dict] = {}
+    """
+    In-process cache with per entry ttl and LRU eviction.
+    Bounded by max_entries and, when max_bytes is set, by the JSON size of the values.
+    Expired entries are dropped when read, by writes once sweep_interval has passed
+    and, between start and stop, by a background sweep every sweep_interval seconds.
+    """
+
+    def __init__(self,
+                 max_entries: int = 10000,
+                 max_bytes: int = 0,
+                 sweep_interval: float = 60) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        # key -> (value, expires_at, size), least recently used first
+        self.cache: "OrderedDict[str, Tuple[dict, float, int]]" = OrderedDict()
+        self.events: Dict[str, List[float]] = {}
+        self.event_windows: Dict[str, float] = {}
+        # Shared by request handlers and the database threads,
+        # reentrant so pipelines can hold it across operations
+        self.lock = threading.RLock()
+        self.bytes = 0
+        self.last_sweep = time.monotonic()
+        self.sweeper: Union[threading.Thread, None] = None
+        self.stopped = threading.Event()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __pop(self, key: str):
+        _, _, size = self.cache.pop(key)
+        self.bytes -= size
+
+    def __get(self, key: str, now: float) -> Union[dict, None]:
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        value, expires_at, _ = entry
+        if expires_at <= now:
+            self.__pop(key)
+            self.expirations += 1
+            return None
+        return value
+
+    def __sweep(self, now: float) -> int:
+        self.last_sweep = now
+        expired = [k for k, (_, expires_at, _) in self.cache.items() if expires_at <= now]
+        for key in expired:
+            self.__pop(key)
+        self.expirations += len(expired)
+
+        wall_time = time.time()
+        for key in [k for k, w in self.event_windows.items()
+                    if self.events[k][-1] <= wall_time - w]:
+            del self.events[key]
+            del self.event_windows[key]
+        return len(expired)
+
+    def sweep(self) -> int:
+        """ Drops every expired entry, returns the number of dropped entries. """
+        with self.lock:
+            return self.__sweep(time.monotonic())
+
+    def __sweep_periodically(self):
+        # Idle and read only caches would otherwise keep expired entries
+        while not self.stopped.wait(self.sweep_interval):
+            self.sweep()
+
+    def start(self):
+        """ Starts the background sweep. """
+        if self.sweeper is not None:
+            return
+        self.stopped.clear()
+        self.sweeper = threading.Thread(
+            target=self.__sweep_periodically, name='memory-cache-sweeper', daemon=True)
+        self.sweeper.start()
+
+    def stop(self):
+        if self.sweeper is None:
+            return
+        self.stopped.set()
+        self.sweeper.join()
+        self.sweeper = None
 
     def get(self, key: str) -> Union[dict, None]:
-        return self.cache.get(key)
+        with self.lock:
+            value = self.__get(key, time.monotonic())
+            if value is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return value
 
     def set(self, key: str, value: dict, ttl: Union[float, timedelta] = 0):
-        self.cache.update({key: value})
+        now = time.monotonic()
+        seconds = ttl_seconds(ttl)
+        expires_at = now + seconds if seconds > 0 else math.inf
+        # default=str so values with BSON types such as user documents can be sized
+        size = len(json.dumps(value, default=str)) if self.max_bytes else 0
+
+        with self.lock:
+            if key in self.cache:
+                self.__pop(key)
+            if self.max_bytes and size > self.max_bytes:
+                return
+            self.cache[key] = (value, expires_at, size)
+            self.bytes += size
+
+            if now - self.last_sweep >= self.sweep_interval:
+                self.__sweep(now)
+            while len(self.cache) > self.max_entries or \
+                    (self.max_bytes and self.bytes > self.max_bytes):
+                self.__pop(next(iter(self.cache)))
+                self.evictions += 1
 
     def delete(self, key: str):
-        if self.cache.get(key):
-            del self.cache[key]
+        with self.lock:
+            if key in self.cache:
+                self.__pop(key)
+            self.events.pop(key, None)
+            self.event_windows.pop(key, None)
 
     def has(self, key: str) -> bool:
-        if self.cache.get(key):
-            return True
-        return False
+        with self.lock:
+            return self.__get(key, time.monotonic()) is not None
+
+    def get_many(self, keys: List[str]) -> Dict[str, dict]:
+        with self.lock:
+            values = {key: self.get(key) for key in keys}
+        return {k: v for k, v in values.items() if v is not None}
+
+    def set_many(self, values: Dict[str, dict], ttl: Union[float, timedelta] = 0):
+        with self.lock:
+            for key, value in values.items():
+                self.set(key, value, ttl)
+
+    def delete_many(self, keys: List[str]):
+        with self.lock:
+            for key in keys:
+                self.delete(key)
+
+    def pipeline(self, transaction: bool = True) -> MemoryCachePipeline:
+        """ Always transactional. """
+        return MemoryCachePipeline(self)
+
+    def __events_in_window(self, key: str, window: float) -> List[float]:
+        start = time.time() - window
+        events = [t for t in self.events.get(key, []) if t > start]
+        if events:
+            self.events[key] = events
+        else:
+            self.events.pop(key, None)
+            self.event_windows.pop(key, None)
+        return events
+
+    def add_event(self, key: str, window: float) -> int:
+        with self.lock:
+            events = self.__events_in_window(key, window)
+            events.append(time.time())
+            self.events[key] = events
+            self.event_windows[key] = window
+            return len(events)
+
+    def count_events(self, key: str, window: float) -> int:
+        with self.lock:
+            return len(self.__events_in_window(key, window))
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.events.clear()
+            self.event_windows.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'size': len(self.cache),
+                'max_entries': self.max_entries,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
 
     def ping(self) -> bool:
         return True
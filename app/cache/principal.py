@@ -0,0 +1,39 @@
+from typing import Union
+
+from bson import json_util
+
+from app.cache.cache import AsyncCache
+
+
+class PrincipalCache:
+    """
+    Short lived cache of user documents keyed by user id.
+    Backed by the shared cache, so with a tiered cache hot users are served in process
+    and invalidations reach every worker. Writers must call invalidate after changing a user.
+    Secret fields are never cached, so documents read back lack the password hash.
+    """
+
+    excluded_fields = ('password',)
+    prefix = 'principal:'
+
+    def __init__(self, cache: AsyncCache, ttl: float) -> None:
+        self.cache = cache
+        self.ttl = ttl
+
+    def __key(self, user_id: str) -> str:
+        return f"{self.prefix}{user_id}"
+
+    async def get(self, user_id: str) -> Union[dict, None]:
+        entry = await self.cache.get(self.__key(user_id))
+        if not entry:
+            return None
+        return json_util.loads(entry['document'])
+
+    async def set(self, user_id: str, document: dict):
+        document = {k: v for k, v in document.items() if k not in self.excluded_fields}
+        # Extended JSON keeps ObjectId and datetime values through the JSON cache
+        await self.cache.set(
+            self.__key(user_id), {'document': json_util.dumps(document)}, self.ttl)
+
+    async def invalidate(self, user_id: str):
+        await self.cache.delete(self.__key(user_id))
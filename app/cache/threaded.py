@@ -0,0 +1,60 @@
+from datetime import timedelta
+from typing import Any, Dict, List, Union
+
+from app.cache.cache import AsyncCache, AsyncCachePipeline, Cache, CachePipeline, PipelineWrapper
+from app.utils.utils import run_in_thread
+
+
+class ThreadedCachePipeline(PipelineWrapper, AsyncCachePipeline):
+    """ Queues on a blocking pipeline and executes it on the default thread pool. """
+
+    pipeline: CachePipeline
+
+    async def execute(self) -> List[Any]:
+        return await run_in_thread(self.pipeline.execute)
+
+
+class ThreadedCache(AsyncCache):
+    """ Runs a blocking Cache on the default thread pool. """
+
+    def __init__(self, cache: Cache) -> None:
+        self.cache = cache
+
+    async def get(self, key: str) -> Union[dict, None]:
+        return await run_in_thread(self.cache.get, key)
+
+    async def get_many(self, keys: List[str]) -> Dict[str, dict]:
+        return await run_in_thread(self.cache.get_many, keys)
+
+    async def set(self, key: str, value: dict, ttl: Union[float, timedelta]):
+        return await run_in_thread(self.cache.set, key, value, ttl)
+
+    async def set_many(self, values: Dict[str, dict], ttl: Union[float, timedelta]):
+        return await run_in_thread(self.cache.set_many, values, ttl)
+
+    async def delete(self, key: str):
+        return await run_in_thread(self.cache.delete, key)
+
+    async def delete_many(self, keys: List[str]):
+        return await run_in_thread(self.cache.delete_many, keys)
+
+    async def has(self, key: str) -> bool:
+        return await run_in_thread(self.cache.has, key)
+
+    async def add_event(self, key: str, window: float) -> int:
+        return await run_in_thread(self.cache.add_event, key, window)
+
+    async def count_events(self, key: str, window: float) -> int:
+        return await run_in_thread(self.cache.count_events, key, window)
+
+    def pipeline(self, transaction: bool = True) -> ThreadedCachePipeline:
+        return ThreadedCachePipeline(self.cache.pipeline(transaction))
+
+    async def ping(self) -> bool:
+        return await run_in_thread(self.cache.ping)
+
+    async def start(self):
+        return await run_in_thread(self.cache.start)
+
+    async def stop(self):
+        return await run_in_thread(self.cache.stop)
@@ -0,0 +1,224 @@
+import asyncio
+import uuid
+from datetime import timedelta
+from typing import Any, Dict, List, Tuple, Union
+
+from redis.asyncio.client import PubSub as AsyncPubSub
+from redis.exceptions import RedisError
+
+from app.cache.cache import (
+    AsyncCache, AsyncCachePipeline, AsyncRedisCache, MemoryCache, PipelineWrapper, ttl_seconds)
+from app.core.logging import logger
+
+
+class AsyncTieredCachePipeline(PipelineWrapper, AsyncCachePipeline):
+    """ Invalidates the written keys once the redis pipeline is executed. """
+
+    pipeline: AsyncCachePipeline
+
+    def __init__(self, cache: "AsyncTieredCache", pipeline: AsyncCachePipeline) -> None:
+        super().__init__(pipeline)
+        self.cache = cache
+
+    async def execute(self) -> List[Any]:
+        results = await self.pipeline.execute()
+        await self.cache.invalidate(self.written)
+        return results
+
+
+class AsyncTieredCache(AsyncCache):
+    """
+    MemoryCache in front of an AsyncRedisCache.
+    Writes go to redis and are broadcast on a pub/sub channel,
+    every other worker drops the key from its local tier when it receives them.
+    Local entries live at most local_ttl seconds and never outlive the redis entry.
+    Only keys starting with one of local_prefixes are kept locally, every key when it's None.
+    Keys that must not be served stale, such as one time codes, are left out of it.
+    Events are always counted in redis since they are shared between workers.
+    All state is changed on the event loop, the listener included.
+    """
+
+    def __init__(self,
+                 remote: AsyncRedisCache,
+                 local: MemoryCache,
+                 local_ttl: float = 5,
+                 channel: str = 'cache:invalidate',
+                 local_prefixes: Union[Tuple[str, ...], None] = None) -> None:
+        self.remote = remote
+        self.local = local
+        self.local_ttl = local_ttl
+        self.channel = channel
+        self.local_prefixes = local_prefixes
+        # Our own invalidations are ignored
+        self.node = uuid.uuid4().hex
+        self.pubsub: Union[AsyncPubSub, None] = None
+        self.task: Union[asyncio.Task, None] = None
+
+        # The local tier is only filled while invalidations are received
+        self.listening = False
+        # Bumped on every invalidation, a redis read that raced one isn't cached
+        self.generation = 0
+
+        self.remote_hits = 0
+        self.remote_misses = 0
+        self.invalidations = 0
+
+    def is_local(self, key: str) -> bool:
+        return self.local_prefixes is None or key.startswith(self.local_prefixes)
+
+    def local_ttl_for(self, ttl: float) -> float:
+        return min(ttl, self.local_ttl) if ttl > 0 else self.local_ttl
+
+    def invalidation(self, keys: List[str]) -> str:
+        return f"{self.node}:" + '\n'.join(keys)
+
+    def on_invalidation(self, data: bytes):
+        node, _, keys = data.decode().partition(':')
+        if node == self.node:
+            return
+        self.generation += 1
+        self.invalidations += 1
+        self.local.delete_many(keys.split('\n'))
+
+    def on_message(self, message: dict):
+        if message['type'] == 'subscribe':
+            self.listening = True
+        elif message['type'] == 'message':
+            self.on_invalidation(message['data'])
+
+    def on_disconnect(self):
+        # Invalidations may have been missed
+        self.listening = False
+        self.generation += 1
+        self.local.clear()
+
+    def on_remote_value(self, key: str, value: Union[dict, None], ttl: float, generation: int):
+        if value is None:
+            self.remote_misses += 1
+            return
+        self.remote_hits += 1
+        if self.listening and generation == self.generation and self.is_local(key):
+            self.local.set(key, value, self.local_ttl_for(ttl))
+
+    def on_set(self, values: Dict[str, dict], ttl: Union[float, timedelta]):
+        if self.listening:
+            self.local.set_many(
+                {k: v for k, v in values.items() if self.is_local(k)},
+                self.local_ttl_for(ttl_seconds(ttl)))
+        else:
+            self.local.delete_many(list(values))
+
+    def get_local(self, keys: List[str]) -> Tuple[Dict[str, dict], List[str], int]:
+        """ Locally cached values, the keys to read from redis and the current generation. """
+        values = self.local.get_many([k for k in keys if self.is_local(k)])
+        return values, [k for k in keys if k not in values], self.generation
+
+    def on_remote_values(self,
+                         keys: List[str],
+                         values: Dict[str, Tuple[dict, float]],
+                         generation: int) -> Dict[str, dict]:
+        for key in keys:
+            value, ttl = values.get(key, (None, 0))
+            self.on_remote_value(key, value, ttl, generation)
+        return {k: v for k, (v, _) in values.items()}
+
+    def stats(self) -> dict:
+        return {
+            **self.local.stats(),
+            'remote_hits': self.remote_hits,
+            'remote_misses': self.remote_misses,
+            'invalidations': self.invalidations,
+            'listening': self.listening,
+        }
+
+    async def __listen(self):
+        while True:
+            try:
+                if not self.pubsub.subscribed:  # type: ignore
+                    await self.pubsub.subscribe(self.channel)  # type: ignore
+                message = await self.pubsub.get_message(timeout=1)  # type: ignore
+            except RedisError as exc:
+                if self.listening:
+                    logger.warning(f"Cache invalidation channel is down: {exc}")
+                self.on_disconnect()
+                await asyncio.sleep(1)
+                continue
+            if message is not None:
+                self.on_message(message)
+
+    async def start(self):
+        if self.task is not None:
+            return
+        self.local.start()
+        self.pubsub = self.remote.redis.pubsub()
+        self.task = asyncio.create_task(self.__listen())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        await self.pubsub.close()  # type: ignore
+        self.pubsub = None
+        self.on_disconnect()
+        self.local.stop()
+        await self.remote.stop()
+
+    async def get(self, key: str) -> Union[dict, None]:
+        if self.is_local(key):
+            value = self.local.get(key)
+            if value is not None:
+                return value
+
+        generation = self.generation
+        value, ttl = await self.remote.get_with_ttl(key)
+        self.on_remote_value(key, value, ttl, generation)
+        return value
+
+    async def get_many(self, keys: List[str]) -> Dict[str, dict]:
+        values, missing, generation = self.get_local(keys)
+        if missing:
+            values.update(self.on_remote_values(
+                missing, await self.remote.get_many_with_ttl(missing), generation))
+        return values
+
+    async def invalidate(self, keys: List[str]):
+        """ Drops keys from the local tier of every worker. """
+        self.local.delete_many(keys)
+        if keys:
+            await self.remote.redis.publish(self.channel, self.invalidation(keys))
+
+    async def set(self, key: str, value: dict, ttl: Union[float, timedelta]):
+        await self.set_many({key: value}, ttl)
+
+    async def set_many(self, values: Dict[str, dict], ttl: Union[float, timedelta]):
+        await self.remote.set_many(values, ttl)
+        await self.invalidate(list(values))
+        self.on_set(values, ttl)
+
+    async def delete(self, key: str):
+        await self.delete_many([key])
+
+    async def delete_many(self, keys: List[str]):
+        await self.remote.delete_many(keys)
+        await self.invalidate(keys)
+
+    def pipeline(self, transaction: bool = True) -> "AsyncTieredCachePipeline":
+        """ Runs on redis, reads skip the local tier. """
+        return AsyncTieredCachePipeline(self, self.remote.pipeline(transaction))
+
+    async def has(self, key: str) -> bool:
+        return self.local.has(key) or await self.remote.has(key)
+
+    async def add_event(self, key: str, window: float) -> int:
+        return await self.remote.add_event(key, window)
+
+    async def count_events(self, key: str, window: float) -> int:
+        return await self.remote.count_events(key, window)
+
+    async def ping(self) -> bool:
+        return await self.remote.ping()
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Literal, Optional
 from pydantic import BaseSettings, RedisDsn, BaseModel
 
 
@@ -20,16 +20,46 @@ class RabitMQSettings(BaseModel):
     port: int = 5672
     username: str = "guest"
     password: str = "guest"
+    channel_pool_size: int = 10
+    rpc_timeout: float = 5
+    rpc_max_in_flight: int = 100
+    rpc_batch_window: float = 0.005
+    rpc_max_batch_size: int = 100
+    prefetch_count: int = 10
+    consumer_workers: int = 4
 
 
 class MongoDBSettings(BaseModel):
     uri: str
     database: str = 'users'
+    # pymongo runs on a thread pool, motor is natively async,
+    # memory keeps everything in process for load tests
+    driver: Literal['pymongo', 'motor', 'memory'] = 'pymongo'
+    # Users generated on startup by the memory driver
+    synthetic_users: int = 0
 
 
 class RedisSettings(BaseModel):
     address: RedisDsn
     password: Optional[str]
+    max_connections: int = 50
+    # Seconds to wait for a free connection when all of them are in use
+    pool_timeout: float = 5
+    # Seconds values are kept in process in front of redis, 0 disables the local tier
+    local_cache_ttl: float = 5
+    invalidation_channel: str = 'cache:invalidate'
+
+
+class MemoryCacheSettings(BaseModel):
+    max_entries: int = 10000
+    # JSON size budget of the cached values, 0 only limits the entry count
+    max_bytes: int = 0
+    sweep_interval: float = 60
+
+
+class JwtKeySettings(BaseModel):
+    directory: str
+    active_kid: str
 
 
 class GlobalSettings(BaseSettings):
@@ -41,9 +71,21 @@ class GlobalSettings(BaseSettings):
     redis: RedisSettings
     secret_key: str
     algorithm: str = "HS256"
+    jwt_keys: Optional[JwtKeySettings]
+    jwks_max_age: int = 3600
     access_token_expire_time: int = 30
+    token_cache_size: int = 10000
+    principal_cache_ttl: float = 30
+    memory_cache: MemoryCacheSettings = MemoryCacheSettings()
+    role_registry_ttl: float = 60
+    # Seconds between last login writes, 0 writes them on every login
+    last_login_flush_interval: float = 5
     datetime_format = '%Y-%m-%d %H:%M:%S'
     user_max_failed_attempt: int = 5
+    ip_max_failed_attempt: int = 50
+    failed_attempt_window: int = 900
+    password_hash_workers: Optional[int]
+    password_hash_queue_size: int = 64
 
     class Config:
         env_nested_delimiter = '__'
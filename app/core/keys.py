@@ -0,0 +1,72 @@
+import json
+from os import listdir, path
+from typing import Any, Dict, Union
+
+from jwt.algorithms import get_default_algorithms
+from cryptography.hazmat.primitives.serialization import (
+    load_pem_private_key, load_pem_public_key)
+
+
+class UnknownKeyError(Exception):
+    pass
+
+
+class KeyRing:
+    """
+    Asymmetric JWT keys indexed by kid.
+    Only the active key signs new tokens, every loaded key verifies them.
+    So a rotated key should stay in the ring until its last token expires.
+    """
+
+    def __init__(self, algorithm: str, active_kid: str) -> None:
+        self.algorithm = algorithm
+        self.active_kid = active_kid
+        self.private_keys: Dict[str, Any] = {}
+        self.public_keys: Dict[str, Any] = {}
+
+    @classmethod
+    def from_directory(cls, directory: str, algorithm: str, active_kid: str) -> "KeyRing":
+        """
+        Loads every <kid>.pem file in directory.
+        Retired keys may be stored as public keys only.
+        """
+        key_ring = cls(algorithm, active_kid)
+        for filename in sorted(listdir(directory)):
+            if not filename.endswith('.pem'):
+                continue
+            with open(path.join(directory, filename), 'rb') as f:
+                key_ring.add_key(filename[:-len('.pem')], f.read())
+
+        if active_kid not in key_ring.private_keys:
+            raise UnknownKeyError(
+                f"private key for active kid {active_kid} not found in {directory}")
+        return key_ring
+
+    def add_key(self, kid: str, pem: bytes):
+        try:
+            private_key = load_pem_private_key(pem, password=None)
+        except ValueError:
+            self.public_keys[kid] = load_pem_public_key(pem)
+        else:
+            self.private_keys[kid] = private_key
+            self.public_keys[kid] = private_key.public_key()
+
+    @property
+    def signing_key(self) -> Any:
+        return self.private_keys[self.active_kid]
+
+    def get_verification_key(self, kid: Union[str, None]) -> Any:
+        try:
+            return self.public_keys[kid]  # type: ignore
+        except KeyError:
+            raise UnknownKeyError(f"unknown kid {kid}")
+
+    def jwks(self) -> dict:
+        """ Public keys in JSON Web Key Set format. """
+        algorithm = get_default_algorithms()[self.algorithm]
+        keys = []
+        for kid, public_key in self.public_keys.items():
+            jwk = json.loads(algorithm.to_jwk(public_key))
+            jwk.update({'kid': kid, 'use': 'sig', 'alg': self.algorithm})
+            keys.append(jwk)
+        return {'keys': keys}
@@ -1,12 +1,116 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, List, Union
+
 from passlib.context import CryptContext
+from app.core.config import settings
+from app.core.errors import MyException
 
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 
+class PasswordHasherSaturatedError(MyException):
+    pass
+
+
 def verify_password(plain_password: str, hashed_password: str):
     return pwd_context.verify(plain_password, hashed_password)
 
 
 def get_password_hash(password: str):
     return pwd_context.hash(password)
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a process pool so hashing doesn't block the event loop.
+    At most max_queue_size jobs wait for a free worker, further jobs are rejected.
+    """
+
+    def __init__(self, max_workers: int, max_queue_size: int) -> None:
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.executor: Union[ProcessPoolExecutor, None] = None
+
+        # Only touched from the event loop thread
+        self.pending = 0
+        self.rejected = 0
+        self.completed = 0
+        # Failed jobs are left out of the timings
+        self.failed = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def __get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self.executor
+
+    async def __run(self, func: Callable, *args: Any, reject: bool = True) -> Any:
+        if reject and self.pending >= self.max_workers + self.max_queue_size:
+            self.rejected += 1
+            raise PasswordHasherSaturatedError(
+                "too many password operations in progress")
+
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.__get_executor(), func, *args)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+
+        elapsed = time.perf_counter() - start
+        self.completed += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self.__run(get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self.__run(verify_password, plain_password, hashed_password)
+
+    async def hash_many(self, passwords: List[str]) -> List[str]:
+        """
+        Hashes on every worker, max_workers passwords at a time so queued logins
+        still get a turn between rounds. Never rejected for a full queue.
+        """
+        hashes: List[str] = []
+        for i in range(0, len(passwords), self.max_workers):
+            hashes.extend(await asyncio.gather(*(
+                self.__run(get_password_hash, password, reject=False)
+                for password in passwords[i:i + self.max_workers]
+            )))
+        return hashes
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.max_workers,
+            'in_progress': self.pending,
+            'queue_depth': max(0, self.pending - self.max_workers),
+            'max_queue_size': self.max_queue_size,
+            'rejected': self.rejected,
+            'completed': self.completed,
+            'failed': self.failed,
+            'average_time': self.total_time / self.completed if self.completed else 0.0,
+            'max_time': self.max_time,
+        }
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+password_hasher = PasswordHasher(
+    max_workers=settings.password_hash_workers or os.cpu_count() or 1,
+    max_queue_size=settings.password_hash_queue_size
+)
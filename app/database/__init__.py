@@ -1,3 +1,5 @@
-from .base import Database
-from .memory import MemoryDatabase
+from .base import Database, AsyncDatabase
+from .memory import AsyncMemoryDatabase, MemoryDatabase
 from .mongo import MongoDatabase
+from .motor import MotorDatabase
+from .threaded import ThreadedDatabase
@@ -1,7 +1,7 @@
 from app.models.role import Role
 from app.models.user import RealUser, LegalUser
 from app.models.province import Province
-from typing import List, Union
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
 from app.database import errors
 from app.types.fields import CompanyCodeField, NationalCodeField
 
@@ -24,10 +24,37 @@ class UserCollection:
     def create(self,
                user: Union[RealUser, LegalUser]) -> Union[RealUser, LegalUser]: ...
 
-    def update_last_login(self, user: Union[RealUser, LegalUser]): ...
+    def create_many(self, users: List[Union[RealUser, LegalUser]]) -> Dict[int, str]:
+        """
+        Inserts users in no particular order, one failure doesn't stop the others.
+        Returns error messages by position in users, ids are set on inserted users.
+        """
+        ...
+
+    def update_last_login(self, user: Union[RealUser, LegalUser]):
+        """ May be buffered until flush is called. """
+        ...
+
+    def flush(self) -> None:
+        """ Writes buffered updates. """
+        ...
 
     def get_all(self) -> List[Union[RealUser, LegalUser]]: ...
 
+    def find(self,
+             after: Optional[str] = None,
+             limit: Optional[int] = None,
+             fields: Optional[List[str]] = None,
+             user_type: Optional[str] = None,
+             platform: Optional[str] = None,
+             role: Optional[str] = None) -> Iterator[dict]:
+        """
+        Lazily yields user documents ordered by _id, starting after the given id.
+        fields limits the returned document fields, _id and type are always included.
+        Passwords are never returned.
+        """
+        ...
+
     def get_by_national_code(
         self, national_code: NationalCodeField) -> RealUser: ...
 
@@ -46,6 +73,14 @@ class UserCollection:
 
     def update(self, user: Union[RealUser, LegalUser]): ...
 
+    def upgrade_schema(self, batch_size: int = 1000) -> Tuple[int, Dict[str, str]]:
+        """
+        Validates users stored with an older schema version and stamps the current one,
+        so they're loaded without validation. Returns the number of upgraded users
+        and error messages of the invalid ones by id.
+        """
+        ...
+
 
 class ProvinceDatabase:
     def __init__(self, db): ...
@@ -65,3 +100,101 @@ class Database:
 
     def check_connection(self) -> bool: ...
     def drop(self) -> None: ...
+
+    def ensure_indexes(self) -> None:
+        """ Creates missing indexes, safe to call on every startup. """
+        ...
+
+    def index_state(self) -> List[dict]:
+        """ Declared indexes and whether each one exists. """
+        ...
+
+    def preload(self) -> None:
+        """ Loads in-memory lookup tables such as roles and cities. """
+        ...
+
+    def flush(self) -> None:
+        """ Writes buffered updates such as last logins. """
+        ...
+
+
+class AsyncRoleCollection:
+    """ Same as RoleCollection but awaitable. """
+
+    async def create(self, role: Role) -> Role: ...
+
+    async def get_all(self) -> List[Role]: ...
+
+    async def get_by_platform(self, platform: str) -> Role: ...
+
+    async def delete_by_id(self, role_id: str): ...
+
+
+class AsyncUserCollection:
+    """ Same as UserCollection but awaitable. """
+
+    async def create(self,
+                     user: Union[RealUser, LegalUser]) -> Union[RealUser, LegalUser]: ...
+
+    async def create_many(self, users: List[Union[RealUser, LegalUser]]) -> Dict[int, str]: ...
+
+    async def update_last_login(self, user: Union[RealUser, LegalUser]): ...
+
+    async def flush(self) -> None: ...
+
+    async def get_all(self) -> List[Union[RealUser, LegalUser]]: ...
+
+    def find(self,
+             after: Optional[str] = None,
+             limit: Optional[int] = None,
+             fields: Optional[List[str]] = None,
+             user_type: Optional[str] = None,
+             platform: Optional[str] = None,
+             role: Optional[str] = None) -> AsyncIterator[dict]: ...
+
+    async def get_by_national_code(
+        self, national_code: NationalCodeField) -> RealUser: ...
+
+    async def get_by_company_code(
+        self, company_code: CompanyCodeField) -> LegalUser: ...
+
+    async def get_first(self) -> Union[RealUser, LegalUser]: ...
+
+    async def check_by_national_code(
+        self, national_code: NationalCodeField) -> bool: ...
+
+    async def check_by_company_code(
+        self, company_code: CompanyCodeField) -> bool: ...
+
+    async def get_by_id(self, user_id: str) -> Union[RealUser, LegalUser]: ...
+
+    async def update(self, user: Union[RealUser, LegalUser]): ...
+
+    async def upgrade_schema(self, batch_size: int = 1000) -> Tuple[int, Dict[str, str]]: ...
+
+
+class AsyncProvinceCollection:
+    """ Same as ProvinceDatabase but awaitable. """
+
+    async def create(self, province: Province) -> Province: ...
+
+    async def get_all(self) -> List[Province]: ...
+
+    async def get_by_city_id(self, city_id: str) -> Province: ...
+
+
+class AsyncDatabase:
+    """
+    Database interface used by the services.
+    Blocking Database implementations are wrapped with ThreadedDatabase.
+    """
+    roles: AsyncRoleCollection
+    users: AsyncUserCollection
+    provinces: AsyncProvinceCollection
+
+    async def check_connection(self) -> bool: ...
+    async def drop(self) -> None: ...
+    async def ensure_indexes(self) -> None: ...
+    async def index_state(self) -> List[dict]: ...
+    async def preload(self) -> None: ...
+    async def flush(self) -> None: ...
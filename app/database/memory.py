@@ -1,153 +1,316 @@
+import threading
+from bisect import bisect_right, insort
+from datetime import datetime
 from bson import ObjectId
+from bson.errors import InvalidId
 from app.database.base import Database, ProvinceDatabase, RoleCollection, UserCollection
-from app.models.role import Role
-from app.models.user import RealUser, LegalUser
+from app.database.threaded import ThreadedDatabase
+from app.models.role import Role, UserRole
+from app.models.user import RealUser, LegalUser, USER_SCHEMA_VERSION
+from app.core.security import get_password_hash
 from app.models.province import Province
-from typing import Any, Dict, List, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from app.database import errors
-from app.types.fields import CompanyCodeField, NationalCodeField, ObjectIdField
+from app.types.fields import CompanyCodeField, NationalCodeField, UserType
+from app.utils import path
+from app.utils.utils import run_inline
+
+
+def to_object_id(value) -> Union[ObjectId, None]:
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        return None
 
 
 class MemoryRoleDatabase(RoleCollection):
-    def __init__(self, db):
-        self.db = db
+    """ Roles indexed by id and by the unique platform. """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.roles: Dict[ObjectId, Role] = {}
+        self.platforms: Dict[str, ObjectId] = {}
 
     def create(self, role: Role) -> Role:
+        if role.platform in self.platforms:
+            raise errors.RoleAlreadyExist("role already exist.")
         role.id = ObjectId()  # type: ignore
-        self.db["roles"].append(role)
+        self.roles[role.id] = role
+        self.platforms[role.platform] = role.id
         return role
 
     def get_all(self) -> List[Role]:
-        return self.db["roles"]
+        return list(self.roles.values())
+
+    def check_by_platform(self, platform: str) -> bool:
+        return platform in self.platforms
 
     def get_by_platform(self, platform: str) -> Role:
-        for role in self.db["roles"]:
-            if role.platform == platform:
-                return role
-        raise errors.RoleDoesNotExist(
-            f"role with platform {platform} doesn't exist")
+        role_id = self.platforms.get(platform)
+        if role_id is None:
+            raise errors.RoleDoesNotExist(
+                f"role with platform {platform} doesn't exist")
+        return self.roles[role_id]
 
     def delete_by_id(self, role_id: str):
-        for i in range(len(self.db["roles"])):
-            if self.db["roles"][i].id == role_id:
-                del self.db["roles"][i]
+        role = self.roles.pop(to_object_id(role_id), None)  # type: ignore
+        if role is None:
+            raise errors.RoleDoesNotExist(f"role id {role_id} not found")
+        del self.platforms[role.platform]
 
 
 class MemoryUserDatabase(UserCollection):
-    def __init__(self, db):
-        self.db = db
-
-    def __get_by_national_code(self, national_code: NationalCodeField) -> Union[RealUser, None]:
-        try:
-            return next(filter(lambda user: isinstance(user, RealUser)
-                               and user.national_code == national_code, self.db["users"]))
-        except StopIteration:
-            return None
-
-    def __get_by_company_code(self, company_code: CompanyCodeField) -> Union[LegalUser, None]:
-        try:
-            return next(filter(lambda user: isinstance(user, LegalUser)
-                               and user.company_code == company_code, self.db["users"]))
-        except StopIteration:
-            return None
-
-    def __error_on_already_exists(self, user: Union[RealUser, LegalUser]):
-        if isinstance(user, RealUser) and self.__get_by_national_code(user.national_code):
-            raise errors.UserAlreadyExist(
-                f"user with national code {user.national_code} already exists")
-        elif isinstance(user, LegalUser) and self.__get_by_company_code(user.company_code):
-            raise errors.UserAlreadyExist(
-                f"user with company code {user.company_code} already exists")
+    """
+    Users indexed by id with unique national_code and company_code indexes.
+    ids is kept sorted for keyset pagination, generated ids aren't always increasing
+    since the ObjectId counter wraps.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.users: Dict[ObjectId, Union[RealUser, LegalUser]] = {}
+        self.national_codes: Dict[str, ObjectId] = {}
+        self.company_codes: Dict[str, ObjectId] = {}
+        self.ids: List[ObjectId] = []
+
+    def __unique_key(self, user: Union[RealUser, LegalUser]):
+        if isinstance(user, RealUser):
+            return self.national_codes, user.national_code
+        return self.company_codes, user.company_code
 
     def create(self, user: Union[RealUser, LegalUser]) -> Union[RealUser, LegalUser]:
-        self.__error_on_already_exists(user)
-        user.id = ObjectId()  # type: ignore
-        self.db["users"].append(user)
+        index, key = self.__unique_key(user)
+        with self.lock:
+            if key in index:
+                raise errors.UserAlreadyExist("user already exists")
+            user.id = ObjectId()  # type: ignore
+            index[key] = user.id
+            self.users[user.id] = user
+            insort(self.ids, user.id)
         return user
 
+    def create_many(self, users: List[Union[RealUser, LegalUser]]) -> Dict[int, str]:
+        create_errors = {}
+        for i, user in enumerate(users):
+            try:
+                self.create(user)
+            except errors.UserAlreadyExist as exc:
+                create_errors[i] = str(exc)
+        return create_errors
+
+    def bulk_create(self, users: Iterable[Union[RealUser, LegalUser]]) -> int:
+        """ Inserts users under one lock, duplicates are skipped. Returns the number of inserted users. """
+        inserted = 0
+        with self.lock:
+            for user in users:
+                index, key = self.__unique_key(user)
+                if key in index:
+                    continue
+                user.id = ObjectId()  # type: ignore
+                index[key] = user.id
+                self.users[user.id] = user
+                insort(self.ids, user.id)
+                inserted += 1
+        return inserted
+
     def update_last_login(self, user: Union[RealUser, LegalUser]):
         return
 
+    def flush(self):
+        return
+
     def get_all(self) -> List[Union[RealUser, LegalUser]]:
-        return self.db["users"]
+        return list(self.users.values())
+
+    def find(self,
+             after: Optional[str] = None,
+             limit: Optional[int] = None,
+             fields: Optional[List[str]] = None,
+             user_type: Optional[str] = None,
+             platform: Optional[str] = None,
+             role: Optional[str] = None) -> Iterator[dict]:
+        i = bisect_right(self.ids, ObjectId(after)) if after else 0
+        last = None
+        count = 0
+        while i < len(self.ids):
+            if limit and count >= limit:
+                return
+            user_id = self.ids[i]
+            if last is not None and user_id <= last:
+                # Users were inserted before i since the last step
+                i = bisect_right(self.ids, last)
+                continue
+            last = user_id
+            i += 1
+
+            user = self.users[user_id]
+            if user_type and user.type != user_type:
+                continue
+            if (platform or role) and not any(
+                    (not platform or r.platform == platform) and (not role or role in r.names)
+                    for r in user.roles):
+                continue
+
+            document = user.dict(by_alias=True, exclude_none=True)
+            document.pop('password', None)
+            if fields:
+                document = {k: v for k, v in document.items()
+                            if k in fields or k in ('_id', 'type')}
+            count += 1
+            yield document
 
     def get_by_national_code(self, national_code: NationalCodeField) -> RealUser:
-        user = self.__get_by_national_code(national_code)
-        if not user:
+        user_id = self.national_codes.get(national_code)
+        if user_id is None:
             raise errors.UserDoesNotExist()
-        return user
+        return self.users[user_id]  # type: ignore
 
     def get_by_company_code(self, company_code: CompanyCodeField) -> LegalUser:
-        user = self.__get_by_company_code(company_code)
-        if not user:
+        user_id = self.company_codes.get(company_code)
+        if user_id is None:
             raise errors.UserDoesNotExist()
-        return user
+        return self.users[user_id]  # type: ignore
 
     def get_first(self) -> Union[RealUser, LegalUser]:
-        if len(self.db["users"]) == 0:
+        if not self.ids:
             raise errors.UserDoesNotExist()
-        return self.db["users"][0]
+        return self.users[self.ids[0]]
 
     def check_by_national_code(self, national_code: NationalCodeField) -> bool:
-        try:
-            self.get_by_national_code(national_code)
-            return True
-        except errors.UserDoesNotExist:
-            return False
+        return national_code in self.national_codes
 
     def check_by_company_code(self, company_code: CompanyCodeField) -> bool:
-        try:
-            self.get_by_company_code(company_code)
-            return True
-        except errors.UserDoesNotExist:
-            return False
+        return company_code in self.company_codes
 
     def get_by_id(self, user_id: str) -> Union[RealUser, LegalUser]:
-        for user in self.db["users"]:
-            if user.id == user_id:
-                return user
-        raise errors.UserDoesNotExist()
+        user = self.users.get(to_object_id(user_id))  # type: ignore
+        if user is None:
+            raise errors.UserDoesNotExist()
+        return user
 
     def update(self, user: Union[RealUser, LegalUser]):
-        ...
+        """ Replaces the stored user, national and company codes aren't updatable. """
+        user_id = to_object_id(user.id)
+        with self.lock:
+            if user_id in self.users:
+                self.users[user_id] = user  # type: ignore
+        user.mark_clean()
+
+    def upgrade_schema(self, batch_size: int = 1000) -> Tuple[int, Dict[str, str]]:
+        """ Stored users are validated models already, they're only stamped. """
+        with self.lock:
+            outdated = [u for u in self.users.values() if u.schema_version != USER_SCHEMA_VERSION]
+            for user in outdated:
+                user.schema_version = USER_SCHEMA_VERSION
+        return len(outdated), {}
 
 
 class MemoryProvinceDatabase(ProvinceDatabase):
-    def __init__(self, db: Dict[str, List[Any]]):
-        self.db = db
-        self.provinces: List[Province] = db["provinces"]
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.provinces: List[Province] = []
+        self.cities: Dict[ObjectId, Province] = {}
 
     def create(self, province: Province) -> Province:
         province.id = ObjectId()  # type: ignore
         self.provinces.append(province)
+        for city in province.cities:
+            self.cities[ObjectId(city.id)] = province
         return province
 
     def get_all(self) -> List[Province]:
         return self.provinces
 
     def get_by_city_id(self, city_id: str) -> Province:
-        for province in self.provinces:
-            for city in province.cities:
-                if city.id == city_id:
-                    return province
-        raise errors.CityDoesNotExist(f"city {city_id} doesn't exist")
+        province = self.cities.get(to_object_id(city_id))  # type: ignore
+        if province is None:
+            raise errors.CityDoesNotExist(f"city {city_id} doesn't exist")
+        return province
+
+
+def synthetic_users(count: int,
+                    hashed_password: str,
+                    roles: List[UserRole],
+                    start: int = 0) -> Iterator[RealUser]:
+    """
+    Yields real users with sequential national codes and phone numbers.
+    Models are constructed without validation, all users share the same password hash.
+    """
+    now = datetime.utcnow().replace(microsecond=0)
+    picture_url = path.get_default_profile_picture_url()
+    for i in range(start, start + count):
+        code = f'{i:010}'
+        yield RealUser.construct(
+            id=None,
+            password=hashed_password,
+            phone_number=code,
+            roles=roles,
+            type=UserType.REAL.value,
+            last_login=now,
+            created_at=now,
+            picture_url=picture_url,
+            contact_information=None,
+            schema_version=USER_SCHEMA_VERSION,
+            national_code=code,
+            first_name=f'first_name_{i}',
+            last_name=f'last_name_{i}',
+        )
 
 
 class MemoryDatabase(Database):
-    """ Base Database Interface. """
+    """ In-memory database for tests and load tests. """
 
     def __init__(self) -> None:
-        db: Dict[str, List[Any]] = {
-            "provinces": [],
-            "users": [],
-            "roles": []
-        }
-        self.roles = MemoryRoleDatabase(db)
-        self.users = MemoryUserDatabase(db)
-        self.provinces = MemoryProvinceDatabase(db)
+        self.roles = MemoryRoleDatabase()
+        self.users = MemoryUserDatabase()
+        self.provinces = MemoryProvinceDatabase()
 
     def check_connection(self):
         raise errors.DatabaseConnectionError("database is not initiated.")
 
+    def ensure_indexes(self):
+        return
+
+    def index_state(self) -> List[dict]:
+        return []
+
+    def preload(self):
+        return
+
+    def flush(self):
+        return
+
+    def load_synthetic_users(self,
+                             count: int,
+                             password: str = 'password',
+                             role: UserRole = UserRole(platform='load.test', names=['user'])) -> int:
+        """ Creates the role if needed and inserts count synthetic users, see synthetic_users. """
+        if not self.roles.check_by_platform(role.platform):
+            self.roles.create(Role(platform=role.platform, names=role.names))  # type: ignore
+        return self.users.bulk_create(synthetic_users(
+            count, get_password_hash(password), [role], start=len(self.users.ids)))
+
     def drop(self):
-        self.db = {}
+        self.roles.clear()
+        self.users.clear()
+        self.provinces.clear()
+
+
+class AsyncMemoryDatabase(ThreadedDatabase):
+    """
+    MemoryDatabase through the async interface.
+    Calls run inline, a thread hop would cost more than the lookups themselves
+    and skew load test numbers.
+    """
+
+    database: MemoryDatabase
+
+    def __init__(self, database: Union[MemoryDatabase, None] = None) -> None:
+        super().__init__(database or MemoryDatabase(), run=run_inline)
@@ -1,29 +1,447 @@
-from app.models.role import Role
-from app.models.user import RealUser, LegalUser
-from app.models.province import Province
-from typing import List, Union
-from pymongo import database
+from app.models.role import Role, UserRole
+from app.models.user import RealUser, LegalUser, USER_SCHEMA_VERSION
+from app.models.province import City, Province
+import threading
+import time
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from pymongo import ASCENDING, IndexModel, UpdateOne, database
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
 from app.database import errors
 from bson import ObjectId
 from app.types.fields import CompanyCodeField, NationalCodeField, UserType
 from datetime import datetime
 from pymongo import MongoClient
+from pydantic import ValidationError
 from app.database.base import (
     Database, UserCollection, ProvinceDatabase, RoleCollection
 )
+from app.core.logging import logger
+
+
+def ensure_indexes(collection, indexes: List[IndexModel]):
+    """ create_indexes is a no-op for indexes that already exist. """
+    try:
+        collection.create_indexes(indexes)
+    except OperationFailure as exc:
+        raise errors.DatabaseInitError(
+            f"can't create indexes on {collection.name}: {exc}")
+
+
+def describe_indexes(collection_name: str, indexes: List[IndexModel], existing: dict) -> List[dict]:
+    """ Compares declared indexes with the existing ones from index_information. """
+    state = []
+    for index in indexes:
+        name = index.document['name']
+        state.append({
+            'collection': collection_name,
+            'name': name,
+            'keys': dict(index.document['key']),
+            'unique': index.document.get('unique', False),
+            'exists': name in existing,
+        })
+    return state
+
+
+def index_state(collection, indexes: List[IndexModel]) -> List[dict]:
+    return describe_indexes(collection.name, indexes, collection.index_information())
+
+
+# Fields needed to build user models, never fetch anything else
+USER_FIELDS = {
+    '_id': 1,
+    'password': 1,
+    'roles': 1,
+    'type': 1,
+    'national_code': 1,
+    'company_code': 1,
+    'phone_number': 1,
+    'last_login': 1,
+    'created_at': 1,
+    'picture_url': 1,
+    'contact_information': 1,
+    'schema_version': 1,
+    # For real user
+    'first_name': 1,
+    'last_name': 1,
+    'father_name': 1,
+    'gender': 1,
+    'birth_day': 1,
+    # For legal user
+    'company_name': 1,
+    'domain': 1,
+    'title': 1
+}
+
+
+def document_to_user(document: dict) -> Union[RealUser, LegalUser]:
+    user: Union[RealUser, LegalUser]
+    if document.get("type") == UserType.REAL:
+        user = RealUser.from_document(document)
+    elif document.get("type") == UserType.LEGAL:
+        user = LegalUser.from_document(document)
+    else:
+        raise errors.InvalidDatabaseSchema(
+            f"user {document['_id']} doesn't have a type field")
+    user.mark_clean()
+    return user
+
+
+# Users written before the current schema version
+OUTDATED_USERS = {'schema_version': {'$ne': USER_SCHEMA_VERSION}}
+
+
+def validate_outdated(documents: List[dict]) -> Tuple[List[ObjectId], Dict[str, str]]:
+    """ Ids of the documents the current models accept and error messages of the others. """
+    valid, invalid = [], {}
+    for document in documents:
+        try:
+            document_to_user(document)
+        except (ValidationError, errors.InvalidDatabaseSchema) as exc:
+            invalid[str(document['_id'])] = str(exc)
+        else:
+            valid.append(document['_id'])
+    return valid, invalid
+
+
+def principal_to_user(document: dict) -> Union[RealUser, LegalUser]:
+    """
+    Builds a user from a PrincipalCache document, which has no password hash.
+    The password is left empty, so these users can't be used to check credentials.
+    """
+    return document_to_user({**document, 'password': ''})
+
+
+def user_query(after: Optional[str] = None,
+               fields: Optional[List[str]] = None,
+               user_type: Optional[str] = None,
+               platform: Optional[str] = None,
+               role: Optional[str] = None) -> Tuple[dict, dict]:
+    """ Filters and projection for UserCollection.find. """
+    filters: dict = {}
+    if after:
+        filters['_id'] = {'$gt': ObjectId(after)}
+    if user_type:
+        filters['type'] = user_type
+    if platform and role:
+        filters['roles'] = {'$elemMatch': {'platform': platform, 'names': role}}
+    elif platform:
+        filters['roles.platform'] = platform
+    elif role:
+        filters['roles.names'] = role
+
+    if fields:
+        projection = {field: 1 for field in fields}
+        projection.update({'_id': 1, 'type': 1})
+    else:
+        projection = dict(USER_FIELDS)
+    projection.pop('password', None)
+    return filters, projection
+
+
+def user_changes(user: Union[RealUser, LegalUser]) -> Tuple[dict, bool]:
+    """
+    $set document for UserCollection.update and whether the city has to be validated.
+    Users that weren't loaded from the database are written completely.
+    """
+    changes = user.get_changes()
+    if changes is not None:
+        city_changed = 'contact_information.city_id' in changes or \
+            bool(changes.get('contact_information', {}).get('city_id'))
+        return changes, city_changed
+
+    changes = user.dict(exclude_none=True)
+    changes.pop('id')
+    if changes.get("contact_information"):
+        for field, value in changes["contact_information"].items():
+            changes[f"contact_information.{field}"] = value
+        changes.pop("contact_information")
+    city_changed = bool(
+        user.contact_information and user.contact_information.city_id)
+    return changes, city_changed
+
+
+def insert_many_errors(exc: BulkWriteError, positions: List[int]) -> Dict[int, str]:
+    """ Maps write errors of an unordered insert_many back to positions in the original list. """
+    insert_errors = {}
+    for error in exc.details['writeErrors']:
+        if error['code'] == 11000:
+            message = "user already exists"
+        else:
+            message = error['errmsg']
+        insert_errors[positions[error['index']]] = message
+    return insert_errors
+
+
+def invalid_roles_error(roles: List[UserRole], platforms: Dict[str, Set[str]]) -> Union[Exception, None]:
+    """ Checks roles against the known role names of each platform. """
+    for user_role in roles:
+        names = platforms.get(user_role.platform)
+        if names is None:
+            return errors.RoleDoesNotExist(
+                f"platform {user_role.platform} does not exists")
+
+        for name in user_role.names:
+            if name not in names:
+                return errors.RoleDoesNotExist(
+                    f"role {name} in platform {user_role.platform} does not exist")
+    return None
+
+
+def user_platforms(users: List[Union[RealUser, LegalUser]]) -> Set[str]:
+    return {user_role.platform for user in users for user_role in user.roles}
+
+
+def user_documents(users: List[Union[RealUser, LegalUser]],
+                   platforms: Dict[str, Set[str]]) -> Tuple[List[dict], List[int], Dict[int, str]]:
+    """
+    Documents to insert for UserCollection.create_many, their positions in users
+    and the error messages of users with unknown roles.
+    """
+    documents, positions, create_errors = [], [], {}
+    for i, user in enumerate(users):
+        error = invalid_roles_error(user.roles, platforms)
+        if error:
+            create_errors[i] = str(error)
+            continue
+        documents.append(user.dict(exclude_none=True))
+        positions.append(i)
+    return documents, positions, create_errors
+
+
+def set_inserted_ids(users: List[Union[RealUser, LegalUser]],
+                     documents: List[dict],
+                     positions: List[int],
+                     create_errors: Dict[int, str]):
+    """ insert_many sets _id on every document, even the ones that failed. """
+    for i, document in zip(positions, documents):
+        if i not in create_errors:
+            users[i].id = document['_id']
+
+
+def province_document(province: Province) -> dict:
+    document = province.dict(exclude_none=True)
+    document['cities'] = [
+        {"_id": city["id"], "name": city["name"]} for city in document['cities']
+    ]
+    return document
+
+
+def city_province(entry: Union[Tuple[Province, City], None], city_id: str) -> Province:
+    """ Province with only the city of a CityIndex entry. """
+    if not entry:
+        raise errors.CityDoesNotExist(
+            f"city with id {city_id} don't exist")
+
+    province, city = entry
+    return Province(
+        _id=province.id,
+        name=province.name,
+        cities=[city.copy()]
+    )
+
+
+class LastLoginBuffer:
+    """
+    Coalesces last login timestamps in memory, flush writes them with one unordered bulk_write.
+    Timestamps are applied with $max so a late flush never moves last_login backwards.
+    """
+
+    def __init__(self) -> None:
+        self.pending: Dict[ObjectId, datetime] = {}
+        self.lock = threading.Lock()
+
+    def add(self, user_id: ObjectId, last_login: datetime):
+        with self.lock:
+            self.pending[user_id] = last_login
+
+    def take(self) -> Dict[ObjectId, datetime]:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def restore(self, pending: Dict[ObjectId, datetime]):
+        """ Puts back timestamps of a failed flush. """
+        with self.lock:
+            # Keep newer timestamps added during the flush
+            pending.update(self.pending)
+            self.pending = pending
+
+    @staticmethod
+    def requests(pending: Dict[ObjectId, datetime]) -> List[UpdateOne]:
+        return [
+            UpdateOne({'_id': user_id}, {'$max': {'last_login': last_login}})
+            for user_id, last_login in pending.items()
+        ]
+
+    def flush(self, collection) -> int:
+        """ Returns the number of written users. """
+        pending = self.take()
+        if not pending:
+            return 0
+
+        try:
+            collection.bulk_write(self.requests(pending), ordered=False)
+        except PyMongoError:
+            logger.exception(f"Failed to flush {len(pending)} last logins")
+            self.restore(pending)
+            return 0
+        return len(pending)
+
+    async def flush_async(self, collection) -> int:
+        """ Same as flush for a motor collection. """
+        pending = self.take()
+        if not pending:
+            return 0
+
+        try:
+            await collection.bulk_write(self.requests(pending), ordered=False)
+        except PyMongoError:
+            logger.exception(f"Failed to flush {len(pending)} last logins")
+            self.restore(pending)
+            return 0
+        return len(pending)
+
+
+class BaseRoleRegistry:
+    """
+    In-memory map of platform to role names.
+    Everything is reloaded once the ttl passes or after invalidate,
+    platforms that are still missing are fetched with a single $in query.
+    Loading is left to RoleRegistry and AsyncRoleRegistry.
+    """
+    projection = {'platform': 1, 'names': 1}
+
+    def __init__(self, collection, ttl: float = 60) -> None:
+        self.collection = collection
+        self.ttl = ttl
+        self.roles: Dict[str, Set[str]] = {}
+        self.loaded_at: Union[float, None] = None
+
+    def expired(self) -> bool:
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def add(self, documents: Iterable[dict]):
+        for document in documents:
+            self.roles[document['platform']] = set(document['names'])
+
+    def replace(self, documents: Iterable[dict]):
+        roles = {d['platform']: set(d['names']) for d in documents}
+        self.roles = roles
+        self.loaded_at = time.monotonic()
+
+    def missing_filter(self, platforms: Set[str]) -> Union[dict, None]:
+        """ Filter of the platforms that aren't loaded yet. """
+        missing = [p for p in platforms if p not in self.roles]
+        return {'platform': {'$in': missing}} if missing else None
+
+    def select(self, platforms: Set[str]) -> Dict[str, Set[str]]:
+        return {p: self.roles[p] for p in platforms if p in self.roles}
+
+
+class RoleRegistry(BaseRoleRegistry):
+    """ BaseRoleRegistry loaded through pymongo. """
+
+    def __init__(self, collection, ttl: float = 60) -> None:
+        super().__init__(collection, ttl)
+        # Sync routes call the database from the thread pool
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def __find(self, filters: dict) -> List[dict]:
+        return list(self.collection.find(filters, self.projection))
+
+    def load(self):
+        with self.lock:
+            self.replace(self.__find({}))
+
+    def get(self, platforms: Iterable[str]) -> Dict[str, Set[str]]:
+        platforms = set(platforms)
+        with self.lock:
+            if self.expired():
+                self.replace(self.__find({}))
+
+            filters = self.missing_filter(platforms)
+            if filters:
+                self.add(self.__find(filters))
+
+            return self.select(platforms)
+
+
+class BaseCityIndex:
+    """
+    In-memory map of city id to its province and city.
+    Rebuilt on first use after invalidate. Unknown ids fall back to one
+    indexed query, so provinces created by other workers are picked up.
+    Loading is left to CityIndex and AsyncCityIndex.
+    """
+
+    def __init__(self, collection) -> None:
+        self.collection = collection
+        self.cities: Dict[ObjectId, Tuple[Province, City]] = {}
+        self.loaded = False
+
+    def replace(self, documents: Iterable[dict]):
+        cities = {}
+        for document in documents:
+            province = Province(**document)
+            for city in province.cities:
+                cities[city.id] = (province, city)
+        self.cities = cities
+        self.loaded = True
+
+    @staticmethod
+    def filter(city_id: ObjectId) -> dict:
+        return {'cities._id': city_id}
+
+
+class CityIndex(BaseCityIndex):
+    """ BaseCityIndex loaded through pymongo. """
+
+    def __init__(self, collection) -> None:
+        super().__init__(collection)
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded = False
+
+    def load(self):
+        with self.lock:
+            self.replace(self.collection.find())
+
+    def get(self, city_id: str) -> Union[Tuple[Province, City], None]:
+        city_id = ObjectId(city_id)
+        with self.lock:
+            if not self.loaded:
+                self.replace(self.collection.find())
+            if city_id not in self.cities and self.collection.find_one(self.filter(city_id), {'_id': 1}):
+                self.replace(self.collection.find())
+            return self.cities.get(city_id)
 
 
 class MongoRoleCollection(RoleCollection):
-    def __init__(self, db: database.Database):
+    indexes = [
+        IndexModel([('platform', ASCENDING)], name='platform', unique=True),
+    ]
+
+    def __init__(self, db: database.Database, registry: Union[RoleRegistry, None] = None):
         self.db = db
         self.collection = self.db.roles
+        self.registry = registry
 
     def create(self, role: Role) -> Role:
-        if self.__check_if_exists(role.platform):
+        # Relies on the unique platform index
+        try:
+            result = self.collection.insert_one(role.dict())
+        except DuplicateKeyError:
             raise errors.RoleAlreadyExist("role already exist.")
-
-        result = self.collection.insert_one(role.dict())
         role.id = result.inserted_id
+        if self.registry:
+            self.registry.invalidate()
         return role
 
     def get_all(self) -> List[Role]:
@@ -36,46 +454,39 @@ class MongoRoleCollection(RoleCollection):
         raise errors.RoleDoesNotExist(
             f"role with platform {platform} don't exist.")
 
-    def __check_if_exists(self, platform: str) -> bool:
-        result = self.collection.find_one({"platform": platform})
-        if result:
-            return True
-        return False
-
     def delete_by_id(self, role_id: str):
         result = self.collection.delete_one({"_id": ObjectId(role_id)})
         if result.deleted_count == 1:
+            if self.registry:
+                self.registry.invalidate()
             return
         raise errors.RoleDoesNotExist(f"role id {role_id} not found")
 
 
 class MongoUserCollection(UserCollection):
-    def __init__(self, db: database.Database):
+    indexes = [
+        # national_code and company_code only exist on real and legal users
+        IndexModel(
+            [('national_code', ASCENDING)], name='national_code', unique=True,
+            partialFilterExpression={'national_code': {'$type': 'string'}}),
+        IndexModel(
+            [('company_code', ASCENDING)], name='company_code', unique=True,
+            partialFilterExpression={'company_code': {'$type': 'string'}}),
+        IndexModel(
+            [('roles.platform', ASCENDING), ('roles.names', ASCENDING)], name='roles'),
+    ]
+
+    def __init__(self,
+                 db: database.Database,
+                 roles: Union[RoleRegistry, None] = None,
+                 cities: Union[CityIndex, None] = None,
+                 last_logins: Union[LastLoginBuffer, None] = None):
         self.db = db
         self.collection = self.db.users
-        self.required_fields = {
-            '_id': 1,
-            'password': 1,
-            'roles': 1,
-            'type': 1,
-            'national_code': 1,
-            'company_code': 1,
-            'phone_number': 1,
-            'last_login': 1,
-            'created_at': 1,
-            'picture_url': 1,
-            'contact_information': 1,
-            # For real user
-            'first_name': 1,
-            'last_name': 1,
-            'father_name': 1,
-            'gender': 1,
-            'birth_day': 1,
-            # For legal user
-            'company_name': 1,
-            'domain': 1,
-            'title': 1
-        }
+        self.last_logins = last_logins
+        self.roles = roles or RoleRegistry(self.db.roles)
+        self.cities = cities or CityIndex(self.db.provinces)
+        self.required_fields = USER_FIELDS
 
     def __find_one(self, filters):
         """ Only fetchs required fields. """
@@ -84,75 +495,86 @@ class MongoUserCollection(UserCollection):
     def __find(self, filters):
         return self.collection.find(filters, self.required_fields)
 
-    def __error_on_duplicate_key(self, user: Union[RealUser, LegalUser]):
-        if isinstance(user, RealUser):
-            document = self.__find_one({'national_code': user.national_code})
-        elif isinstance(user, LegalUser):
-            document = self.__find_one({'company_code': user.company_code})
-        if document:
-            raise errors.UserAlreadyExist("user already exists")
-
     def __error_on_invalid_roles(self, roles):
-        # TODO: Use efficent query
-        for user_role in roles:
-            role = self.db.roles.find_one({"platform": user_role.platform})
-            if not role:
-                raise errors.RoleDoesNotExist(
-                    f"platform {user_role.platform} does not exists")
-
-            for name in user_role.names:
-                if name not in role["names"]:
-                    raise errors.RoleDoesNotExist(
-                        f"role {name} in platform {user_role.platform} does not exist")
+        platforms = self.roles.get(user_role.platform for user_role in roles)
+        error = invalid_roles_error(roles, platforms)
+        if error:
+            raise error
 
     def __error_on_invalid_city(self, city_id):
-        query = self.db.roles.find_one(
-            {'cities._id': ObjectId(city_id)},
-            {'name': 1, 'cities.$': 1}
-        )
-        if not query:
+        if not self.cities.get(city_id):
             raise errors.CityDoesNotExist(
                 f"city with id {city_id} don't exist")
 
     def create(self, user: Union[RealUser, LegalUser]) -> Union[RealUser, LegalUser]:
         self.__error_on_invalid_roles(user.roles)
-        self.__error_on_duplicate_key(user)
         if user.contact_information and user.contact_information.city_id:
             self.__error_on_invalid_city(user.contact_information.city_id)
 
+        # Duplicates are rejected by the unique national_code/company_code indexes
         document = user.dict(exclude_none=True)
-        result = self.collection.insert_one(document)
+        try:
+            result = self.collection.insert_one(document)
+        except DuplicateKeyError:
+            raise errors.UserAlreadyExist("user already exists")
         user.id = result.inserted_id
         return user
 
+    def create_many(self, users: List[Union[RealUser, LegalUser]]) -> Dict[int, str]:
+        documents, positions, create_errors = user_documents(
+            users, self.roles.get(user_platforms(users)))
+        if documents:
+            try:
+                self.collection.insert_many(documents, ordered=False)
+            except BulkWriteError as exc:
+                create_errors.update(insert_many_errors(exc, positions))
+
+        set_inserted_ids(users, documents, positions, create_errors)
+        return create_errors
+
     def update_last_login(self, user: Union[RealUser, LegalUser]):
+        if self.last_logins:
+            self.last_logins.add(ObjectId(user.id), datetime.utcnow())
+            return
         self.collection.update_one(
             {'_id': ObjectId(user.id)},
             {'$set': {'last_login': datetime.utcnow()}}
         )
 
+    def flush(self):
+        if self.last_logins:
+            self.last_logins.flush(self.collection)
+
     def map_to_model(self, document) -> Union[RealUser, LegalUser]:
-        if document.get("type") == UserType.REAL:
-            return RealUser(**document)
-        elif document.get("type") == UserType.LEGAL:
-            return LegalUser(**document)
-        raise errors.InvalidDatabaseSchema(
-            f"user {document['_id']} doesn't have a type field")
+        return document_to_user(document)
 
     def get_all(self) -> List[Union[RealUser, LegalUser]]:
         return list(map(lambda d: self.map_to_model(d), self.__find({})))
 
+    def find(self,
+             after: Optional[str] = None,
+             limit: Optional[int] = None,
+             fields: Optional[List[str]] = None,
+             user_type: Optional[str] = None,
+             platform: Optional[str] = None,
+             role: Optional[str] = None) -> Iterator[dict]:
+        filters, projection = user_query(after, fields, user_type, platform, role)
+        cursor = self.collection.find(filters, projection).sort('_id', ASCENDING)
+        if limit:
+            cursor = cursor.limit(limit)
+        return iter(cursor)
+
     def get_by_national_code(self, national_code: NationalCodeField) -> RealUser:
         document = self.__find_one({"national_code": national_code})
         if not document:
             raise errors.UserDoesNotExist("user does not exist")
-        return RealUser(**document)
+        return self.map_to_model(document)  # type: ignore
 
     def get_by_company_code(self, company_code: CompanyCodeField) -> LegalUser:
         document = self.__find_one({"company_code": company_code})
         if not document:
             raise errors.UserDoesNotExist("user does not exist")
-        return LegalUser(**document)
+        return self.map_to_model(document)  # type: ignore
 
     def get_first(self) -> Union[RealUser, LegalUser]:
         document = self.__find_one({})
@@ -177,45 +599,52 @@ class MongoUserCollection(UserCollection):
     def get_by_id(self, user_id: str) -> Union[RealUser, LegalUser]:
         document = self.__find_one({"_id": ObjectId(user_id)})
         if not document:
-            raise errors.UserAlreadyExist("user does not exist")
+            raise errors.UserDoesNotExist("user does not exist")
         return self.map_to_model(document)
 
     def update(self, user: Union[RealUser, LegalUser]):
-        # TODO: Only update fields that are changed
-        if user.contact_information:
-            self.__error_on_invalid_city(
-                user.contact_information.city_id)
-
-        query = user.dict(exclude_none=True)
-        query.pop('id')
-
-        if query.get("contact_information"):
-            for field, value in query["contact_information"].items():
-                query[f"contact_information.{field}"] = value
-            query.pop("contact_information")
+        """ Writes only the fields changed since the user was loaded. """
+        changes, city_changed = user_changes(user)
+        if not changes:
+            return
+        if city_changed:
+            self.__error_on_invalid_city(user.contact_information.city_id)  # type: ignore
 
         self.collection.update_one(
             {'_id': ObjectId(user.id)},
-            {"$set": query}
+            {"$set": changes}
         )
+        user.mark_clean()
+
+    def upgrade_schema(self, batch_size: int = 1000) -> Tuple[int, Dict[str, str]]:
+        cursor = self.collection.find(OUTDATED_USERS, USER_FIELDS).sort('_id', ASCENDING)
+        upgraded, upgrade_errors = 0, {}
+        while True:
+            batch = list(islice(cursor, batch_size))
+            if not batch:
+                return upgraded, upgrade_errors
+            valid, invalid = validate_outdated(batch)
+            upgrade_errors.update(invalid)
+            if valid:
+                self.collection.update_many(
+                    {'_id': {'$in': valid}}, {'$set': {'schema_version': USER_SCHEMA_VERSION}})
+                upgraded += len(valid)
 
 
 class MongoProvinceCollection(ProvinceDatabase):
-    def __init__(self, db: database.Database):
+    indexes = [
+        IndexModel([('cities._id', ASCENDING)], name='cities_id'),
+    ]
+
+    def __init__(self, db: database.Database, cities: Union[CityIndex, None] = None):
         self.db = db
         self.collection = self.db.provinces
+        self.cities = cities or CityIndex(self.collection)
 
     def create(self, province: Province) -> Province:
-        document = province.dict(exclude_none=True)
-        # TODO: remove this
-        for i in range(len(document['cities'])):
-            document['cities'][i] = {
-                "_id": document['cities'][i]["id"],
-                "name": document['cities'][i]["name"]
-            }
-
-        result = self.collection.insert_one(document)
+        result = self.collection.insert_one(province_document(province))
         province.id = result.inserted_id
+        self.cities.invalidate()
         return province
 
     def get_all(self) -> List[Province]:
@@ -223,25 +652,45 @@ class MongoProvinceCollection(ProvinceDatabase):
 
     def get_by_city_id(self, city_id: str) -> Province:
         """ only return one city with it's province """
-
-        query = self.collection.find_one(
-            {'cities._id': ObjectId(city_id)},
-            {'name': 1, 'cities.$': 1}
-        )
-        if not query:
-            raise errors.CityDoesNotExist(
-                f"city with id {city_id} don't exist")
-        return Province(**query)
+        return city_province(self.cities.get(city_id), city_id)
 
 
 class MongoDatabase(Database):
-    def __init__(self, uri: str, database: str):
+    def __init__(self,
+                 uri: str,
+                 database: str,
+                 role_registry_ttl: float = 60,
+                 buffer_last_logins: bool = False):
         self.database_name = database
         self.client = MongoClient(uri)
         self.db = self.client.get_database(self.database_name)
-        self.roles = MongoRoleCollection(self.db)
-        self.users = MongoUserCollection(self.db)
-        self.provinces = MongoProvinceCollection(self.db)
+        self.role_registry = RoleRegistry(self.db.roles, role_registry_ttl)
+        self.city_index = CityIndex(self.db.provinces)
+        self.roles = MongoRoleCollection(self.db, self.role_registry)
+        self.users = MongoUserCollection(
+            self.db, self.role_registry, self.city_index,
+            LastLoginBuffer() if buffer_last_logins else None)
+        self.provinces = MongoProvinceCollection(self.db, self.city_index)
+
+    def __collections(self):
+        return [self.roles, self.users, self.provinces]
+
+    def ensure_indexes(self):
+        for c in self.__collections():
+            ensure_indexes(c.collection, c.indexes)
+
+    def index_state(self) -> List[dict]:
+        state = []
+        for c in self.__collections():
+            state.extend(index_state(c.collection, c.indexes))
+        return state
+
+    def preload(self):
+        self.role_registry.load()
+        self.city_index.load()
+
+    def flush(self):
+        self.users.flush()
 
     def check_connection(self):
         return self.db.command('ping')
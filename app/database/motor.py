@@ -0,0 +1,361 @@
+import asyncio
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from app.cache import PrincipalCache
+from app.database import errors
+from app.database.base import (
+    AsyncDatabase, AsyncProvinceCollection, AsyncRoleCollection, AsyncUserCollection)
+from app.database.mongo import (
+    OUTDATED_USERS, USER_FIELDS, BaseCityIndex, BaseRoleRegistry, LastLoginBuffer, MongoProvinceCollection,
+    MongoRoleCollection, MongoUserCollection, city_province, describe_indexes, document_to_user,
+    insert_many_errors, invalid_roles_error, principal_to_user, province_document,
+    set_inserted_ids, user_changes, user_documents, user_platforms, user_query,
+    validate_outdated)
+from app.models.province import City, Province
+from app.models.role import Role, UserRole
+from app.models.user import USER_SCHEMA_VERSION, LegalUser, RealUser
+from app.types.fields import CompanyCodeField, NationalCodeField
+
+
+async def ensure_indexes(collection, indexes):
+    try:
+        await collection.create_indexes(indexes)
+    except OperationFailure as exc:
+        raise errors.DatabaseInitError(
+            f"can't create indexes on {collection.name}: {exc}")
+
+
+class AsyncRoleRegistry(BaseRoleRegistry):
+    """ BaseRoleRegistry loaded through motor. """
+
+    def __init__(self, collection, ttl: float = 60) -> None:
+        super().__init__(collection, ttl)
+        # Created on first use so it binds to the running loop
+        self.lock: Union[asyncio.Lock, None] = None
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    async def __find(self, filters: dict) -> List[dict]:
+        return [d async for d in self.collection.find(filters, self.projection)]
+
+    async def load(self):
+        self.replace(await self.__find({}))
+
+    async def get(self, platforms: Iterable[str]) -> Dict[str, Set[str]]:
+        platforms = set(platforms)
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        # Concurrent requests share one reload
+        async with self.lock:
+            if self.expired():
+                self.replace(await self.__find({}))
+
+            filters = self.missing_filter(platforms)
+            if filters:
+                self.add(await self.__find(filters))
+
+            return self.select(platforms)
+
+
+class AsyncCityIndex(BaseCityIndex):
+    """ BaseCityIndex loaded through motor. """
+
+    def __init__(self, collection) -> None:
+        super().__init__(collection)
+        self.lock: Union[asyncio.Lock, None] = None
+
+    def invalidate(self):
+        self.loaded = False
+
+    async def __rebuild(self):
+        self.replace([d async for d in self.collection.find()])
+
+    async def load(self):
+        await self.__rebuild()
+
+    async def get(self, city_id: str) -> Union[Tuple[Province, City], None]:
+        city_id = ObjectId(city_id)
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if not self.loaded:
+                await self.__rebuild()
+            if city_id not in self.cities and \
+                    await self.collection.find_one(self.filter(city_id), {'_id': 1}):
+                await self.__rebuild()
+            return self.cities.get(city_id)
+
+
+class MotorRoleCollection(AsyncRoleCollection):
+    indexes = MongoRoleCollection.indexes
+
+    def __init__(self, db: AsyncIOMotorDatabase, registry: Union[AsyncRoleRegistry, None] = None):
+        self.db = db
+        self.collection = self.db.roles
+        self.registry = registry
+
+    async def create(self, role: Role) -> Role:
+        try:
+            result = await self.collection.insert_one(role.dict())
+        except DuplicateKeyError:
+            raise errors.RoleAlreadyExist("role already exist.")
+        role.id = result.inserted_id
+        if self.registry:
+            self.registry.invalidate()
+        return role
+
+    async def get_all(self) -> List[Role]:
+        return [Role(**d) async for d in self.collection.find()]
+
+    async def get_by_platform(self, platform: str) -> Role:
+        result = await self.collection.find_one({"platform": platform})
+        if result:
+            return Role(**result)
+        raise errors.RoleDoesNotExist(
+            f"role with platform {platform} don't exist.")
+
+    async def delete_by_id(self, role_id: str):
+        result = await self.collection.delete_one({"_id": ObjectId(role_id)})
+        if result.deleted_count == 1:
+            if self.registry:
+                self.registry.invalidate()
+            return
+        raise errors.RoleDoesNotExist(f"role id {role_id} not found")
+
+
+class MotorUserCollection(AsyncUserCollection):
+    indexes = MongoUserCollection.indexes
+
+    def __init__(self,
+                 db: AsyncIOMotorDatabase,
+                 principals: Union[PrincipalCache, None] = None,
+                 roles: Union[AsyncRoleRegistry, None] = None,
+                 cities: Union[AsyncCityIndex, None] = None,
+                 last_logins: Union[LastLoginBuffer, None] = None):
+        self.db = db
+        self.collection = self.db.users
+        self.principals = principals
+        self.last_logins = last_logins
+        self.roles = roles or AsyncRoleRegistry(self.db.roles)
+        self.cities = cities or AsyncCityIndex(self.db.provinces)
+
+    async def __find_one(self, filters):
+        """ Only fetchs required fields. """
+        return await self.collection.find_one(filters, USER_FIELDS)
+
+    async def __error_on_invalid_roles(self, roles: List[UserRole]):
+        platforms = await self.roles.get(user_role.platform for user_role in roles)
+        error = invalid_roles_error(roles, platforms)
+        if error:
+            raise error
+
+    async def __error_on_invalid_city(self, city_id):
+        if not await self.cities.get(city_id):
+            raise errors.CityDoesNotExist(
+                f"city with id {city_id} don't exist")
+
+    async def __invalidate(self, user: Union[RealUser, LegalUser]):
+        if self.principals and user.id:
+            await self.principals.invalidate(str(user.id))
+
+    async def create(self, user: Union[RealUser, LegalUser]) -> Union[RealUser, LegalUser]:
+        await self.__error_on_invalid_roles(user.roles)
+        if user.contact_information and user.contact_information.city_id:
+            await self.__error_on_invalid_city(user.contact_information.city_id)
+
+        try:
+            result = await self.collection.insert_one(user.dict(exclude_none=True))
+        except DuplicateKeyError:
+            raise errors.UserAlreadyExist("user already exists")
+        user.id = result.inserted_id
+        await self.__invalidate(user)
+        return user
+
+    async def create_many(self, users: List[Union[RealUser, LegalUser]]) -> Dict[int, str]:
+        documents, positions, create_errors = user_documents(
+            users, await self.roles.get(user_platforms(users)))
+        if documents:
+            try:
+                await self.collection.insert_many(documents, ordered=False)
+            except BulkWriteError as exc:
+                create_errors.update(insert_many_errors(exc, positions))
+
+        set_inserted_ids(users, documents, positions, create_errors)
+        return create_errors
+
+    async def update_last_login(self, user: Union[RealUser, LegalUser]):
+        if self.last_logins:
+            self.last_logins.add(ObjectId(user.id), datetime.utcnow())
+            return
+        await self.collection.update_one(
+            {'_id': ObjectId(user.id)},
+            {'$set': {'last_login': datetime.utcnow()}}
+        )
+
+    async def flush(self):
+        if self.last_logins:
+            await self.last_logins.flush_async(self.collection)
+
+    async def get_all(self) -> List[Union[RealUser, LegalUser]]:
+        return [document_to_user(d) async for d in self.collection.find({}, USER_FIELDS)]
+
+    async def find(self,
+                   after: Optional[str] = None,
+                   limit: Optional[int] = None,
+                   fields: Optional[List[str]] = None,
+                   user_type: Optional[str] = None,
+                   platform: Optional[str] = None,
+                   role: Optional[str] = None) -> AsyncIterator[dict]:
+        filters, projection = user_query(after, fields, user_type, platform, role)
+        cursor = self.collection.find(filters, projection).sort('_id', ASCENDING)
+        if limit:
+            cursor = cursor.limit(limit)
+        async for document in cursor:
+            yield document
+
+    async def get_by_national_code(self, national_code: NationalCodeField) -> RealUser:
+        document = await self.__find_one({"national_code": national_code})
+        if not document:
+            raise errors.UserDoesNotExist("user does not exist")
+        return document_to_user(document)  # type: ignore
+
+    async def get_by_company_code(self, company_code: CompanyCodeField) -> LegalUser:
+        document = await self.__find_one({"company_code": company_code})
+        if not document:
+            raise errors.UserDoesNotExist("user does not exist")
+        return document_to_user(document)  # type: ignore
+
+    async def get_first(self) -> Union[RealUser, LegalUser]:
+        document = await self.__find_one({})
+        if not document:
+            raise errors.UserDoesNotExist("user does not exist")
+        return document_to_user(document)
+
+    async def check_by_national_code(self, national_code: NationalCodeField) -> bool:
+        return await self.collection.count_documents(
+            {"national_code": national_code}, limit=1) > 0
+
+    async def check_by_company_code(self, company_code: CompanyCodeField) -> bool:
+        return await self.collection.count_documents(
+            {"company_code": company_code}, limit=1) > 0
+
+    async def get_by_id(self, user_id: str) -> Union[RealUser, LegalUser]:
+        if self.principals:
+            document = await self.principals.get(str(user_id))
+            if document:
+                return principal_to_user(document)
+
+        document = await self.__find_one({"_id": ObjectId(user_id)})
+        if not document:
+            raise errors.UserDoesNotExist("user does not exist")
+        if self.principals:
+            await self.principals.set(str(user_id), document)
+        return document_to_user(document)
+
+    async def update(self, user: Union[RealUser, LegalUser]):
+        changes, city_changed = user_changes(user)
+        if not changes:
+            return
+        if city_changed:
+            await self.__error_on_invalid_city(user.contact_information.city_id)  # type: ignore
+
+        await self.collection.update_one(
+            {'_id': ObjectId(user.id)},
+            {"$set": changes}
+        )
+        user.mark_clean()
+        await self.__invalidate(user)
+
+    async def upgrade_schema(self, batch_size: int = 1000) -> Tuple[int, Dict[str, str]]:
+        cursor = self.collection.find(OUTDATED_USERS, USER_FIELDS).sort('_id', ASCENDING)
+        upgraded, upgrade_errors = 0, {}
+        while True:
+            batch = await cursor.to_list(batch_size)
+            if not batch:
+                return upgraded, upgrade_errors
+            valid, invalid = validate_outdated(batch)
+            upgrade_errors.update(invalid)
+            if valid:
+                await self.collection.update_many(
+                    {'_id': {'$in': valid}}, {'$set': {'schema_version': USER_SCHEMA_VERSION}})
+                upgraded += len(valid)
+
+
+class MotorProvinceCollection(AsyncProvinceCollection):
+    indexes = MongoProvinceCollection.indexes
+
+    def __init__(self, db: AsyncIOMotorDatabase, cities: Union[AsyncCityIndex, None] = None):
+        self.db = db
+        self.collection = self.db.provinces
+        self.cities = cities or AsyncCityIndex(self.collection)
+
+    async def create(self, province: Province) -> Province:
+        result = await self.collection.insert_one(province_document(province))
+        province.id = result.inserted_id
+        self.cities.invalidate()
+        return province
+
+    async def get_all(self) -> List[Province]:
+        return [Province(**d) async for d in self.collection.find()]
+
+    async def get_by_city_id(self, city_id: str) -> Province:
+        """ only return one city with it's province """
+        return city_province(await self.cities.get(city_id), city_id)
+
+
+class MotorDatabase(AsyncDatabase):
+    """
+    MongoDB through the asyncio driver, nothing blocks the event loop.
+    Shares queries and in-memory role and city lookups with MongoDatabase.
+    """
+
+    def __init__(self,
+                 uri: str,
+                 database: str,
+                 principals: Union[PrincipalCache, None] = None,
+                 role_registry_ttl: float = 60,
+                 buffer_last_logins: bool = False):
+        self.database_name = database
+        self.client = AsyncIOMotorClient(uri)
+        self.db = self.client.get_database(self.database_name)
+        self.role_registry = AsyncRoleRegistry(self.db.roles, role_registry_ttl)
+        self.city_index = AsyncCityIndex(self.db.provinces)
+        self.roles = MotorRoleCollection(self.db, self.role_registry)
+        self.users = MotorUserCollection(
+            self.db, principals, self.role_registry, self.city_index,
+            LastLoginBuffer() if buffer_last_logins else None)
+        self.provinces = MotorProvinceCollection(self.db, self.city_index)
+
+    def __collections(self):
+        return [self.roles, self.users, self.provinces]
+
+    async def ensure_indexes(self):
+        for c in self.__collections():
+            await ensure_indexes(c.collection, c.indexes)
+
+    async def index_state(self) -> List[dict]:
+        state = []
+        for c in self.__collections():
+            existing = await c.collection.index_information()
+            state.extend(describe_indexes(c.collection.name, c.indexes, existing))
+        return state
+
+    async def preload(self):
+        await self.role_registry.load()
+        await self.city_index.load()
+
+    async def flush(self):
+        await self.users.flush()
+
+    async def check_connection(self):
+        return await self.db.command('ping')
+
+    async def drop(self):
+        await self.client.drop_database(self.database_name)
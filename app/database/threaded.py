@@ -0,0 +1,169 @@
+from itertools import islice
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from app.cache import PrincipalCache
+from app.database.base import (
+    AsyncDatabase, AsyncProvinceCollection, AsyncRoleCollection, AsyncUserCollection,
+    Database, ProvinceDatabase, RoleCollection, UserCollection)
+from app.database.mongo import principal_to_user
+from app.models.province import Province
+from app.models.role import Role
+from app.models.user import LegalUser, RealUser
+from app.types.fields import CompanyCodeField, NationalCodeField
+from app.utils.utils import run_in_thread
+
+# run_in_thread, or run_inline for databases that never block
+Runner = Callable[..., Awaitable[Any]]
+
+
+class ThreadedRoleCollection(AsyncRoleCollection):
+    def __init__(self, roles: RoleCollection, run: Runner = run_in_thread) -> None:
+        self.roles = roles
+        self.run = run
+
+    async def create(self, role: Role) -> Role:
+        return await self.run(self.roles.create, role)
+
+    async def get_all(self) -> List[Role]:
+        return await self.run(self.roles.get_all)
+
+    async def get_by_platform(self, platform: str) -> Role:
+        return await self.run(self.roles.get_by_platform, platform)
+
+    async def delete_by_id(self, role_id: str):
+        return await self.run(self.roles.delete_by_id, role_id)
+
+
+class ThreadedUserCollection(AsyncUserCollection):
+    """ get_by_id is served from principals when given, create and update invalidate it. """
+
+    def __init__(self,
+                 users: UserCollection,
+                 principals: Union[PrincipalCache, None] = None,
+                 batch_size: int = 100,
+                 run: Runner = run_in_thread) -> None:
+        self.users = users
+        self.principals = principals
+        self.batch_size = batch_size
+        self.run = run
+
+    async def create(self, user: Union[RealUser, LegalUser]) -> Union[RealUser, LegalUser]:
+        user = await self.run(self.users.create, user)
+        await self.__invalidate(user)
+        return user
+
+    async def create_many(self, users: List[Union[RealUser, LegalUser]]) -> Dict[int, str]:
+        return await self.run(self.users.create_many, users)
+
+    async def update_last_login(self, user: Union[RealUser, LegalUser]):
+        return await self.run(self.users.update_last_login, user)
+
+    async def flush(self):
+        return await self.run(self.users.flush)
+
+    async def get_all(self) -> List[Union[RealUser, LegalUser]]:
+        return await self.run(self.users.get_all)
+
+    async def find(self,
+                   after: Optional[str] = None,
+                   limit: Optional[int] = None,
+                   fields: Optional[List[str]] = None,
+                   user_type: Optional[str] = None,
+                   platform: Optional[str] = None,
+                   role: Optional[str] = None) -> AsyncIterator[dict]:
+        documents = await self.run(
+            self.users.find, after, limit, fields, user_type, platform, role)
+        while True:
+            # One thread hop per batch instead of per document
+            batch = await self.run(lambda: list(islice(documents, self.batch_size)))
+            if not batch:
+                return
+            for document in batch:
+                yield document
+
+    async def get_by_national_code(self, national_code: NationalCodeField) -> RealUser:
+        return await self.run(self.users.get_by_national_code, national_code)
+
+    async def get_by_company_code(self, company_code: CompanyCodeField) -> LegalUser:
+        return await self.run(self.users.get_by_company_code, company_code)
+
+    async def get_first(self) -> Union[RealUser, LegalUser]:
+        return await self.run(self.users.get_first)
+
+    async def check_by_national_code(self, national_code: NationalCodeField) -> bool:
+        return await self.run(self.users.check_by_national_code, national_code)
+
+    async def check_by_company_code(self, company_code: CompanyCodeField) -> bool:
+        return await self.run(self.users.check_by_company_code, company_code)
+
+    async def get_by_id(self, user_id: str) -> Union[RealUser, LegalUser]:
+        if not self.principals:
+            return await self.run(self.users.get_by_id, user_id)
+
+        document = await self.principals.get(str(user_id))
+        if document:
+            return principal_to_user(document)
+        user = await self.run(self.users.get_by_id, user_id)
+        await self.principals.set(str(user_id), user.dict(by_alias=True, exclude_none=True))
+        return user
+
+    async def update(self, user: Union[RealUser, LegalUser]):
+        await self.run(self.users.update, user)
+        await self.__invalidate(user)
+
+    async def upgrade_schema(self, batch_size: int = 1000) -> Tuple[int, Dict[str, str]]:
+        return await self.run(self.users.upgrade_schema, batch_size)
+
+    async def __invalidate(self, user: Union[RealUser, LegalUser]):
+        if self.principals and user.id:
+            await self.principals.invalidate(str(user.id))
+
+
+class ThreadedProvinceCollection(AsyncProvinceCollection):
+    def __init__(self, provinces: ProvinceDatabase, run: Runner = run_in_thread) -> None:
+        self.provinces = provinces
+        self.run = run
+
+    async def create(self, province: Province) -> Province:
+        return await self.run(self.provinces.create, province)
+
+    async def get_all(self) -> List[Province]:
+        return await self.run(self.provinces.get_all)
+
+    async def get_by_city_id(self, city_id: str) -> Province:
+        return await self.run(self.provinces.get_by_city_id, city_id)
+
+
+class ThreadedDatabase(AsyncDatabase):
+    """
+    Runs a blocking Database on the default thread pool,
+    so the event loop keeps serving other requests while it waits.
+    """
+
+    def __init__(self,
+                 database: Database,
+                 principals: Union[PrincipalCache, None] = None,
+                 run: Runner = run_in_thread) -> None:
+        self.database = database
+        self.run = run
+        self.roles = ThreadedRoleCollection(database.roles, run)
+        self.users = ThreadedUserCollection(database.users, principals, run=run)
+        self.provinces = ThreadedProvinceCollection(database.provinces, run)
+
+    async def check_connection(self):
+        return await self.run(self.database.check_connection)
+
+    async def drop(self):
+        return await self.run(self.database.drop)
+
+    async def ensure_indexes(self):
+        return await self.run(self.database.ensure_indexes)
+
+    async def index_state(self) -> List[dict]:
+        return await self.run(self.database.index_state)
+
+    async def preload(self):
+        return await self.run(self.database.preload)
+
+    async def flush(self):
+        return await self.run(self.database.flush)
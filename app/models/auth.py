@@ -1,3 +1,4 @@
+from pydantic import BaseModel
 from app.models.base import PlatformSpecificationIn, BaseModelIn
 from app.types.fields import CompanyCodeField, NationalCodeField
 
@@ -12,3 +13,15 @@ class RealUserAuthenticationIn(BaseModelIn):
     national_code: NationalCodeField
     current_platform: PlatformSpecificationIn
     password: str
+
+
+class PasswordHasherStatsOut(BaseModel):
+    workers: int
+    in_progress: int
+    queue_depth: int
+    max_queue_size: int
+    rejected: int
+    completed: int
+    failed: int
+    average_time: float
+    max_time: float
@@ -1,10 +1,33 @@
-from typing import Any
+from typing import Any, Type, TypeVar
 from pydantic import BaseModel, validator, BaseConfig
+from pydantic.fields import SHAPE_LIST
 from app.types.fields import UserType
 from datetime import datetime
 from bson import ObjectId
 
 
+Model = TypeVar('Model', bound=BaseModel)
+
+
+def construct_trusted(model: Type[Model], document: dict) -> Model:
+    """
+    Like model.construct but nested models and lists of models are built too.
+    Skips validation, so document must be something we validated before writing.
+    """
+    values = {}
+    for name, field in model.__fields__.items():
+        if field.alias not in document:
+            continue
+        value = document[field.alias]
+        if value is not None and isinstance(field.type_, type) and issubclass(field.type_, BaseModel):
+            if field.shape == SHAPE_LIST:
+                value = [construct_trusted(field.type_, v) for v in value]
+            else:
+                value = construct_trusted(field.type_, value)
+        values[name] = value
+    return model.construct(**values)
+
+
 class MongoModel(BaseModel):
     """
     Base model for mapping pydantic objects to mongo compatible dictionary.
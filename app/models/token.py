@@ -27,3 +27,25 @@ class JwtPayload(BaseModel):
 class AccessTokenOut(BaseModel):
     token: str
     type: str = 'bearer'
+
+
+class AccessTokenBatchIn(BaseModel):
+    tokens: List[str]
+    type: str = 'bearer'
+
+
+class TokenVerificationOut(BaseModel):
+    """ Verdict for one token of a batch, payload is None for invalid tokens. """
+    valid: bool
+    payload: Optional[JwtPayload]
+
+
+class TokenCacheStatsOut(BaseModel):
+    size: int
+    max_size: int
+    hits: int
+    misses: int
+
+
+class JwksOut(BaseModel):
+    keys: List[dict]
@@ -1,12 +1,12 @@
 from datetime import datetime, date
-from typing import List, Optional, Union
-from app.models.base import MongoModel, BaseModelOut
+from typing import List, Literal, Optional, Union
+from app.models.base import MongoModel, BaseModelOut, construct_trusted
 from app.models.role import UserRole, Role
 from app.types.fields import ObjectIdField, CompanyCodeField, CompanyDomainField, GenderField,\
     NationalCodeField, PhoneNumberField, UserTypeField, UserType
 
-from app.core.security import get_password_hash
-from pydantic import BaseModel, Field, validator, HttpUrl
+from app.core.security import get_password_hash, password_hasher
+from pydantic import BaseModel, Field, PrivateAttr, validator, HttpUrl
 from app.models.verification import LegalUserCodeVerificationIn, RealUserCodeVerificationIn
 from app.models.base import BaseModelIn, PlatformSpecificationIn, PlatformSpecificationOut
 from app.models.profile import ContactInformation, ContactInformationIn, ContactInformationOut
@@ -15,6 +15,11 @@ from app.utils import path
 from app.utils.utils import date_to_datetime
 
 
+# Bump when stored user documents stop being valid input for the models,
+# documents with an older version are validated when they're loaded.
+USER_SCHEMA_VERSION = 1
+
+
 class User(MongoModel):
     """ Common fields for both real users and legal users. """
     id: Optional[ObjectIdField] = Field(alias='_id')
@@ -27,29 +32,72 @@ class User(MongoModel):
 
     picture_url: str
     contact_information: Optional[ContactInformation]
+    schema_version: Optional[int]
+
+    # Field values as they were loaded from the database
+    _snapshot: Optional[dict] = PrivateAttr(default=None)
 
     @staticmethod
     def new_user(
             phone_number: str,
             plain_password,
             user_type: UserTypeField,
-            roles: List[UserRole]
+            roles: List[UserRole],
+            hashed_password: Optional[str] = None
     ):
+        """ Pass hashed_password to skip hashing plain_password synchronously. """
         return User(
             _id=None,
             roles=roles,
             phone_number=phone_number,
-            password=get_password_hash(plain_password),
+            password=hashed_password or get_password_hash(plain_password),
             last_login=datetime.utcnow().replace(microsecond=0),
             created_at=datetime.utcnow().replace(microsecond=0),
             picture_url=path.get_default_profile_picture_url(),
             type=user_type,
-            contact_information=None
+            contact_information=None,
+            schema_version=USER_SCHEMA_VERSION
         )
 
+    @classmethod
+    def from_document(cls, document: dict):
+        """
+        Builds the model from a stored document.
+        Documents written with the current schema version aren't validated again.
+        """
+        if document.get('schema_version') == USER_SCHEMA_VERSION:
+            return construct_trusted(cls, document)
+        return cls(**document)
+
     def set_password(self, plain_password: str):
         self.password = get_password_hash(plain_password)
 
+    async def set_password_async(self, plain_password: str):
+        self.password = await password_hasher.hash(plain_password)
+
+    def mark_clean(self):
+        """ Remembers current values, get_changes reports fields changed after this. """
+        self._snapshot = self.dict(exclude={'id'}, exclude_none=True)
+
+    def get_changes(self) -> Union[dict, None]:
+        """
+        Changed fields since mark_clean, nested documents are compared field by field
+        and reported with dotted paths. Returns None if the model was never marked clean.
+        """
+        if self._snapshot is None:
+            return None
+
+        changes = {}
+        for field, value in self.dict(exclude={'id'}, exclude_none=True).items():
+            old_value = self._snapshot.get(field)
+            if isinstance(value, dict) and isinstance(old_value, dict):
+                for sub_field, sub_value in value.items():
+                    if old_value.get(sub_field) != sub_value:
+                        changes[f"{field}.{sub_field}"] = sub_value
+            elif old_value != value:
+                changes[field] = value
+        return changes
+
     def has_role(self, platform: str, role_name: str) -> bool:
         for role in self.roles:
             if role.platform == platform:
@@ -86,14 +134,16 @@ class RealUser(User):
         first_name: str,
         last_name: str,
         plain_password: str,
-        roles: List[UserRole]
+        roles: List[UserRole],
+        hashed_password: Optional[str] = None
     ) -> "RealUser":
 
         basic_user = User.new_user(
             phone_number=phone_number,
             plain_password=plain_password,
             roles=roles,
-            user_type=UserType.REAL  # type: ignore
+            user_type=UserType.REAL,  # type: ignore
+            hashed_password=hashed_password
         )
 
         return RealUser(
@@ -135,14 +185,15 @@ class RealUserCreationIn(BaseModelIn):
     password1: str
     password2: str
 
-    def to_model(self) -> RealUser:
+    def to_model(self, hashed_password: Optional[str] = None) -> RealUser:
         return RealUser.new_user(
             national_code=self.national_code,
             phone_number=self.phone_number,
             first_name=self.first_name,
             last_name=self.last_name,
             plain_password=self.password1,
-            roles=self.roles
+            roles=self.roles,
+            hashed_password=hashed_password
         )
 
     @validator('password2')
@@ -173,7 +224,7 @@ class RealUserRegistrationIn(BaseModelIn):
             raise ValueError(_('passwords do not match'))
         return v
 
-    def to_model(self) -> RealUser:
+    def to_model(self, hashed_password: Optional[str] = None) -> RealUser:
         return RealUser.new_user(
             national_code=self.verification.national_code,
             phone_number=self.verification.phone_number,
@@ -185,7 +236,8 @@ class RealUserRegistrationIn(BaseModelIn):
                     platform=self.current_platform.platform,
                     names=[self.current_platform.role]
                 )
-            ]
+            ],
+            hashed_password=hashed_password
         )
 
 
@@ -205,13 +257,15 @@ class LegalUser(User):
         domain: str,
         plain_password: str,
         roles: List[UserRole],
+        hashed_password: Optional[str] = None
     ) -> "LegalUser":
 
         basic_user = User.new_user(
             phone_number=phone_number,
             plain_password=plain_password,
             roles=roles,
-            user_type=UserType.LEGAL  # type: ignore
+            user_type=UserType.LEGAL,  # type: ignore
+            hashed_password=hashed_password
         )
         return LegalUser(
             **basic_user.dict(),
@@ -247,14 +301,15 @@ class LegalUserCreationIn(BaseModelIn):
     password1: str
     password2: str
 
-    def to_model(self) -> LegalUser:
+    def to_model(self, hashed_password: Optional[str] = None) -> LegalUser:
         return LegalUser.new_user(
             company_code=self.company_code,
             phone_number=self.phone_number,
             company_name=self.company_name,
             domain=self.domain,
             plain_password=self.password1,
-            roles=self.roles
+            roles=self.roles,
+            hashed_password=hashed_password
         )
 
     @validator('password2')
@@ -284,7 +339,7 @@ class LegalUserRegistrationIn(BaseModelIn):
             raise ValueError(_('passwords do not match'))
         return v
 
-    def to_model(self) -> LegalUser:
+    def to_model(self, hashed_password: Optional[str] = None) -> LegalUser:
         return LegalUser.new_user(
             company_code=self.verification.company_code,
             phone_number=self.verification.phone_number,
@@ -296,10 +351,24 @@ class LegalUserRegistrationIn(BaseModelIn):
                     platform=self.current_platform.platform,
                     names=[self.current_platform.role]
                 )
-            ]
+            ],
+            hashed_password=hashed_password
         )
 
 
+# ProfileOut fields mapped to the user document fields they're built from
+PROFILE_DOCUMENT_FIELDS = {
+    'id': ['_id'],
+    'phone_number': ['phone_number'],
+    'type': ['type'],
+    'real_user': ['national_code', 'first_name', 'last_name', 'father_name', 'gender', 'birth_day'],
+    'legal_user': ['company_code', 'company_name', 'domain', 'title'],
+    'roles': ['roles'],
+    'contact_information': ['contact_information'],
+    'picture_url': ['picture_url'],
+}
+
+
 class ProfileOut(BaseModelOut):
     id: Optional[ObjectIdField] = Field(alias='_id')
     phone_number: Optional[str]
@@ -329,6 +398,57 @@ class ProfileOut(BaseModelOut):
             picture_url=path.get_full_url(user.picture_url)
         )
 
+    @staticmethod
+    def document_fields(fields: List[str]) -> List[str]:
+        """ Translates ProfileOut field names into a user document projection. """
+        document_fields = []
+        for field in fields:
+            if field not in PROFILE_DOCUMENT_FIELDS:
+                raise ValueError(_("unknown field {}").format(field))
+            document_fields.extend(PROFILE_DOCUMENT_FIELDS[field])
+        return document_fields
+
+    @classmethod
+    def from_document(cls, document: dict) -> "ProfileOut":
+        """
+        Builds a profile from a (possibly projected) user document
+        without validating the whole user model first.
+        Missing fields are left as None.
+        """
+        real_user = legal_user = contact_information = picture_url = None
+        if document.get('type') == UserType.REAL and 'national_code' in document:
+            real_user = RealUserOut(
+                national_code=document['national_code'],
+                first_name=document['first_name'],
+                last_name=document['last_name'],
+                father_name=document.get('father_name'),
+                gender=document.get('gender'),
+                birth_day=document.get('birth_day')
+            )
+        if document.get('type') == UserType.LEGAL and 'company_code' in document:
+            legal_user = LegalUserOut(
+                company_code=document['company_code'],
+                name=document['company_name'],
+                domain=document['domain'],
+                title=document.get('title')
+            )
+        if 'contact_information' in document:
+            contact_information = ContactInformationOut(
+                **(document['contact_information'] or {}))
+        if 'picture_url' in document:
+            picture_url = path.get_full_url(document['picture_url'])
+
+        return cls(
+            _id=document['_id'],
+            phone_number=document.get('phone_number'),
+            type=document.get('type'),
+            legal_user=legal_user,
+            real_user=real_user,
+            roles=document.get('roles'),
+            contact_information=contact_information,
+            picture_url=picture_url
+        )
+
     class Config:
         use_enum_values = True
 
@@ -420,3 +540,59 @@ class PhoneNumberUpdateIn(BaseModel):
             return v
         raise ValueError(
             _("phone_number should be eqaul to the verification.phone_number"))
+
+
+class RealUserImportIn(BaseModelIn):
+    """ Real user row of a bulk import. """
+    type: Literal['REAL']
+    national_code: NationalCodeField
+    phone_number: PhoneNumberField
+    first_name: str
+    last_name: str
+    password: str
+    roles: List[UserRole]
+
+    def to_model(self, hashed_password: Optional[str] = None) -> RealUser:
+        return RealUser.new_user(
+            national_code=self.national_code,
+            phone_number=self.phone_number,
+            first_name=self.first_name,
+            last_name=self.last_name,
+            plain_password=self.password,
+            roles=self.roles,
+            hashed_password=hashed_password
+        )
+
+
+class LegalUserImportIn(BaseModelIn):
+    """ Legal user row of a bulk import. """
+    type: Literal['LEGAL']
+    company_code: CompanyCodeField
+    phone_number: PhoneNumberField
+    company_name: str
+    domain: CompanyDomainField
+    password: str
+    roles: List[UserRole]
+
+    def to_model(self, hashed_password: Optional[str] = None) -> LegalUser:
+        return LegalUser.new_user(
+            company_code=self.company_code,
+            phone_number=self.phone_number,
+            company_name=self.company_name,
+            domain=self.domain,
+            plain_password=self.password,
+            roles=self.roles,
+            hashed_password=hashed_password
+        )
+
+
+class ImportRowError(BaseModel):
+    row: int
+    error: str
+
+
+class UserImportOut(BaseModel):
+    total: int = 0
+    created: int = 0
+    failed: int = 0
+    errors: List[ImportRowError] = []
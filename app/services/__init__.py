@@ -6,3 +6,4 @@ from .notification import (
 from .verification import SMSVerificationService, VerificationService, FakeVerificationService
 from .services import get_srv, init_srv
 from .broker import Broker, RabbitMQ, MemoryBroker
+from .importer import UserImporter
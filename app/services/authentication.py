@@ -1,16 +1,18 @@
 from typing import Union
 
-from app.cache import Cache
-from app.core.security import verify_password
+from app.cache import AsyncCache
+from app.core.security import password_hasher
 from app.models.profile import PictureIn
 from app.models.role import Role, UserRole
 from app.models.user import LegalUser, RealUser, RealUserRegistrationIn, LegalUserRegistrationIn
 from app.models.auth import RealUserAuthenticationIn, LegalUserAuthenticationIn
 from app.types.fields import NationalCodeField, PhoneNumberField
-from app.database import errors as dberrors, Database
+from app.database import errors as dberrors, AsyncDatabase
 from app.services.s3 import S3Service
 from app.services.broker import Broker, Message
 from app.services.verification import VerificationService
+from app.services.lockout import LoginLockout
+from app.core.config import settings
 from app.core.errors import MyException
 
 
@@ -21,14 +23,20 @@ class UnAuthorizedError(MyException):
 class AuthService:
     def __init__(self,
                  broker: Broker,
-                 db: Database,
-                 cache: Cache,
+                 db: AsyncDatabase,
+                 cache: AsyncCache,
                  verification: VerificationService):
 
         self.broker = broker
         self.database = db
         self.verification = verification
         self.cache = cache
+        self.lockout = LoginLockout(
+            cache,
+            max_failed_attempts=settings.user_max_failed_attempt,
+            ip_max_failed_attempts=settings.ip_max_failed_attempt,
+            window=settings.failed_attempt_window
+        )
         self.s3 = S3Service('images/profile')
 
     def create_profile_picture_url(self, info: PictureIn, user_id: str) -> str:
@@ -39,31 +47,47 @@ class AuthService:
             info.content_length
         )
 
-    def authenticate(self, credentials: Union[RealUserAuthenticationIn, LegalUserAuthenticationIn]) -> Union[RealUser, LegalUser]:
+    async def authenticate(
+            self,
+            credentials: Union[RealUserAuthenticationIn, LegalUserAuthenticationIn],
+            ip: Union[str, None] = None) -> Union[RealUser, LegalUser]:
+        if isinstance(credentials, RealUserAuthenticationIn):
+            identity = str(credentials.national_code)
+        else:
+            identity = str(credentials.company_code)
+
+        # Locked out identities never reach the database or bcrypt
+        await self.lockout.check(identity, ip)
+
         try:
             if isinstance(credentials, RealUserAuthenticationIn):
-                user = self.database.users.get_by_national_code(
+                user = await self.database.users.get_by_national_code(
                     credentials.national_code)
             else:
-                user = self.database.users.get_by_company_code(
+                user = await self.database.users.get_by_company_code(
                     credentials.company_code)
         except dberrors.UserDoesNotExist:
+            await self.lockout.register_failure(identity, ip)
             raise UnAuthorizedError("invalid credentials")
 
-        if not verify_password(credentials.password, user.password):
+        if not await password_hasher.verify(credentials.password, user.password):
+            await self.lockout.register_failure(identity, ip)
             raise UnAuthorizedError("invalid credentials")
 
+        await self.lockout.reset(identity)
+
         if not user.has_role(credentials.current_platform.platform, credentials.current_platform.role):
             raise UnAuthorizedError(
                 "you don't have this role in the given platform")
 
-        self.database.users.update_last_login(user)
+        await self.database.users.update_last_login(user)
         return user
 
     async def register(self, u: Union[RealUserRegistrationIn, LegalUserRegistrationIn]):
         await self.verification.verify(u.verification, delete_on_success=True)
 
-        new_user = self.database.users.create(u.to_model())
+        hashed_password = await password_hasher.hash(u.password1)
+        new_user = await self.database.users.create(u.to_model(hashed_password))
         await self.broker.publish(
             queue_name='registration',
             message=Message(
@@ -72,7 +96,7 @@ class AuthService:
             )
         )
 
-    def create_admin(
+    async def create_admin(
             self,
             national_code: NationalCodeField,
             phone_number: PhoneNumberField,
@@ -81,9 +105,9 @@ class AuthService:
             password: str
     ) -> RealUser:
         try:
-            self.database.roles.get_by_platform("*")
+            await self.database.roles.get_by_platform("*")
         except dberrors.RoleDoesNotExist:
-            self.database.roles.create(
+            await self.database.roles.create(
                 Role(platform='*', names=['admin']))  # type: ignore
 
         admin = RealUser.new_user(
@@ -95,4 +119,4 @@ class AuthService:
             [UserRole(platform='*', names=['admin'])]
         )
 
-        return self.database.users.create(admin)  # type: ignore
+        return await self.database.users.create(admin)  # type: ignore
@@ -2,11 +2,14 @@ import abc
 import asyncio
 import json
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Callable, Any, Dict, Union
+from typing import Callable, Any, Dict, Set, Union
 from aio_pika import Message as PikaMessage, connect_robust, connect
-from aio_pika.abc import AbstractIncomingMessage
+from aio_pika.abc import AbstractChannel, AbstractIncomingMessage, AbstractRobustConnection
+from aio_pika.pool import Pool
 from app.core.logging import logger
+from app.core.serializer import JsonSerializer as JsonEncoder
 
 
 @dataclass
@@ -30,7 +33,7 @@ class Serializer(abc.ABC):
 
 class JsonSerializer(Serializer):
     def encode(self, message: dict) -> bytes:
-        return json.dumps(message).encode('utf-8')
+        return json.dumps(message, cls=JsonEncoder).encode('utf-8')
 
     def decode(self, message: bytes) -> dict:
         return json.loads(message.decode('utf-8'))
@@ -50,6 +53,11 @@ class Broker(abc.ABC):
     async def publish(self, queue_name: str, message: Message):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    async def close(self):
+        """ Releases connections held by the broker """
+        raise NotImplementedError
+
 
 class MemoryBroker(Broker):
     def __init__(self, delay: float = 1) -> None:
@@ -73,6 +81,9 @@ class MemoryBroker(Broker):
 
         self.queues[queue_name].append(message.body)
 
+    async def close(self):
+        return
+
 
 class RabbitMQ(Broker):
     def __init__(self,
@@ -80,7 +91,10 @@ class RabbitMQ(Broker):
                  port: int,
                  username: str = "",
                  password: str = "",
-                 serializers: Union[Dict[str, Serializer], None] = None
+                 serializers: Union[Dict[str, Serializer], None] = None,
+                 channel_pool_size: int = 10,
+                 prefetch_count: int = 10,
+                 consumer_workers: int = 4
                  ) -> None:
         self.address = address
         self.port = port
@@ -91,6 +105,19 @@ class RabbitMQ(Broker):
         else:
             self.serializers = self.get_default_serializers()
 
+        self.channel_pool_size = channel_pool_size
+        self.connection: Union[AbstractRobustConnection, None] = None
+        self.connection_lock: Union[asyncio.Lock, None] = None
+        self.channel_pool: Union[Pool[AbstractChannel], None] = None
+        self.declared_queues: Set[str] = set()
+
+        self.prefetch_count = prefetch_count
+        self.consumer_workers = consumer_workers
+        self.executor: Union[ThreadPoolExecutor, None] = None
+        # Running consume loops and the requests they are handling
+        self.consumers: Set[asyncio.Task] = set()
+        self.consumer_tasks: Set[asyncio.Task] = set()
+
     def get_default_serializers(self) -> Dict[str, Serializer]:
         return {
             'application/json': JsonSerializer(),
@@ -108,57 +135,137 @@ class RabbitMQ(Broker):
         except Exception:
             return False
 
+    async def get_connection(self) -> AbstractRobustConnection:
+        """ Returns the shared robust connection, connecting on first use. """
+        # Created lazily so the lock is bound to the running event loop
+        if self.connection_lock is None:
+            self.connection_lock = asyncio.Lock()
+
+        async with self.connection_lock:
+            if self.connection is None or self.connection.is_closed:
+                self.connection = await connect_robust(
+                    host=self.address,
+                    port=self.port,
+                    login=self.username,
+                    password=self.password
+                )
+        return self.connection
+
+    async def get_channel(self) -> AbstractChannel:
+        connection = await self.get_connection()
+        return await connection.channel()
+
+    def get_channel_pool(self) -> Pool[AbstractChannel]:
+        if self.channel_pool is None or self.channel_pool.is_closed:
+            self.channel_pool = Pool(
+                self.get_channel, max_size=self.channel_pool_size)
+        return self.channel_pool
+
     async def publish(self, queue_name: str, message: Message):
-        connection = await connect_robust(
-            host=self.address,
-            port=self.port,
-            login=self.username,
-            password=self.password
-        )
-        channel = await connection.channel()
-        await channel.declare_queue(queue_name)
-        await channel.default_exchange.publish(
-            PikaMessage(
-                message_id=message.id.hex,
-                body=self.serializers[message.content_type].encode(
-                    message.body),
-                content_type=message.content_type,
-                type=message.type,
-            ), routing_key=queue_name
-        )
+        async with self.get_channel_pool().acquire() as channel:
+            if queue_name not in self.declared_queues:
+                await channel.declare_queue(queue_name)
+                self.declared_queues.add(queue_name)
+
+            await channel.default_exchange.publish(
+                PikaMessage(
+                    message_id=message.id.hex,
+                    body=self.serializers[message.content_type].encode(
+                        message.body),
+                    content_type=message.content_type,
+                    type=message.type,
+                ), routing_key=queue_name
+            )
+
+    async def stop_consuming(self):
+        """ Stops the consume loops and waits for the requests they already took. """
+        consumers = list(self.consumers)
+        for consumer in consumers:
+            consumer.cancel()
+        # Leaving the queue iterator cancels the consumer and requeues prefetched messages
+        await asyncio.gather(*consumers, return_exceptions=True)
+        if self.consumer_tasks:
+            await asyncio.gather(*self.consumer_tasks, return_exceptions=True)
+
+    async def close(self):
+        """ Stops consuming, then closes pooled channels and the shared connection. """
+        await self.stop_consuming()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.channel_pool is not None:
+            await self.channel_pool.close()
+            self.channel_pool = None
+        if self.connection is not None:
+            await self.connection.close()
+            self.connection = None
+        self.declared_queues.clear()
 
     async def consume(self, loop, queue_name: str, on_message: Callable[[dict], dict]):
-        connection = await connect_robust(
-            host=self.address,
-            port=self.port,
-            login=self.username,
-            password=self.password,
-            loop=loop
-        )
+        """
+        Serves requests from queue_name with up to consumer_workers handlers
+        running concurrently. on_message runs in a thread pool so CPU bound
+        handlers don't block the event loop.
+        """
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.consumer_workers,
+                thread_name_prefix=f"consumer-{queue_name}")
+
+        connection = await self.get_connection()
         channel = await connection.channel()
+        await channel.set_qos(prefetch_count=self.prefetch_count)
         queue = await channel.declare_queue(queue_name)
 
+        workers = asyncio.Semaphore(self.consumer_workers)
+
+        def on_done(task: asyncio.Task):
+            self.consumer_tasks.discard(task)
+            workers.release()
+
+        consumer = asyncio.current_task()
+        self.consumers.add(consumer)  # type: ignore
         logger.info("Consuming from queue")
-        async with queue.iterator() as iterator:
-            message: AbstractIncomingMessage
-            async for message in iterator:
-                try:
-                    async with message.process(requeue=False):
-                        assert message.reply_to
-                        assert message.content_type
-
-                        response = on_message(
-                            self.serializers[message.content_type].decode(message.body))
-
-                        await channel.default_exchange.publish(
-                            PikaMessage(
-                                body=self.serializers["application/json"].encode(
-                                    response),
-                                content_type='json/application',
-                                correlation_id=message.correlation_id,
-                            ),
-                            routing_key=message.reply_to,
-                        )
-                        logger.info("Request complete")
-                except Exception:
-                    logger.exception(f"Processing error for message {message}")
+        try:
+            async with queue.iterator() as iterator:
+                message: AbstractIncomingMessage
+                async for message in iterator:
+                    await workers.acquire()
+                    task = asyncio.create_task(
+                        self.__process_message(loop, channel, message, on_message))
+                    self.consumer_tasks.add(task)
+                    task.add_done_callback(on_done)
+        finally:
+            self.consumers.discard(consumer)  # type: ignore
+
+    async def __process_message(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        channel: AbstractChannel,
+        message: AbstractIncomingMessage,
+        on_message: Callable[[dict], dict]
+    ):
+        try:
+            async with message.process(requeue=False):
+                assert message.reply_to
+                assert message.content_type
+
+                request = self.serializers[message.content_type].decode(
+                    message.body)
+                response = await loop.run_in_executor(
+                    self.executor, on_message, request)
+
+                await channel.default_exchange.publish(
+                    PikaMessage(
+                        body=self.serializers["application/json"].encode(
+                            response),
+                        content_type='application/json',
+                        correlation_id=message.correlation_id,
+                    ),
+                    routing_key=message.reply_to,
+                )
+                logger.info("Request complete")
+        except Exception:
+            logger.exception(f"Processing error for message {message}")
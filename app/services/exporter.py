@@ -0,0 +1,159 @@
+import csv
+import gzip
+import json
+import os
+from datetime import date
+from typing import IO, List, Optional, TextIO, Union
+
+from bson import ObjectId
+
+from app.database import AsyncDatabase
+from app.database.mongo import USER_FIELDS
+from app.services.importer import format_roles
+
+
+EXPORT_FIELDS = [f for f in USER_FIELDS if f != 'password']
+
+
+def json_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def csv_value(field: str, value) -> str:
+    """ Roles use the import-users format, other nested values are written as JSON. """
+    if value is None:
+        return ''
+    if field == 'roles':
+        return format_roles(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=json_default)
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def open_export(path: Optional[str],
+                compress: bool = False,
+                append: bool = False,
+                stdout: Optional[IO[bytes]] = None) -> TextIO:
+    """ Text stream for path, or stdout when path is None. gzip members can be appended. """
+    mode = 'a' if append else 'w'
+    if compress:
+        if path is None:
+            return gzip.open(stdout, mode + 't', encoding='utf-8', newline='')  # type: ignore
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='')  # type: ignore
+    if path is None:
+        return open(stdout.fileno(),  # type: ignore
+                    'w', encoding='utf-8', newline='', closefd=False)
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def checkpoint_path(path: str) -> str:
+    return f"{path}.resume"
+
+
+def write_checkpoint(path: str, exporter: "UserExporter"):
+    """ Records the last exported _id and the columns next to a closed export file. """
+    checkpoint = {
+        'last_id': exporter.last_id,
+        'format': exporter.format,
+        'columns': exporter.columns,
+        'size': os.path.getsize(path),
+    }
+    with open(checkpoint_path(path), 'w', encoding='utf-8') as file:
+        json.dump(checkpoint, file)
+
+
+def read_checkpoint(path: str) -> Union[dict, None]:
+    """ None when there is no checkpoint or path changed after it was written. """
+    try:
+        with open(checkpoint_path(path), encoding='utf-8') as file:
+            checkpoint = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get('size') != os.path.getsize(path):
+        return None
+    return checkpoint
+
+
+def scan_export(path: str, format: str, compress: bool) -> dict:
+    """
+    Reads a previous export line by line for the _id of its last row and the CSV header.
+    Only needed when the checkpoint is missing, e.g. after the process was killed.
+    """
+    opener = gzip.open if compress else open
+    last, columns = None, None
+    with opener(path, 'rt', encoding='utf-8', newline='') as file:  # type: ignore
+        for line in file:
+            if not line.strip():
+                continue
+            if format == 'csv' and columns is None:
+                columns = next(csv.reader([line]))
+                continue
+            last = line
+
+    last_id = None
+    if last is not None and format == 'csv':
+        last_id = next(csv.reader([last]))[columns.index('_id')]  # type: ignore
+    elif last is not None:
+        last_id = json.loads(last)['_id']
+    return {'last_id': last_id, 'format': format, 'columns': columns}
+
+
+def resume_point(path: str, format: str, compress: bool) -> dict:
+    """ last_id, format and columns (None if unknown) of a previous export. """
+    return read_checkpoint(path) or scan_export(path, format, compress)
+
+
+class UserExporter:
+    """
+    Streams users ordered by _id into NDJSON or CSV.
+    Only one database batch is held in memory, so the export size doesn't matter.
+    count and last_id are updated per written row, pass last_id as after to resume.
+    """
+
+    def __init__(self,
+                 database: AsyncDatabase,
+                 format: str = 'ndjson',
+                 fields: Optional[List[str]] = None):
+        unknown = set(fields or []) - set(EXPORT_FIELDS)
+        if unknown:
+            raise ValueError(f"unknown fields: {', '.join(sorted(unknown))}")
+        if format not in ('ndjson', 'csv'):
+            raise ValueError(f"unknown format {format}")
+        self.database = database
+        self.format = format
+        self.fields = fields
+        # Projected documents always contain _id and type
+        self.columns = ['_id', 'type'] + [f for f in fields if f not in ('_id', 'type')] \
+            if fields else EXPORT_FIELDS
+        self.count = 0
+        self.last_id: Union[str, None] = None
+
+    async def run(self,
+                  out: TextIO,
+                  after: Optional[str] = None,
+                  header: bool = True,
+                  user_type: Optional[str] = None,
+                  platform: Optional[str] = None,
+                  role: Optional[str] = None) -> int:
+        """ Returns the number of exported users. """
+        writer = csv.writer(out) if self.format == 'csv' else None
+        if writer and header:
+            writer.writerow(self.columns)
+
+        documents = self.database.users.find(
+            after=after, fields=self.fields,
+            user_type=user_type, platform=platform, role=role)
+        async for document in documents:
+            if writer:
+                writer.writerow([csv_value(c, document.get(c)) for c in self.columns])
+            else:
+                out.write(json.dumps(document, default=json_default) + '\n')
+            self.count += 1
+            self.last_id = str(document['_id'])
+        return self.count
@@ -0,0 +1,175 @@
+import codecs
+import csv
+import json
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable, List, Tuple, Union
+
+from pydantic import ValidationError
+
+from app.core.security import PasswordHasher, password_hasher
+from app.database import AsyncDatabase
+from app.models.user import (
+    ImportRowError, LegalUserImportIn, RealUserImportIn, UserImportOut)
+from app.types.fields import UserType
+
+
+ROW_MODELS = {
+    UserType.REAL.value: RealUserImportIn,
+    UserType.LEGAL.value: LegalUserImportIn,
+}
+
+
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """ Splits a byte stream into lines without reading it all into memory. """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    rest = ''
+    async for chunk in chunks:
+        rest += decoder.decode(chunk)
+        *lines, rest = rest.split('\n')
+        for line in lines:
+            yield line.rstrip('\r')
+    rest += decoder.decode(b'', final=True)
+    if rest:
+        yield rest.rstrip('\r')
+
+
+async def iter_file_lines(lines: Iterable[str]) -> AsyncIterator[str]:
+    for line in lines:
+        yield line.rstrip('\r\n')
+
+
+def parse_roles(value: str) -> List[dict]:
+    """ platform1:name1|name2;platform2:name3 """
+    roles = []
+    for role in filter(None, value.split(';')):
+        platform, _, names = role.partition(':')
+        roles.append({'platform': platform.strip(),
+                      'names': [n.strip() for n in names.split('|') if n.strip()]})
+    return roles
+
+
+def format_roles(roles: List[dict]) -> str:
+    """ Inverse of parse_roles. """
+    return ';'.join(f"{r['platform']}:{'|'.join(r['names'])}" for r in roles)
+
+
+async def read_csv(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[int, Union[dict, str]]]:
+    """
+    Yields (line number, row) pairs, the first line is the header.
+    Empty cells are left out and roles are parsed with parse_roles.
+    Quoted values can't span lines.
+    """
+    header = None
+    number = 0
+    async for line in lines:
+        number += 1
+        if not line.strip():
+            continue
+        values = next(csv.reader([line]))
+        if header is None:
+            header = [h.strip() for h in values]
+            continue
+        if len(values) != len(header):
+            yield number, f"expected {len(header)} columns, got {len(values)}"
+            continue
+        row = {k: v.strip() for k, v in zip(header, values) if v.strip()}
+        if 'roles' in row:
+            row['roles'] = parse_roles(row['roles'])
+        yield number, row
+
+
+async def read_ndjson(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[int, Union[dict, str]]]:
+    """ Yields (line number, row) pairs, roles may be objects or a parse_roles string. """
+    number = 0
+    async for line in lines:
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            yield number, f"invalid json: {exc}"
+            continue
+        if not isinstance(row, dict):
+            yield number, "expected a json object"
+            continue
+        if isinstance(row.get('roles'), str):
+            row['roles'] = parse_roles(row['roles'])
+        yield number, row
+
+
+READERS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+}
+
+
+def format_validation_error(exc: ValidationError) -> str:
+    return '; '.join(
+        f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in exc.errors())
+
+
+def validate_row(row: dict) -> Union[RealUserImportIn, LegalUserImportIn]:
+    model = ROW_MODELS.get(row.get('type'))  # type: ignore
+    if model is None:
+        raise ValueError(f"type: must be one of {', '.join(ROW_MODELS)}")
+    return model(**row)
+
+
+class UserImporter:
+    """
+    Creates users from CSV or NDJSON rows in batches.
+    Each batch is validated, hashed on every password hasher worker
+    and written with one unordered insert, a bad row only fails itself.
+    """
+
+    def __init__(self,
+                 database: AsyncDatabase,
+                 hasher: PasswordHasher = password_hasher,
+                 batch_size: int = 1000,
+                 max_errors: int = 1000):
+        self.database = database
+        self.hasher = hasher
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+
+    def __error(self, result: UserImportOut, row: int, error: str):
+        result.failed += 1
+        if len(result.errors) < self.max_errors:
+            result.errors.append(ImportRowError(row=row, error=error))
+
+    async def __import_batch(self,
+                             batch: List[Tuple[int, Union[RealUserImportIn, LegalUserImportIn]]],
+                             result: UserImportOut):
+        hashes = await self.hasher.hash_many([user_in.password for _, user_in in batch])
+        users = [user_in.to_model(hashed)
+                 for (_, user_in), hashed in zip(batch, hashes)]
+        create_errors: Dict[int, str] = await self.database.users.create_many(users)
+        for i, error in sorted(create_errors.items()):
+            self.__error(result, batch[i][0], error)
+        result.created += len(users) - len(create_errors)
+
+    async def run(self, lines: AsyncIterator[str], format: str = 'csv') -> UserImportOut:
+        """ Rows are streamed, at most batch_size users are held in memory. """
+        result = UserImportOut()
+        batch: List[Tuple[int, Union[RealUserImportIn, LegalUserImportIn]]] = []
+        async for number, row in READERS[format](lines):
+            result.total += 1
+            if isinstance(row, str):
+                self.__error(result, number, row)
+                continue
+            try:
+                batch.append((number, validate_row(row)))
+            except ValidationError as exc:
+                self.__error(result, number, format_validation_error(exc))
+                continue
+            except ValueError as exc:
+                self.__error(result, number, str(exc))
+                continue
+
+            if len(batch) >= self.batch_size:
+                await self.__import_batch(batch, result)
+                batch = []
+
+        if batch:
+            await self.__import_batch(batch, result)
+        return result
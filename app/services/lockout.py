@@ -0,0 +1,54 @@
+from typing import Union
+
+from app.cache import AsyncCache
+from app.core.errors import MyException
+
+
+class TooManyFailedAttemptsError(MyException):
+    pass
+
+
+class LoginLockout:
+    """
+    Counts failed logins per identity and per client ip in a sliding window.
+    Counters live in the shared cache so every worker sees the same state.
+    """
+
+    def __init__(self,
+                 cache: AsyncCache,
+                 max_failed_attempts: int,
+                 ip_max_failed_attempts: int,
+                 window: float) -> None:
+        self.cache = cache
+        self.max_failed_attempts = max_failed_attempts
+        self.ip_max_failed_attempts = ip_max_failed_attempts
+        self.window = window
+
+    def __identity_key(self, identity: str) -> str:
+        return f"lockout:identity:{identity}"
+
+    def __ip_key(self, ip: str) -> str:
+        return f"lockout:ip:{ip}"
+
+    async def check(self, identity: str, ip: Union[str, None] = None):
+        """ Raise if the identity or ip is currently locked out. """
+        # Both counters in one round trip
+        async with self.cache.pipeline(transaction=False) as pipeline:
+            pipeline.count_events(self.__identity_key(identity), self.window)
+            if ip:
+                pipeline.count_events(self.__ip_key(ip), self.window)
+
+        identity_failures, *ip_failures = pipeline.results
+        if identity_failures >= self.max_failed_attempts or \
+                (ip_failures and ip_failures[0] >= self.ip_max_failed_attempts):
+            raise TooManyFailedAttemptsError(
+                "too many failed attempts, try again later")
+
+    async def register_failure(self, identity: str, ip: Union[str, None] = None):
+        async with self.cache.pipeline() as pipeline:
+            pipeline.add_event(self.__identity_key(identity), self.window)
+            if ip:
+                pipeline.add_event(self.__ip_key(ip), self.window)
+
+    async def reset(self, identity: str):
+        await self.cache.delete(self.__identity_key(identity))
@@ -1,12 +1,26 @@
 import asyncio
 import json
 import uuid
-from typing import MutableMapping
+from typing import List, MutableMapping, Set, Tuple, Union
 
 from aio_pika import Message, connect_robust
 from aio_pika.abc import (
     AbstractChannel, AbstractConnection, AbstractIncomingMessage, AbstractQueue)
 from app.core.config import settings
+from app.core.errors import MyException
+from app.core.logging import logger
+
+
+class RpcTimeoutError(MyException):
+    pass
+
+
+class InvalidRpcResponseError(MyException):
+    pass
+
+
+class RpcClientClosedError(MyException):
+    pass
 
 
 class AuthenticationRpcClient:
@@ -15,9 +29,27 @@ class AuthenticationRpcClient:
     callback_queue: AbstractQueue
     loop: asyncio.AbstractEventLoop
 
-    def __init__(self) -> None:
+    def __init__(self,
+                 routing_key: str = "auth_srv",
+                 timeout: float = settings.rabbitmq.rpc_timeout,
+                 max_in_flight: int = settings.rabbitmq.rpc_max_in_flight,
+                 batch_window: float = settings.rabbitmq.rpc_batch_window,
+                 max_batch_size: int = settings.rabbitmq.rpc_max_batch_size
+                 ) -> None:
         self.futures: MutableMapping[str, asyncio.Future] = {}
         self.loop = asyncio.get_running_loop()
+        self.routing_key = routing_key
+        self.timeout = timeout
+        # Callers wait here once max_in_flight requests are pending
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.batch: List[Tuple[str, asyncio.Future]] = []
+        self.batch_timer: Union[asyncio.TimerHandle, None] = None
+        # Referenced until done so they aren't garbage collected mid-flight
+        self.batch_tasks: Set[asyncio.Task] = set()
+        self.closed = False
 
     async def connect(self) -> "AuthenticationRpcClient":
         self.connection = await connect_robust(
@@ -29,40 +61,174 @@ class AuthenticationRpcClient:
         )
         self.channel = await self.connection.channel()
         self.callback_queue = await self.channel.declare_queue(exclusive=True)
-        await self.callback_queue.consume(self.on_response)
+        await self.callback_queue.consume(self.on_response, no_ack=True)
 
         return self
 
+    @property
+    def is_closed(self) -> bool:
+        return self.closed or self.connection.is_closed
+
     def on_response(self, message: AbstractIncomingMessage) -> None:
         if message.correlation_id is None:
-            print(f"Bad message {message!r}")
+            logger.warning(f"Bad message {message!r}")
             return
 
-        future: asyncio.Future = self.futures.pop(message.correlation_id)
-        future.set_result(message.body)
+        future = self.futures.pop(message.correlation_id, None)
+        if future is None or future.done():
+            # The caller has already timed out
+            logger.warning(
+                f"Late reply for request {message.correlation_id}")
+            return
+        future.set_result(json.loads(message.body))
 
-    async def call(self, token: str):
-        correlation_id = str(uuid.uuid4())
-        future = self.loop.create_future()
+    def __error_if_closed(self):
+        if self.closed:
+            raise RpcClientClosedError("rpc client is closed")
 
-        self.futures[correlation_id] = future
+    async def call(self, request: dict) -> dict:
+        self.__error_if_closed()
+        async with self.in_flight:
+            correlation_id = str(uuid.uuid4())
+            future = self.loop.create_future()
 
-        await self.channel.default_exchange.publish(
-            Message(
-                str(token).encode(),
-                content_type="text/plain",
-                correlation_id=correlation_id,
-                reply_to=self.callback_queue.name,
-            ),
-            routing_key="rpc_queue",
-        )
+            self.futures[correlation_id] = future
+            try:
+                await self.channel.default_exchange.publish(
+                    Message(
+                        json.dumps(request).encode(),
+                        content_type="application/json",
+                        correlation_id=correlation_id,
+                        reply_to=self.callback_queue.name,
+                        expiration=self.timeout,
+                    ),
+                    routing_key=self.routing_key,
+                )
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                raise RpcTimeoutError(
+                    f"no reply for request {correlation_id} after {self.timeout}s")
+            finally:
+                self.futures.pop(correlation_id, None)
+
+    async def verify_many(self, tokens: List[str]) -> List[dict]:
+        """ Verifies all tokens in a single round trip, keeping their order. """
+        response = await self.call({
+            'service_name': 'jwt_batch_verification',
+            'type': 'Bearer',
+            'tokens': tokens
+        })
+        results = response.get('message')
+        if not isinstance(results, list) or len(results) != len(tokens):
+            raise InvalidRpcResponseError(
+                f"invalid batch verification response: {response}")
+        return results
+
+    async def verify(self, token: str) -> dict:
+        """
+        Verifies one token. Tokens from concurrent callers are grouped
+        for up to batch_window seconds and sent with verify_many.
+        """
+        self.__error_if_closed()
+        future = self.loop.create_future()
+        self.batch.append((token, future))
+
+        if len(self.batch) >= self.max_batch_size:
+            self.__flush()
+        elif self.batch_timer is None:
+            self.batch_timer = self.loop.call_later(
+                self.batch_window, self.__flush)
         return await future
 
+    def __flush(self):
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+
+        batch, self.batch = self.batch, []
+        if batch:
+            task = self.loop.create_task(self.__send_batch(batch))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
 
-async def authenticate_rpc(token: str):
-    auth_rpc = await AuthenticationRpcClient().connect()
-    return await auth_rpc.call(json.dumps({
+    async def __send_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        try:
+            results = await self.verify_many([token for token, _ in batch])
+        except asyncio.CancelledError:
+            # Closed while the batch was pending
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        self.closed = True
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        for _, future in self.batch:
+            future.cancel()
+        self.batch.clear()
+
+        tasks = list(self.batch_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for future in self.futures.values():
+            if not future.done():
+                future.cancel()
+        self.futures.clear()
+        await self.connection.close()
+
+
+__client: Union[AuthenticationRpcClient, None] = None
+__client_lock: Union[asyncio.Lock, None] = None
+__client_loop: Union[asyncio.AbstractEventLoop, None] = None
+
+
+async def get_rpc_client() -> AuthenticationRpcClient:
+    """
+    Returns the rpc client shared by the running event loop, connecting on first use.
+    The client and its lock only work on the loop they were created on,
+    so another loop, e.g. of a later asyncio.run, gets a new client.
+    """
+    global __client, __client_lock, __client_loop
+    loop = asyncio.get_running_loop()
+    if __client_loop is not loop:
+        __client, __client_lock, __client_loop = None, asyncio.Lock(), loop
+
+    async with __client_lock:  # type: ignore
+        if __client is None or __client.is_closed:
+            __client = await AuthenticationRpcClient().connect()
+    return __client
+
+
+async def close_rpc_client():
+    global __client
+    if __client is not None:
+        await __client.close()
+        __client = None
+
+
+async def authenticate_rpc(token: str) -> dict:
+    auth_rpc = await get_rpc_client()
+    return await auth_rpc.call({
         'service_name': 'jwt_verification',
         'type': 'Bearer',
         'token': token
-    }))
+    })
+
+
+async def verify_rpc(token: str) -> dict:
+    """ Same as authenticate_rpc but batched with concurrent calls. """
+    auth_rpc = await get_rpc_client()
+    return await auth_rpc.verify(token)
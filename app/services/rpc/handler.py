@@ -1,6 +1,6 @@
 from pydantic import ValidationError
-from app.models.token import AccessTokenOut
-from app.services.token import verify_access_token
+from app.models.token import AccessTokenBatchIn, AccessTokenOut
+from app.services.token import verify_access_token, verify_access_tokens
 
 
 def call_service(request: dict) -> dict:
@@ -11,5 +11,14 @@ def call_service(request: dict) -> dict:
             return {'message': err.errors()}
 
         return {'message': verify_access_token(access_token)}
+    elif request.get('service_name') == 'jwt_batch_verification':
+        try:
+            batch = AccessTokenBatchIn(**request)
+        except ValidationError as err:
+            return {'message': err.errors()}
+
+        return {'message': [
+            result.dict() for result in verify_access_tokens(batch.tokens)
+        ]}
     else:
         return {'error': 'invalid service name'}
@@ -1,11 +1,22 @@
-from app.database import Database
-from app.cache import Cache
+from typing import Union
+from app.database import AsyncDatabase, AsyncMemoryDatabase, Database, MemoryDatabase, ThreadedDatabase
+from app.cache import AsyncCache, Cache, ThreadedCache
 from app.services.broker import Broker
 from app.services.verification import SMSNotification, SMSVerificationService
 from app.services.authentication import AuthService
 
 
-def authentication_factory(db: Database, cache: Cache, broker: Broker, notification: SMSNotification) -> AuthService:
+def authentication_factory(db: Union[Database, AsyncDatabase], cache: Union[Cache, AsyncCache], broker: Broker, notification: SMSNotification) -> AuthService:
+    """
+    Blocking databases and caches are moved off the event loop with ThreadedDatabase and ThreadedCache,
+    MemoryDatabase never blocks and is called directly.
+    """
+    if isinstance(db, MemoryDatabase):
+        db = AsyncMemoryDatabase(db)
+    elif isinstance(db, Database):
+        db = ThreadedDatabase(db)
+    if isinstance(cache, Cache):
+        cache = ThreadedCache(cache)
     return AuthService(
         broker=broker,
         db=db,
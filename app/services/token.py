@@ -1,10 +1,15 @@
+import hashlib
+import threading
+from collections import OrderedDict
 from datetime import timedelta, datetime
+from typing import List, Union
 
 from pydantic import ValidationError
 from app.core.config import settings
+from app.core.keys import KeyRing, UnknownKeyError
 from app.core.serializer import JsonSerializer
 from app.models.user import User
-from app.models.token import AccessTokenOut, JwtPayload, JwtUser
+from app.models.token import AccessTokenOut, JwtPayload, JwtUser, TokenVerificationOut
 import jwt
 
 from app.models.base import PlatformSpecificationOut
@@ -30,27 +35,128 @@ def calculate_expiration_time() -> datetime:
     return datetime.utcnow() + timedelta(minutes=settings.access_token_expire_time)
 
 
+class VerifiedTokenCache:
+    """
+    Bounded LRU of already verified tokens, keyed by the token digest.
+    An entry is dropped once the token itself expires.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.tokens: "OrderedDict[str, JwtPayload]" = OrderedDict()
+        # decode_access_token is also called from the rpc consumer threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Union[JwtPayload, None]:
+        key = self.digest(token)
+        with self.lock:
+            payload = self.tokens.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            if check_token_expiration(payload.expiration):
+                del self.tokens[key]
+                self.misses += 1
+                return None
+
+            self.tokens.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def set(self, token: str, payload: JwtPayload):
+        if self.max_size <= 0:
+            return
+        key = self.digest(token)
+        with self.lock:
+            self.tokens[key] = payload
+            self.tokens.move_to_end(key)
+            while len(self.tokens) > self.max_size:
+                self.tokens.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.tokens.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'size': len(self.tokens),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+token_cache = VerifiedTokenCache(settings.token_cache_size)
+
+
+def load_key_ring() -> Union[KeyRing, None]:
+    """ Returns None when tokens are signed with the shared secret key. """
+    if settings.algorithm.startswith('HS'):
+        return None
+    if not settings.jwt_keys:
+        raise ValueError(f"jwt_keys is required for {settings.algorithm}")
+    return KeyRing.from_directory(
+        settings.jwt_keys.directory,
+        settings.algorithm,
+        settings.jwt_keys.active_kid
+    )
+
+
+key_ring = load_key_ring()
+
+
 def encode_access_token(data: JwtPayload) -> str:
-    encoded_jwt = jwt.encode(
-        data.dict(),
-        settings.secret_key,
-        algorithm=settings.algorithm,
-        json_encoder=JsonSerializer)
+    if key_ring:
+        encoded_jwt = jwt.encode(
+            data.dict(),
+            key_ring.signing_key,
+            algorithm=settings.algorithm,
+            headers={'kid': key_ring.active_kid},
+            json_encoder=JsonSerializer)
+    else:
+        encoded_jwt = jwt.encode(
+            data.dict(),
+            settings.secret_key,
+            algorithm=settings.algorithm,
+            json_encoder=JsonSerializer)
     return encoded_jwt
 
 
+def get_verification_key(token: str):
+    if not key_ring:
+        return settings.secret_key
+    return key_ring.get_verification_key(
+        jwt.get_unverified_header(token).get('kid'))
+
+
 def decode_access_token(token: str) -> JwtPayload:
+    cached_payload = token_cache.get(token)
+    if cached_payload is not None:
+        return cached_payload
+
     try:
-        payload = jwt.decode(token, settings.secret_key, [settings.algorithm])
+        payload = jwt.decode(
+            token, get_verification_key(token), [settings.algorithm])
         jwt_payload = JwtPayload(**payload)
 
-    except jwt.InvalidSignatureError as v:
+    except (jwt.InvalidSignatureError, UnknownKeyError) as v:
         raise InvalidSignatureError(v)
     except ValidationError as v:
         raise InvalidJwtTokenError(v)
 
     if check_token_expiration(jwt_payload.expiration):
         raise ExpiredJwtTokenError()
+
+    token_cache.set(token, jwt_payload)
     return jwt_payload
 
 
@@ -78,3 +184,16 @@ def verify_access_token(access_token: AccessTokenOut) -> bool:
     except Exception:
         return False
     return True
+
+
+def verify_access_tokens(tokens: List[str]) -> List[TokenVerificationOut]:
+    """ Verifies tokens in order, returning a verdict for each one. """
+    results = []
+    for token in tokens:
+        try:
+            payload = decode_access_token(token)
+        except Exception:
+            results.append(TokenVerificationOut(valid=False, payload=None))
+        else:
+            results.append(TokenVerificationOut(valid=True, payload=payload))
+    return results
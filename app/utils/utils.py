@@ -1,5 +1,18 @@
+import asyncio
 from datetime import datetime, date
+from functools import partial
+from typing import Any, Callable
 
 
 def date_to_datetime(d: date) -> datetime:
     return datetime.fromisoformat(d.isoformat())
+
+
+async def run_in_thread(func: Callable, *args: Any, **kwargs: Any) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(
+        None, partial(func, *args, **kwargs))
+
+
+async def run_inline(func: Callable, *args: Any, **kwargs: Any) -> Any:
+    """ Drop-in for run_in_thread when func never blocks. """
+    return func(*args, **kwargs)
@@ -8,9 +8,14 @@ from fastapi.openapi.utils import get_openapi
 from app.services import get_srv
 from app.models.response import Message, StandardResponse
 from app.apis.router import router
+from app.apis.v1.jwks import router as jwks_router
 from app.services.rpc import call_service
+from app.services.rpc.client import close_rpc_client
 
 from app.core import errors
+from app.core.config import settings
+from app.core.security import password_hasher, PasswordHasherSaturatedError
+from app.services.lockout import TooManyFailedAttemptsError
 
 
 app = FastAPI(prefix="/api/v1")
@@ -23,6 +28,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 app.include_router(router)
+app.include_router(jwks_router)
 
 
 def custom_openapi():
@@ -53,12 +59,42 @@ def custom_openapi():
 app.openapi = custom_openapi
 
 
+background_tasks = []
+
+
+async def flush_database(interval: float):
+    """ Periodically writes buffered database updates. """
+    service = get_srv()
+    while True:
+        await asyncio.sleep(interval)
+        await service.database.flush()
+
+
 @app.on_event("startup")
-def startup():
+async def startup():
     service = get_srv()
+    await service.database.ensure_indexes()
+    await service.database.preload()
+    await service.cache.start()
     loop = asyncio.get_event_loop()
     asyncio.ensure_future(service.broker.consume(
         loop, 'auth_srv', call_service))
+    if settings.last_login_flush_interval > 0:
+        background_tasks.append(asyncio.ensure_future(
+            flush_database(settings.last_login_flush_interval)))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    service = get_srv()
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await service.database.flush()
+    await service.cache.stop()
+    await service.broker.close()
+    await close_rpc_client()
+    password_hasher.shutdown()
 
 
 @app.exception_handler(RequestValidationError)
@@ -85,3 +121,21 @@ async def custom_error_handler(request, exc: errors.MyException):
         content=StandardResponse(message=Message(en=str(exc), fa=None)).dict(),
         status_code=status.HTTP_400_BAD_REQUEST
     )
+
+
+@app.exception_handler(PasswordHasherSaturatedError)
+async def saturated_error_handler(request, exc: PasswordHasherSaturatedError):
+    return JSONResponse(
+        content=StandardResponse(message=Message(en=str(exc), fa=None)).dict(),
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={'Retry-After': '1'}
+    )
+
+
+@app.exception_handler(TooManyFailedAttemptsError)
+async def lockout_error_handler(request, exc: TooManyFailedAttemptsError):
+    return JSONResponse(
+        content=StandardResponse(message=Message(en=str(exc), fa=None)).dict(),
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={'Retry-After': str(settings.failed_attempt_window)}
+    )
@@ -1,36 +1,96 @@
 #!/usr/bin/python3
 
+import asyncio
+import os
+import sys
+from typing import Optional
+
 import uvicorn
 import typer
 import rich
+import rich.console
+import rich.table
 
 
 from app.services import (
-    RabbitMQ, authentication_factory,
+    RabbitMQ, UserImporter, authentication_factory,
     init_srv, MelipayamakSMSNotification, FakeSMSNotification)
-from app.database import MongoDatabase
-from app.cache import RedisCache
+from app.database import AsyncDatabase, AsyncMemoryDatabase, MongoDatabase, MotorDatabase, ThreadedDatabase
+from app.cache import AsyncCache, AsyncRedisCache, AsyncTieredCache, MemoryCache, PrincipalCache
 from app.core.config import settings
+from app.services.exporter import UserExporter, open_export, resume_point, write_checkpoint
+from app.services.importer import iter_file_lines
 from app.types.fields import PhoneNumberField, NationalCodeField
 
 
-service = authentication_factory(
-    db=MongoDatabase(
+def create_memory_cache() -> MemoryCache:
+    return MemoryCache(
+        max_entries=settings.memory_cache.max_entries,
+        max_bytes=settings.memory_cache.max_bytes,
+        sweep_interval=settings.memory_cache.sweep_interval
+    )
+
+
+def create_cache() -> AsyncCache:
+    """ REDIS__LOCAL_CACHE_TTL=0 disables the in-process tier. """
+    cache = AsyncRedisCache(
+        settings.redis.address.host,  # type: ignore
+        settings.redis.address.port,  # type: ignore
+        db=0,
+        password=settings.redis.password,  # type: ignore
+        max_connections=settings.redis.max_connections,
+        pool_timeout=settings.redis.pool_timeout
+    )
+    if settings.redis.local_cache_ttl <= 0:
+        return cache
+    return AsyncTieredCache(
+        cache,
+        create_memory_cache(),
+        local_ttl=settings.redis.local_cache_ttl,
+        channel=settings.redis.invalidation_channel,
+        # Verification codes are single use, so they're always read from redis
+        local_prefixes=(PrincipalCache.prefix,)
+    )
+
+
+def create_database(cache: AsyncCache) -> AsyncDatabase:
+    """ MONGODB__DRIVER picks the driver, users are cached by id in the shared cache. """
+    if settings.mongodb.driver == 'memory':
+        database = AsyncMemoryDatabase()
+        database.database.load_synthetic_users(settings.mongodb.synthetic_users)
+        return database
+
+    principals = PrincipalCache(cache, settings.principal_cache_ttl)
+    buffer_last_logins = settings.last_login_flush_interval > 0
+    if settings.mongodb.driver == 'motor':
+        return MotorDatabase(
+            settings.mongodb.uri,
+            settings.mongodb.database,
+            principals=principals,
+            role_registry_ttl=settings.role_registry_ttl,
+            buffer_last_logins=buffer_last_logins
+        )
+    return ThreadedDatabase(MongoDatabase(
         settings.mongodb.uri,
-        settings.mongodb.database
-    ),
+        settings.mongodb.database,
+        role_registry_ttl=settings.role_registry_ttl,
+        buffer_last_logins=buffer_last_logins
+    ), principals)
+
+
+cache = create_cache()
+service = authentication_factory(
+    db=create_database(cache),
     broker=RabbitMQ(
         settings.rabbitmq.address,
         settings.rabbitmq.port,
         settings.rabbitmq.username,
-        settings.rabbitmq.password
-    ),
-    cache=RedisCache(
-        settings.redis.address.host,  # type: ignore
-        settings.redis.address.port,  # type: ignore
-        db=0,
-        password=settings.redis.password  # type: ignore
+        settings.rabbitmq.password,
+        channel_pool_size=settings.rabbitmq.channel_pool_size,
+        prefetch_count=settings.rabbitmq.prefetch_count,
+        consumer_workers=settings.rabbitmq.consumer_workers
     ),
+    cache=cache,
     notification=FakeSMSNotification()
 )
 init_srv(service)
@@ -54,8 +114,127 @@ def run(host: str = "localhost", port: int = 8080, debug: bool = False):
 @cli.command()
 def get_users():
     console = rich.get_console()
+    users = asyncio.run(service.database.users.get_all())
+    console.print(list(map(lambda x: dict(x), users)))
+
+
+@cli.command()
+def export_users(
+    output: Optional[str] = typer.Option(
+        None, '--output', '-o', help="stdout when omitted, .gz files are compressed"),
+    format: str = typer.Option('ndjson', help="ndjson or csv"),
+    fields: Optional[str] = typer.Option(None, help="comma separated document fields"),
+    compress: bool = typer.Option(False, '--gzip'),
+    after: Optional[str] = typer.Option(None, help="only export users after this _id"),
+    resume: bool = typer.Option(False, help="append to output after its last exported user"),
+    user_type: Optional[str] = typer.Option(None, '--type'),
+    platform: Optional[str] = None,
+    role: Optional[str] = None
+):
+    """ Stream users into NDJSON or CSV with constant memory """
+    # stdout may be the export itself
+    console = rich.console.Console(stderr=True)
+    compress = compress or bool(output and output.endswith('.gz'))
+    try:
+        exporter = UserExporter(
+            service.database, format, fields.split(',') if fields else None)
+    except ValueError as exc:
+        raise typer.BadParameter(str(exc))
+
+    append, header = False, True
+    if resume:
+        if not output:
+            raise typer.BadParameter("--resume needs --output")
+        if os.path.exists(output):
+            previous = resume_point(output, format, compress)
+            if previous['format'] != format:
+                raise typer.BadParameter(f"{output} is a {previous['format']} export")
+            if format == 'csv' and previous['columns'] not in (None, exporter.columns):
+                raise typer.BadParameter(
+                    f"{output} has the columns {','.join(previous['columns'])}, "
+                    f"--fields would write {','.join(exporter.columns)}")
+            after = previous['last_id'] or after
+            # Kept in the checkpoint when nothing new is exported
+            exporter.last_id = after
+            append, header = True, previous['columns'] is None
+
+    try:
+        with open_export(output, compress, append, sys.stdout.buffer) as out:
+            asyncio.run(exporter.run(
+                out, after=after, header=header,
+                user_type=user_type, platform=platform, role=role))
+    except KeyboardInterrupt:
+        console.print(f"Interrupted after {exporter.count} users")
+        raise typer.Exit(1)
+    finally:
+        if exporter.last_id:
+            console.print(f"Last exported _id: {exporter.last_id}")
+            if output:
+                write_checkpoint(output, exporter)
+    console.print(f"[green]{exporter.count} users exported[/green]")
+
+
+@cli.command()
+def indexes(create: bool = False):
+    """ Show database indexes, --create builds the missing ones """
+    async def index_state():
+        # One event loop per command, motor stays bound to the loop it first ran on
+        if create:
+            await service.database.ensure_indexes()
+        return await service.database.index_state()
+
+    table = rich.table.Table("Collection", "Name", "Keys", "Unique", "Exists")
+    for index in asyncio.run(index_state()):
+        table.add_row(
+            index['collection'],
+            index['name'],
+            ', '.join(f'{k}: {v}' for k, v in index['keys'].items()),
+            str(index['unique']),
+            '[green]yes[/green]' if index['exists'] else '[red]no[/red]'
+        )
+    rich.get_console().print(table)
+
+
+@cli.command()
+def import_users(
+    file: typer.FileText,
+    format: str = typer.Option('csv', help="csv or ndjson"),
+    batch_size: int = 1000
+):
+    """ Bulk create users from a CSV or NDJSON file, see POST /users/import/ """
+    console = rich.get_console()
+    importer = UserImporter(service.database, batch_size=batch_size)
+
+    async def import_file():
+        # Duplicates are only rejected by the unique indexes
+        await service.database.ensure_indexes()
+        return await importer.run(iter_file_lines(file), format)
+
+    result = asyncio.run(import_file())
+
+    if result.errors:
+        table = rich.table.Table("Line", "Error")
+        for error in result.errors:
+            table.add_row(str(error.row), error.error)
+        console.print(table)
     console.print(
-        list(map(lambda x: dict(x), service.database.users.get_all())))
+        f"{result.total} rows, [green]{result.created} created[/green], "
+        f"[red]{result.failed} failed[/red]")
+
+
+@cli.command()
+def upgrade_users(batch_size: int = 1000):
+    """ Stamp users stored before the current schema version, so they load without validation """
+    console = rich.get_console()
+    upgraded, upgrade_errors = asyncio.run(service.database.users.upgrade_schema(batch_size))
+
+    if upgrade_errors:
+        table = rich.table.Table("User", "Error")
+        for user_id, error in upgrade_errors.items():
+            table.add_row(user_id, error)
+        console.print(table)
+    console.print(
+        f"[green]{upgraded} upgraded[/green], [red]{len(upgrade_errors)} invalid[/red]")
 
 
 @cli.command()
@@ -63,14 +242,24 @@ def create_admin():
     """ Create an admin user """
     console = rich.get_console()
     console.rule("Registration")
-    admin = service.create_admin(
-        national_code=NationalCodeField(
-            console.input("Enter national code: ")),
-        phone_number=PhoneNumberField(console.input("Enter phone number: ")),
-        first_name=console.input("Enter first name: "),
-        last_name=console.input("Enter last_name name: "),
-        password=console.input("Enter password: ", password=True)
-    )
+    national_code = NationalCodeField(console.input("Enter national code: "))
+    phone_number = PhoneNumberField(console.input("Enter phone number: "))
+    first_name = console.input("Enter first name: ")
+    last_name = console.input("Enter last_name name: ")
+    password = console.input("Enter password: ", password=True)
+
+    async def create():
+        # Duplicates are only rejected by the unique indexes
+        await service.database.ensure_indexes()
+        return await service.create_admin(
+            national_code=national_code,
+            phone_number=phone_number,
+            first_name=first_name,
+            last_name=last_name,
+            password=password
+        )
+
+    admin = asyncio.run(create())
 
     console.print(
         f"Welcome! {admin.first_name}, {admin.last_name}.")
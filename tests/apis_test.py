@@ -1,15 +1,17 @@
+import json
 from unittest import TestCase
 from fastapi.testclient import TestClient
 from fastapi import status
 
 from app.services import init_srv
+from app.database import MemoryDatabase
 from app.models.role import UserRole
 from app.web import app
 from app.apis.depends import get_current_admin_user
 from app.models.province import CityIn, City, Province, ProvinceIn
-from app.models.user import RealUser, LegalUser, RealUserCreationIn, LegalUserCreationIn, ProfileOut
+from app.models.user import RealUser, LegalUser, RealUserCreationIn, LegalUserCreationIn, ProfileOut, UserImportOut
 from app.models.response import StandardResponse
-from app.types.fields import NationalCodeField
+from app.types.fields import CompanyCodeField, NationalCodeField
 
 
 from tests.fake import fake_service, fake_admin
@@ -17,7 +19,8 @@ from tests.fake import fake_service, fake_admin
 
 class TestHealthAPIs(TestCase):
     def setUp(self) -> None:
-        self.srv = fake_service()
+        self.database = MemoryDatabase()
+        self.srv = fake_service(self.database)
         init_srv(self.srv)
 
         app.dependency_overrides[get_current_admin_user] = lambda: fake_admin()
@@ -31,6 +34,17 @@ class TestHealthAPIs(TestCase):
         res = self.client.get('api/v1/health/redis/')
         assert res.status_code == 200
 
+    def test_get_jwks(self):
+        res = self.client.get('.well-known/jwks.json')
+        assert res.status_code == 200
+        assert 'keys' in res.json()
+        assert 'max-age' in res.headers['cache-control']
+
+    def test_get_token_cache_stats(self):
+        res = self.client.get('api/v1/health/token-cache/')
+        assert res.status_code == 200
+        assert {'size', 'max_size', 'hits', 'misses'} <= res.json().keys()
+
     # def test_check_rabbitmq_connection(self):
     #     res = self.client.get('api/v1/health/rabbitmq/')
     #     assert res.status_code == 200
@@ -38,7 +52,8 @@ class TestHealthAPIs(TestCase):
 
 class TestInformationAPIs(TestCase):
     def setUp(self) -> None:
-        self.srv = fake_service()
+        self.database = MemoryDatabase()
+        self.srv = fake_service(self.database)
         init_srv(self.srv)
 
         app.dependency_overrides[get_current_admin_user] = lambda: fake_admin()
@@ -54,7 +69,7 @@ class TestInformationAPIs(TestCase):
                 City(name='test_city_3'),  # type: ignore
             ]
         )
-        p_db = self.srv.database.provinces.create(p)
+        p_db = self.database.provinces.create(p)
 
         res = self.client.get('api/v1/info/provinces/')
 
@@ -79,7 +94,8 @@ class TestInformationAPIs(TestCase):
 
 class TestUserAPIs(TestCase):
     def setUp(self) -> None:
-        self.srv = fake_service()
+        self.database = MemoryDatabase()
+        self.srv = fake_service(self.database)
         init_srv(self.srv)
 
         app.dependency_overrides[get_current_admin_user] = lambda: fake_admin()
@@ -104,7 +120,7 @@ class TestUserAPIs(TestCase):
         assert res.status_code == 200
         assert StandardResponse(**res.json()).message.en == 'user created'
 
-        assert self.srv.database.users.get_by_national_code(
+        assert self.database.users.get_by_national_code(
             NationalCodeField('1111111111'))
 
     def test_create_user_invalid_national_code(self):
@@ -196,10 +212,94 @@ class TestUserAPIs(TestCase):
             )
         ]
         for user in users:
-            self.srv.database.users.create(user)
+            self.database.users.create(user)
 
         res = self.client.get('api/v1/users/')
         assert res.status_code == status.HTTP_200_OK
         users_db = res.json()
         assert ProfileOut(**users_db[0]).real_user
         assert ProfileOut(**users_db[1]).legal_user
+
+    def create_real_users(self, count: int):
+        for i in range(count):
+            self.database.users.create(RealUser.new_user(
+                NationalCodeField(f'{i:010}'), f'{i:010}', 'first', 'last', 'password',
+                [UserRole(platform='platform.com', names=['role_name'])],
+                hashed_password='hashed'
+            ))
+
+    def test_get_users_paginated(self):
+        self.create_real_users(3)
+
+        res = self.client.get('api/v1/users/', params={'limit': 2})
+        assert res.status_code == status.HTTP_200_OK
+        assert len(res.json()) == 2
+
+        res = self.client.get('api/v1/users/', params={
+            'limit': 2, 'after': res.headers['X-Next-Cursor']})
+        assert len(res.json()) == 1
+        assert 'X-Next-Cursor' not in res.headers
+
+    def test_get_users_projected(self):
+        self.create_real_users(1)
+
+        res = self.client.get('api/v1/users/', params={'fields': 'phone_number'})
+        profile = ProfileOut(**res.json()[0])
+        assert profile.phone_number == '0000000000'
+        assert profile.real_user is None
+
+        res = self.client.get('api/v1/users/', params={'fields': 'password'})
+        assert res.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_get_users_filtered(self):
+        self.create_real_users(1)
+
+        res = self.client.get('api/v1/users/', params={'type': 'LEGAL'})
+        assert res.json() == []
+        res = self.client.get('api/v1/users/', params={
+            'platform': 'platform.com', 'role': 'other_role'})
+        assert res.json() == []
+        res = self.client.get('api/v1/users/', params={
+            'platform': 'platform.com', 'role': 'role_name'})
+        assert len(res.json()) == 1
+
+    def test_get_users_ndjson(self):
+        self.create_real_users(3)
+
+        res = self.client.get('api/v1/users/', params={'format': 'ndjson'})
+        assert res.status_code == status.HTTP_200_OK
+        lines = res.text.splitlines()
+        assert len(lines) == 3
+        assert ProfileOut.parse_raw(lines[0]).real_user
+
+    def test_import_users_csv(self):
+        body = '\n'.join([
+            'type,national_code,company_code,phone_number,first_name,last_name,company_name,domain,password,roles',
+            'REAL,0000000001,,0000000001,first,last,,,1234,platform.com:user|admin',
+            'LEGAL,,00000000001,0000000002,,,company,company-domain,1234,platform.com:user',
+            'REAL,1111,,0000000003,first,last,,,1234,platform.com:user',
+            'REAL,0000000001,,0000000004,first,last,,,1234,platform.com:user',
+        ])
+        res = self.client.post('api/v1/users/import/', data=body)
+        assert res.status_code == status.HTTP_200_OK
+        result = UserImportOut(**res.json())
+        assert (result.total, result.created, result.failed) == (4, 2, 2)
+        assert [e.row for e in result.errors] == [4, 5]
+        assert result.errors[0].error.startswith('national_code')
+
+        user = self.database.users.get_by_national_code(NationalCodeField('0000000001'))
+        assert user.roles[0].names == ['user', 'admin']
+        assert self.database.users.check_by_company_code(CompanyCodeField('00000000001'))
+
+    def test_import_users_ndjson(self):
+        body = '\n'.join([
+            json.dumps({'type': 'REAL', 'national_code': '0000000001', 'phone_number': '0000000001',
+                        'first_name': 'first', 'last_name': 'last', 'password': '1234',
+                        'roles': [{'platform': 'platform.com', 'names': ['user']}]}),
+            '{not json',
+            json.dumps({'type': 'UNKNOWN'}),
+        ])
+        res = self.client.post('api/v1/users/import/', params={'format': 'ndjson'}, data=body)
+        result = UserImportOut(**res.json())
+        assert (result.total, result.created, result.failed) == (3, 1, 2)
+        assert [e.row for e in result.errors] == [2, 3]
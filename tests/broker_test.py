@@ -1,7 +1,11 @@
+import asyncio
+import threading
+import time
 import unittest
 from app.services import RabbitMQ, Broker, MemoryBroker
 from app.services.broker import JsonSerializer, Message
 from app.core.config import settings
+from tests.fake import FakeBrokerChannel, FakeBrokerConnection, FakeIncomingMessage
 
 
 class TestSerializer(unittest.TestCase):
@@ -35,17 +39,94 @@ class TestMemoryBroker(unittest.IsolatedAsyncioTestCase):
         await self.broker.consume(None, queue_name='queue_name', on_message=self.process_message)
 
 
+class TestRabbitMQConsumer(unittest.IsolatedAsyncioTestCase):
+    """ Consumes from a fake queue, so no rabbitmq is needed. """
+
+    async def asyncSetUp(self):
+        self.broker = RabbitMQ('localhost', 5672, consumer_workers=4)
+        self.messages = [FakeIncomingMessage({'number': i}, f"request-{i}") for i in range(8)]
+        self.channel = FakeBrokerChannel(list(self.messages))
+        self.broker.connection = FakeBrokerConnection(self.channel)  # type: ignore
+
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    async def asyncTearDown(self):
+        await self.broker.close()
+
+    def slow_handler(self, message: dict) -> dict:
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.1)
+        with self.lock:
+            self.running -= 1
+        return {'number': message['number'] * 2}
+
+    async def wait_for_replies(self, count: int):
+        while len(self.channel.replies) < count:
+            await asyncio.sleep(0.01)
+
+    async def test_messages_are_handled_concurrently(self):
+        consumer = asyncio.create_task(
+            self.broker.consume(None, 'test_authentication', self.slow_handler))
+        started = time.monotonic()
+        await asyncio.wait_for(self.wait_for_replies(8), timeout=2)
+        elapsed = time.monotonic() - started
+
+        # 8 handlers of 0.1s on 4 workers take two rounds, not eight
+        assert self.max_running == 4
+        assert elapsed < 0.5
+        assert self.channel.prefetch_count == self.broker.prefetch_count
+        assert all(reply.routing_key == 'callback' for reply in self.channel.replies)
+        replies = {reply.correlation_id: reply.body for reply in self.channel.replies}
+        assert replies == {f"request-{i}": {'number': i * 2} for i in range(8)}
+        assert not consumer.done()
+
+    async def test_close_waits_for_in_flight_messages(self):
+        consumer = asyncio.create_task(
+            self.broker.consume(None, 'test_authentication', self.slow_handler))
+        await asyncio.sleep(0.05)
+
+        await self.broker.close()
+        assert consumer.done()
+        assert self.channel.iterator.closed
+        # The first batch was taken off the queue and is still answered
+        assert len(self.channel.replies) == 4
+        assert all(message.acked for message in self.messages[:4])
+        assert not any(message.acked for message in self.messages[5:])
+        assert self.broker.consumers == set() and self.broker.consumer_tasks == set()
+
+
 class TestRabbitMQBroker(unittest.IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
-        self.broker: Broker = RabbitMQ(
+        self.broker = RabbitMQ(
             settings.rabbitmq.address,
             settings.rabbitmq.port,
             settings.rabbitmq.username,
             settings.rabbitmq.password
         )
 
+    async def asyncTearDown(self):
+        await self.broker.close()
+
     async def test_publish_message(self):
         await self.broker.publish(
             queue_name='test_authentication',
             message=Message({'message': 'test'})
         )
+
+    async def test_publish_reuses_connection(self):
+        await self.broker.publish(
+            queue_name='test_authentication',
+            message=Message({'message': 'test'})
+        )
+        connection = self.broker.connection
+
+        await self.broker.publish(
+            queue_name='test_authentication',
+            message=Message({'message': 'test'})
+        )
+        assert self.broker.connection is connection
+        assert 'test_authentication' in self.broker.declared_queues
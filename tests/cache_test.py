@@ -1,5 +1,10 @@
-from unittest import TestCase
-from app.cache import MemoryCache, RedisCache
+import asyncio
+import json
+import time
+from datetime import datetime
+from unittest import IsolatedAsyncioTestCase, TestCase
+from bson import ObjectId
+from app.cache import AsyncRedisCache, AsyncTieredCache, MemoryCache, RedisCache, PrincipalCache, ThreadedCache
 
 
 class TestMemoryCache(TestCase):
@@ -47,6 +52,187 @@ class TestMemoryCache(TestCase):
         self.cache.delete('key1')
         assert self.cache.has('key1') is False
 
+    def test_add_event(self):
+        assert self.cache.add_event('events', 10) == 1
+        assert self.cache.add_event('events', 10) == 2
+        assert self.cache.count_events('events', 10) == 2
+
+    def test_events_out_of_window(self):
+        self.cache.add_event('events', 0.01)
+        time.sleep(0.02)
+
+        assert self.cache.count_events('events', 0.01) == 0
+        assert self.cache.add_event('events', 0.01) == 1
+
+    def test_expired_key(self):
+        self.cache.set('key1', {'test': 'test'}, 0.01)
+        time.sleep(0.02)
+
+        assert self.cache.get('key1') is None
+        assert self.cache.has('key1') is False
+        assert self.cache.stats()['expirations'] == 1
+
+    def test_set_without_ttl_never_expires(self):
+        self.cache.set('key1', {'test': 'test'})
+        assert self.cache.sweep() == 0
+        assert self.cache.get('key1') == {'test': 'test'}
+
+    def test_sweep(self):
+        self.cache.set('key1', {'test': 'test'}, 0.01)
+        self.cache.set('key2', {'test': 'test'}, 10)
+        time.sleep(0.02)
+
+        assert self.cache.sweep() == 1
+        assert self.cache.stats()['size'] == 1
+
+    def test_background_sweep(self):
+        cache = MemoryCache(sweep_interval=0.01)
+        cache.set('key', {'key': 'value'}, ttl=0.01)
+        cache.start()
+        try:
+            time.sleep(0.1)
+            assert cache.stats()['expirations'] == 1
+            assert cache.stats()['size'] == 0
+        finally:
+            cache.stop()
+        assert cache.sweeper is None
+
+    def test_least_recently_used_is_evicted(self):
+        cache = MemoryCache(max_entries=2)
+        cache.set('key1', {'test': 'test'}, 10)
+        cache.set('key2', {'test': 'test'}, 10)
+        cache.get('key1')
+        cache.set('key3', {'test': 'test'}, 10)
+
+        assert cache.has('key1') is True
+        assert cache.has('key2') is False
+        assert cache.stats()['evictions'] == 1
+
+    def test_byte_budget(self):
+        value = {'test': 'x' * 10}
+        size = len(json.dumps(value))
+        cache = MemoryCache(max_bytes=size * 2)
+        for key in ('key1', 'key2', 'key3'):
+            cache.set(key, value, 10)
+
+        assert cache.stats()['bytes'] == size * 2
+        assert cache.has('key1') is False
+        cache.set('key4', {'test': 'x' * size * 2}, 10)
+        assert cache.has('key4') is False
+
+    def test_hit_miss_stats(self):
+        self.cache.set('key1', {'test': 'test'}, 10)
+        self.cache.get('key1')
+        self.cache.get('key2')
+
+        stats = self.cache.stats()
+        assert (stats['hits'], stats['misses']) == (1, 1)
+
+
+    def test_many(self):
+        self.cache.set_many({'key1': {'test': 1}, 'key2': {'test': 2}}, 10)
+
+        assert self.cache.get_many(['key1', 'key2', 'key3']) == {
+            'key1': {'test': 1}, 'key2': {'test': 2}}
+        self.cache.delete_many(['key1', 'key2'])
+        assert self.cache.get_many(['key1', 'key2']) == {}
+
+    def test_pipeline(self):
+        self.cache.set('key1', {'test': 'test'}, 10)
+
+        with self.cache.pipeline() as pipeline:
+            pipeline.get('key1')
+            pipeline.delete('key1')
+            pipeline.has('key1')
+            pipeline.add_event('events', 10)
+
+        assert pipeline.results == [{'test': 'test'}, None, False, 1]
+        assert pipeline.written == ['key1']
+
+    def test_pipeline_is_not_executed_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.cache.pipeline() as pipeline:
+                pipeline.set('key1', {'test': 'test'}, 10)
+                raise ValueError()
+
+        assert self.cache.has('key1') is False
+
+class TestPrincipalCache(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.cache = PrincipalCache(ThreadedCache(MemoryCache()), ttl=10)
+
+    async def test_get_cached_document(self):
+        document = {'_id': 'user_id', 'type': 'REAL'}
+        await self.cache.set('user_id', document)
+
+        assert await self.cache.get('user_id') == document
+
+    async def test_get_none_existent_document(self):
+        assert await self.cache.get('user_id') is None
+
+    async def test_invalidate(self):
+        await self.cache.set('user_id', {'_id': 'user_id'})
+        await self.cache.invalidate('user_id')
+
+        assert await self.cache.get('user_id') is None
+
+    async def test_expired_document(self):
+        self.cache.ttl = 0.01
+        await self.cache.set('user_id', {'_id': 'user_id'})
+        await asyncio.sleep(0.02)
+
+        assert await self.cache.get('user_id') is None
+
+    async def test_password_is_not_cached(self):
+        memory = MemoryCache()
+        cache = PrincipalCache(ThreadedCache(memory), ttl=10)
+        await cache.set('user_id', {'_id': 'user_id', 'password': 'hash'})
+
+        assert 'hash' not in memory.get('principal:user_id')['document']
+        assert await cache.get('user_id') == {'_id': 'user_id'}
+
+    async def test_byte_budget_with_bson_values(self):
+        cache = PrincipalCache(ThreadedCache(MemoryCache(max_bytes=10000)), ttl=10)
+        document = {'_id': ObjectId(), 'created_at': datetime.now().replace(microsecond=0)}
+        await cache.set('user_id', document)
+
+        assert await cache.get('user_id') == document
+
+
+class TestLocalTier(TestCase):
+    def setUp(self) -> None:
+        # Connections are only opened on first use
+        remote = AsyncRedisCache(host='localhost', port=6379, db=0, password="")
+        self.tier = AsyncTieredCache(remote, MemoryCache())
+        self.tier.on_message({'type': 'subscribe', 'data': 1})
+
+    def test_remote_value_is_cached(self):
+        self.tier.on_remote_value('key1', {'test': 'test'}, 10, self.tier.generation)
+
+        assert self.tier.local.get('key1') == {'test': 'test'}
+
+    def test_read_that_raced_an_invalidation_is_not_cached(self):
+        generation = self.tier.generation
+        self.tier.on_invalidation(b'other:key1')
+        self.tier.on_remote_value('key1', {'test': 'old'}, 10, generation)
+
+        assert self.tier.local.get('key1') is None
+
+    def test_keys_outside_local_prefixes_are_not_cached(self):
+        self.tier.local_prefixes = ('principal:',)
+        self.tier.on_remote_value('09123456789', {'code': '1234'}, 10, self.tier.generation)
+        self.tier.on_set({'09123456789': {'code': '1234'}, 'principal:1': {'_id': '1'}}, 10)
+
+        assert self.tier.local.get('09123456789') is None
+        assert self.tier.local.get('principal:1') == {'_id': '1'}
+        assert self.tier.get_local(['09123456789'])[1] == ['09123456789']
+
+    def test_own_invalidations_are_ignored(self):
+        generation = self.tier.generation
+        self.tier.on_invalidation(self.tier.invalidation(['key1']).encode())
+
+        assert self.tier.generation == generation
+
 
 class TestRedisCache(TestCase):
     def setUp(self) -> None:
@@ -96,3 +282,140 @@ class TestRedisCache(TestCase):
         assert self.cache.has('key1') is False
         self.cache.delete('key1')
         assert self.cache.has('key1') is False
+
+    def test_add_event(self):
+        self.cache.delete('events')
+        assert self.cache.add_event('events', 10) == 1
+        assert self.cache.add_event('events', 10) == 2
+        assert self.cache.count_events('events', 10) == 2
+
+
+    def test_many(self):
+        self.cache.set_many({'key1': {'test': 1}, 'key2': {'test': 2}}, 10)
+
+        assert self.cache.get_many(['key1', 'key2', 'key3']) == {
+            'key1': {'test': 1}, 'key2': {'test': 2}}
+        self.cache.delete_many(['key1', 'key2'])
+        assert self.cache.get_many(['key1', 'key2']) == {}
+
+    def test_has_empty_value(self):
+        self.cache.set('key1', {}, 10)
+
+        assert self.cache.has('key1') is True
+
+    def test_pipeline(self):
+        self.cache.delete('events')
+        self.cache.set('key1', {'test': 'test'}, 10)
+
+        with self.cache.pipeline() as pipeline:
+            pipeline.get('key1')
+            pipeline.delete('key1')
+            pipeline.has('key1')
+            pipeline.add_event('events', 10)
+            pipeline.count_events('events', 10)
+
+        assert pipeline.results == [{'test': 'test'}, None, False, 1, 1]
+
+class TestAsyncTieredCache(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.caches = [
+            AsyncTieredCache(
+                AsyncRedisCache(host='localhost', port=6379, db=0, password=""), MemoryCache())
+            for _ in range(2)
+        ]
+        for cache in self.caches:
+            await cache.start()
+        await self.wait_for(lambda: all(c.listening for c in self.caches))
+
+    async def asyncTearDown(self) -> None:
+        for cache in self.caches:
+            await cache.delete('key1')
+            await cache.stop()
+
+    async def wait_for(self, condition):
+        deadline = time.time() + 2
+        while not condition() and time.time() < deadline:
+            await asyncio.sleep(0.01)
+        assert condition()
+
+    async def test_get_is_served_locally(self):
+        first, second = self.caches
+        await first.set('key1', {'test': 'test'}, 10)
+        await self.wait_for(lambda: second.invalidations == 1)
+
+        assert await second.get('key1') == {'test': 'test'}
+        assert await second.get('key1') == {'test': 'test'}
+        assert second.stats()['remote_hits'] == 1
+        assert second.stats()['hits'] == 1
+
+    async def test_set_invalidates_other_workers(self):
+        first, second = self.caches
+        await first.set('key1', {'test': 'old'}, 10)
+        await self.wait_for(lambda: second.invalidations == 1)
+        await second.get('key1')
+
+        await first.set('key1', {'test': 'new'}, 10)
+
+        await self.wait_for(lambda: second.invalidations == 2)
+        assert await second.get('key1') == {'test': 'new'}
+
+    async def test_delete_invalidates_other_workers(self):
+        first, second = self.caches
+        await first.set('key1', {'test': 'test'}, 10)
+        await self.wait_for(lambda: second.invalidations == 1)
+        await second.get('key1')
+
+        await first.delete('key1')
+
+        await self.wait_for(lambda: second.invalidations == 2)
+        assert await second.get('key1') is None
+
+    async def test_local_entry_expires_with_redis(self):
+        first, second = self.caches
+        await first.set('key1', {'test': 'test'}, 0.1)
+        await self.wait_for(lambda: second.invalidations == 1)
+        await second.get('key1')
+        await asyncio.sleep(0.15)
+
+        assert await second.get('key1') is None
+
+
+class TestAsyncRedisCache(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.cache = AsyncRedisCache(
+            host='localhost', port=6379, db=0, password="", max_connections=2)
+
+    async def asyncTearDown(self) -> None:
+        await self.cache.delete('key1')
+        await self.cache.stop()
+
+    async def test_ping(self):
+        assert await self.cache.ping() is True
+
+    async def test_get_with_existent_key(self):
+        await self.cache.set('key1', {'test': 'test'}, 10)
+
+        assert await self.cache.get('key1') == {'test': 'test'}
+        assert await self.cache.has('key1') is True
+
+    async def test_get_with_none_existent_key(self):
+        assert await self.cache.get('key1') is None
+        assert await self.cache.has('key1') is False
+
+    async def test_expired_key(self):
+        await self.cache.set('key1', {'test': 'test'}, 0.05)
+        await asyncio.sleep(0.1)
+
+        assert await self.cache.get('key1') is None
+
+    async def test_concurrent_calls_share_the_pool(self):
+        await self.cache.set('key1', {'test': 'test'}, 10)
+
+        values = await asyncio.gather(*(self.cache.get('key1') for _ in range(10)))
+        assert values == [{'test': 'test'}] * 10
+
+    async def test_add_event(self):
+        await self.cache.delete('events')
+        assert await self.cache.add_event('events', 10) == 1
+        assert await self.cache.add_event('events', 10) == 2
+        assert await self.cache.count_events('events', 10) == 2
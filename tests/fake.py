@@ -1,9 +1,15 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from typing import Callable, List, Union
 from app.models.user import RealUser, UserRole
 from app.services.token import get_access_token
 from app.cache import MemoryCache
 from app.database import MemoryDatabase
 from app.services import AuthService, FakeSMSNotification, MemoryBroker
 from app.services import authentication_factory
+from app.services.rpc.client import AuthenticationRpcClient
 from app.types.fields import NationalCodeField, PhoneNumberField
 
 
@@ -11,9 +17,9 @@ def get_admin_token(admin: RealUser) -> str:
     return get_access_token(admin, '*', 'admin')
 
 
-def fake_service() -> AuthService:
+def fake_service(database: Union[MemoryDatabase, None] = None) -> AuthService:
     return authentication_factory(
-        db=MemoryDatabase(),
+        db=database or MemoryDatabase(),
         cache=MemoryCache(),
         broker=MemoryBroker(delay=3),
         notification=FakeSMSNotification(),
@@ -29,3 +35,118 @@ def fake_admin() -> RealUser:
         plain_password='test',
         roles=[UserRole(platform='test.com', names=['admin'])]
     )
+
+
+class FakeRpcExchange:
+    """
+    Stands in for the default exchange of an rpc client, publish replies with
+    responder(request) after delay seconds. Requests answered with None get no reply.
+    """
+
+    def __init__(self,
+                 client: AuthenticationRpcClient,
+                 responder: Callable[[dict], Union[dict, None]],
+                 delay: float = 0) -> None:
+        self.client = client
+        self.responder = responder
+        self.delay = delay
+        self.published: List[dict] = []
+
+    async def publish(self, message, routing_key: str):
+        request = json.loads(message.body)
+        self.published.append(request)
+        asyncio.get_running_loop().call_later(
+            self.delay, self.reply, message.correlation_id, request)
+
+    def reply(self, correlation_id: str, request: dict):
+        response = self.responder(request)
+        if response is not None:
+            self.client.on_response(SimpleNamespace(  # type: ignore
+                correlation_id=correlation_id, body=json.dumps(response).encode()))
+
+
+class FakeRpcConnection:
+    is_closed = False
+
+    async def close(self):
+        self.is_closed = True
+
+
+def fake_rpc_client(responder: Callable[[dict], Union[dict, None]],
+                    delay: float = 0,
+                    **kwargs) -> AuthenticationRpcClient:
+    """ Rpc client answered by a FakeRpcExchange, must be created on the running loop. """
+    client = AuthenticationRpcClient(**kwargs)
+    client.connection = FakeRpcConnection()  # type: ignore
+    client.channel = SimpleNamespace(  # type: ignore
+        default_exchange=FakeRpcExchange(client, responder, delay))
+    client.callback_queue = SimpleNamespace(name='callback')  # type: ignore
+    return client
+
+
+class FakeIncomingMessage:
+    """ Request delivered by a FakeQueue, acked once processed. """
+
+    def __init__(self, body: dict, correlation_id: str, reply_to: str = 'callback') -> None:
+        self.body = json.dumps(body).encode()
+        self.correlation_id = correlation_id
+        self.reply_to = reply_to
+        self.content_type = 'application/json'
+        self.acked = False
+
+    @asynccontextmanager
+    async def process(self, requeue: bool = False):
+        yield
+        self.acked = True
+
+
+class FakeQueueIterator:
+    """ Yields the queued messages, then waits for more like a real consumer. """
+
+    def __init__(self, messages: List[FakeIncomingMessage]) -> None:
+        self.messages = messages
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        self.closed = True
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> FakeIncomingMessage:
+        if self.messages:
+            return self.messages.pop(0)
+        await asyncio.Event().wait()
+        raise StopAsyncIteration
+
+
+class FakeBrokerChannel:
+    """ Channel whose queue holds messages and whose default exchange records replies. """
+
+    def __init__(self, messages: List[FakeIncomingMessage]) -> None:
+        self.iterator = FakeQueueIterator(messages)
+        self.replies: List[SimpleNamespace] = []
+        self.default_exchange = self
+
+    async def set_qos(self, prefetch_count: int):
+        self.prefetch_count = prefetch_count
+
+    async def declare_queue(self, queue_name: str):
+        return SimpleNamespace(iterator=lambda: self.iterator)
+
+    async def publish(self, message, routing_key: str):
+        self.replies.append(SimpleNamespace(
+            correlation_id=message.correlation_id,
+            routing_key=routing_key,
+            body=json.loads(message.body)))
+
+
+class FakeBrokerConnection(FakeRpcConnection):
+    def __init__(self, channel: FakeBrokerChannel) -> None:
+        self.fake_channel = channel
+
+    async def channel(self) -> FakeBrokerChannel:
+        return self.fake_channel
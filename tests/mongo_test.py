@@ -1,11 +1,17 @@
-from unittest import TestCase
-from app.database import MongoDatabase, MemoryDatabase, errors
+import asyncio
+from unittest import IsolatedAsyncioTestCase, TestCase, mock
+from app.cache import MemoryCache, PrincipalCache, ThreadedCache
+from app.database import (
+    AsyncMemoryDatabase, MongoDatabase, MotorDatabase, MemoryDatabase, ThreadedDatabase, errors)
+from app.database.memory import synthetic_users
+from app.database.mongo import OUTDATED_USERS, document_to_user
 from app.models.province import Province, City
 from app.models.role import Role, UserRole
-from app.models.user import RealUser, LegalUser
+from app.models.user import RealUser, LegalUser, USER_SCHEMA_VERSION
 from app.models.profile import ContactInformation
 from bson import ObjectId
 from app.types.fields import ObjectIdField, NationalCodeField, PhoneNumberField, CompanyCodeField
+from tests.fake import fake_service
 
 
 class TestDatabaseProvinceCollection(TestCase):
@@ -71,9 +77,29 @@ class TestDatabaseProvinceCollection(TestCase):
         assert city == db_province.cities[0]
 
 
+class TestDatabaseIndexes(TestCase):
+    def setUp(self):
+        self.database = MongoDatabase("mongodb://localhost", "test_database")
+
+    def tearDown(self) -> None:
+        self.database.drop()
+
+    def test_ensure_indexes(self):
+        assert not any(i['exists'] for i in self.database.index_state())
+
+        self.database.ensure_indexes()
+        assert all(i['exists'] for i in self.database.index_state())
+
+    def test_ensure_indexes_is_idempotent(self):
+        self.database.ensure_indexes()
+        self.database.ensure_indexes()
+        assert all(i['exists'] for i in self.database.index_state())
+
+
 class TestDatabaseRoleCollection(TestCase):
     def setUp(self):
         self.database = MongoDatabase("mongodb://localhost", "test_database")
+        self.database.ensure_indexes()
 
     def tearDown(self) -> None:
         self.database.drop()
@@ -161,6 +187,7 @@ class TestDatabaseUserCollection(TestCase):
         self.database = MongoDatabase("mongodb://localhost", "test_database")
         # Raise error if database connection failed
         self.database.check_connection()
+        self.database.ensure_indexes()
 
         self.province = Province(
             _id=ObjectIdField(ObjectId()),
@@ -214,6 +241,24 @@ class TestDatabaseUserCollection(TestCase):
         except Exception as exc:
             assert isinstance(exc, errors.RoleDoesNotExist)
 
+    def test_create_real_user_with_newly_created_platform(self):
+        # Loads the role registry before the new platform exists
+        self.test_create_real_user_with_none_existent_platform()
+        self.database.roles.create(
+            Role(_id=ObjectIdField(ObjectId()), platform='new_platform', names=['staff']))
+
+        user = RealUser.new_user(
+            national_code=NationalCodeField('2' * 10),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('2' * 10),
+            plain_password='plain_password',
+            roles=[
+                UserRole(platform='new_platform', names=['staff'])
+            ],
+        )
+        assert self.database.users.create(user).id
+
     def test_create_real_user_with_invalid_province(self):
         user = RealUser.new_user(
             national_code=NationalCodeField('1' * 10),
@@ -234,6 +279,22 @@ class TestDatabaseUserCollection(TestCase):
         except Exception as exc:
             assert isinstance(exc, errors.CityDoesNotExist)
 
+    def test_create_real_user_with_valid_city(self):
+        user = RealUser.new_user(
+            national_code=NationalCodeField('1' * 10),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1' * 10),
+            plain_password='plain_password',
+            roles=[
+                UserRole(platform='*', names=['admin'])
+            ],
+        )
+        user.contact_information = ContactInformation(
+            city_id=self.province.cities[0].id)  # type: ignore
+
+        assert self.database.users.create(user).id
+
     def test_create_already_exist_real_user(self):
         user = RealUser.new_user(
             national_code=NationalCodeField('1' * 10),
@@ -410,3 +471,343 @@ class TestDatabaseUserCollection(TestCase):
         self.database.users.update_last_login(user)
         db_user = self.database.users.get_by_id(str(user.id))
         assert db_user.last_login > user.last_login
+
+    def test_update_only_changed_fields(self):
+        user = RealUser.new_user(
+            national_code=NationalCodeField('1' * 10),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1' * 10),
+            plain_password='plain_password',
+            roles=[
+                UserRole(platform='*', names=['admin'])
+            ],
+        )
+        self.database.users.create(user)
+        db_user = self.database.users.get_by_id(str(user.id))
+        assert db_user.get_changes() == {}
+
+        db_user.phone_number = PhoneNumberField('2' * 10)
+        assert db_user.get_changes() == {'phone_number': '2' * 10}
+
+        # A concurrent change to another field must survive the update
+        self.database.users.collection.update_one(
+            {'_id': user.id}, {'$set': {'first_name': 'changed'}})
+        self.database.users.update(db_user)
+
+        db_user = self.database.users.get_by_id(str(user.id))
+        assert db_user.phone_number == '2' * 10
+        assert db_user.first_name == 'changed'
+
+    def test_buffered_update_last_login(self):
+        database = MongoDatabase(
+            "mongodb://localhost", "test_database", buffer_last_logins=True)
+        user = LegalUser.new_user(
+            company_code=CompanyCodeField('1' * 11),
+            phone_number=PhoneNumberField('1' * 10),
+            company_name='test',
+            domain='test',
+            plain_password='plain_password',
+            roles=[
+                UserRole(platform='*', names=['admin'])
+            ],
+        )
+        database.users.create(user)
+        database.users.update_last_login(user)
+        database.users.update_last_login(user)
+        assert database.users.get_by_id(str(user.id)).last_login == user.last_login
+
+        assert database.users.last_logins.flush(database.users.collection) == 1
+        assert database.users.get_by_id(str(user.id)).last_login > user.last_login
+
+    def test_get_user_without_schema_version(self):
+        user = RealUser.new_user(
+            national_code=NationalCodeField('1' * 10),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1' * 10),
+            plain_password='plain_password',
+            roles=[
+                UserRole(platform='*', names=['admin'])
+            ],
+        )
+        self.database.users.create(user)
+        db_user = self.database.users.get_by_id(str(user.id))
+        assert db_user == user
+
+        # Older documents are validated instead of trusted
+        self.database.users.collection.update_one(
+            {'_id': user.id}, {'$unset': {'schema_version': ''}})
+        db_user = self.database.users.get_by_national_code(user.national_code)
+        assert db_user.schema_version is None
+        assert isinstance(db_user.roles[0], UserRole)
+
+        assert self.database.users.upgrade_schema() == (1, {})
+        assert self.database.users.get_by_id(str(user.id)).schema_version == USER_SCHEMA_VERSION
+
+    def test_upgrade_schema_skips_invalid_users(self):
+        self.database.users.collection.insert_one({'_id': ObjectId(), 'type': 'REAL'})
+
+        upgraded, errors = self.database.users.upgrade_schema()
+        assert upgraded == 0 and len(errors) == 1
+        assert self.database.users.collection.count_documents(OUTDATED_USERS) == 1
+
+
+class TestMotorDatabase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.database = MotorDatabase("mongodb://localhost", "test_database")
+        await self.database.check_connection()
+        await self.database.ensure_indexes()
+
+        self.city = City(_id=ObjectIdField(ObjectId()), name='c11')
+        await self.database.provinces.create(Province(
+            _id=ObjectIdField(ObjectId()),
+            name='p1',
+            cities=[self.city, City(_id=ObjectIdField(ObjectId()), name='c12')]
+        ))
+        await self.database.roles.create(
+            Role(_id=ObjectIdField(ObjectId()), platform="*", names=['admin']))
+
+    async def asyncTearDown(self) -> None:
+        await self.database.drop()
+
+    async def test_get_by_city_id(self):
+        province = await self.database.provinces.get_by_city_id(str(self.city.id))
+        assert province.cities == [self.city]
+
+    async def test_create_and_get_user(self):
+        user = RealUser.new_user(
+            national_code=NationalCodeField('1' * 10),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1' * 10),
+            plain_password='plain_password',
+            roles=[
+                UserRole(platform='*', names=['admin'])
+            ],
+        )
+        await self.database.users.create(user)
+        assert await self.database.users.get_by_id(str(user.id)) == user
+        assert await self.database.users.check_by_national_code(user.national_code)
+
+        try:
+            await self.database.users.create(user.copy(update={'id': None}))
+            assert False
+        except Exception as exc:
+            assert isinstance(exc, errors.UserAlreadyExist)
+
+    async def test_create_user_with_none_existent_role(self):
+        user = RealUser.new_user(
+            national_code=NationalCodeField('1' * 10),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1' * 10),
+            plain_password='plain_password',
+            roles=[
+                UserRole(platform='*', names=['staff'])
+            ],
+        )
+        try:
+            await self.database.users.create(user)
+            assert False
+        except Exception as exc:
+            assert isinstance(exc, errors.RoleDoesNotExist)
+
+    async def test_deleted_role_is_rejected(self):
+        await self.database.preload()
+        role = await self.database.roles.create(Role(platform='staff.com', names=['staff']))
+        user = RealUser.new_user(
+            national_code=NationalCodeField('1' * 10),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1' * 10),
+            plain_password='plain_password',
+            roles=[
+                UserRole(platform='staff.com', names=['staff'])
+            ],
+        )
+        await self.database.roles.delete_by_id(str(role.id))
+        try:
+            await self.database.users.create(user)
+            assert False
+        except Exception as exc:
+            assert isinstance(exc, errors.RoleDoesNotExist)
+
+    async def test_get_by_city_id_of_new_province(self):
+        await self.database.preload()
+        city = City(_id=ObjectIdField(ObjectId()), name='c21')
+        await self.database.provinces.create(Province(
+            _id=ObjectIdField(ObjectId()), name='p2', cities=[city]))
+
+        province = await self.database.provinces.get_by_city_id(str(city.id))
+        assert province.name == 'p2'
+        assert province.cities == [city]
+
+
+class TestMemoryDatabase(TestCase):
+    def setUp(self):
+        self.database = MemoryDatabase()
+        self.user = RealUser.new_user(
+            national_code=NationalCodeField('1' * 10),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1' * 10),
+            plain_password='plain_password',
+            roles=[UserRole(platform='*', names=['admin'])],
+            hashed_password='hashed'
+        )
+        self.database.users.create(self.user)
+
+    def test_user_from_document_without_schema_version(self):
+        document = self.user.dict(by_alias=True, exclude={'schema_version'})
+        document['roles'] = [{'platform': '*', 'names': ['admin']}]
+
+        user = document_to_user(document)
+        # Validated, so nested documents become models
+        assert isinstance(user.roles[0], UserRole)
+        assert user.schema_version is None
+        assert user.get_changes() == {}
+
+    def test_upgrade_schema(self):
+        self.user.schema_version = None
+
+        assert self.database.users.upgrade_schema() == (1, {})
+        assert self.user.schema_version == USER_SCHEMA_VERSION
+        assert self.database.users.upgrade_schema() == (0, {})
+
+    def test_get_user_by_indexes(self):
+        assert self.database.users.get_by_id(str(self.user.id)) is self.user
+        assert self.database.users.get_by_national_code(
+            NationalCodeField('1' * 10)) is self.user
+        assert self.database.users.check_by_national_code(NationalCodeField('1' * 10))
+        assert not self.database.users.check_by_national_code(NationalCodeField('2' * 10))
+
+        try:
+            self.database.users.get_by_id('invalid')
+            assert False
+        except Exception as exc:
+            assert isinstance(exc, errors.UserDoesNotExist)
+
+    def test_create_duplicate_user(self):
+        try:
+            self.database.users.create(self.user.copy())
+            assert False
+        except Exception as exc:
+            assert isinstance(exc, errors.UserAlreadyExist)
+
+    def test_create_duplicate_role(self):
+        self.database.roles.create(Role(platform='*', names=['admin']))
+        try:
+            self.database.roles.create(Role(platform='*', names=['staff']))
+            assert False
+        except Exception as exc:
+            assert isinstance(exc, errors.RoleAlreadyExist)
+
+    def test_delete_role(self):
+        roles = [self.database.roles.create(Role(platform=p, names=['admin']))
+                 for p in ('a', 'b', 'c')]
+        self.database.roles.delete_by_id(str(roles[1].id))
+
+        assert self.database.roles.get_all() == [roles[0], roles[2]]
+        try:
+            self.database.roles.delete_by_id(str(roles[1].id))
+            assert False
+        except Exception as exc:
+            assert isinstance(exc, errors.RoleDoesNotExist)
+
+    def test_load_synthetic_users(self):
+        assert self.database.load_synthetic_users(1000) == 1000
+        # Numbering continues after the existing user
+        user = self.database.users.get_by_national_code(NationalCodeField('0000000999'))
+        assert user.has_role('load.test', 'user')
+
+        page = list(self.database.users.find(after=str(user.id)))
+        assert [d['national_code'] for d in page] == ['0000001000']
+
+    def test_find_with_wrapped_object_id_counter(self):
+        # The counter wrapped, later ids sort before earlier ones
+        ids = [ObjectId('0' * 23 + str(i)) for i in (5, 3, 4)]
+        with mock.patch('app.database.memory.ObjectId',
+                        side_effect=lambda *args: ObjectId(*args) if args else ids.pop(0)):
+            self.database.users.bulk_create(synthetic_users(3, 'hashed', []))
+
+        documents = list(self.database.users.find())
+        assert [d['_id'] for d in documents] == sorted(d['_id'] for d in documents)
+        page = list(self.database.users.find(after=str(documents[0]['_id']), limit=2))
+        assert [d['_id'] for d in page] == [d['_id'] for d in documents[1:3]]
+
+    def test_update(self):
+        user = self.user.copy(update={'phone_number': '2' * 10})
+        self.database.users.update(user)
+
+        assert self.database.users.get_by_id(str(self.user.id)).phone_number == '2' * 10
+
+
+class TestAsyncMemoryDatabase(IsolatedAsyncioTestCase):
+    async def test_no_thread_hops(self):
+        database = AsyncMemoryDatabase()
+        user = RealUser.new_user(
+            national_code=NationalCodeField('1' * 10),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1' * 10),
+            plain_password='plain_password',
+            roles=[UserRole(platform='*', names=['admin'])],
+            hashed_password='hashed'
+        )
+
+        loop = asyncio.get_running_loop()
+        with mock.patch.object(loop, 'run_in_executor', side_effect=AssertionError):
+            await database.users.create(user)
+            assert await database.users.get_by_id(str(user.id)) is user
+            assert [d['_id'] async for d in database.users.find()] == [user.id]
+
+    def test_service_uses_memory_database_directly(self):
+        service = fake_service()
+        assert isinstance(service.database, AsyncMemoryDatabase)
+
+
+class TestThreadedDatabase(IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.memory = MemoryDatabase()
+        self.principals = PrincipalCache(ThreadedCache(MemoryCache()), ttl=10)
+        self.database = ThreadedDatabase(self.memory, self.principals)
+        self.user = RealUser.new_user(
+            national_code=NationalCodeField('1' * 10),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1' * 10),
+            plain_password='plain_password',
+            roles=[UserRole(platform='*', names=['admin'])],
+            hashed_password='hashed'
+        )
+        self.memory.users.create(self.user)
+
+    async def test_get_by_id_is_cached(self):
+        user = await self.database.users.get_by_id(str(self.user.id))
+        self.memory.users.clear()
+
+        cached = await self.database.users.get_by_id(str(self.user.id))
+        assert cached.dict(exclude={'password'}) == user.dict(exclude={'password'})
+        assert isinstance(cached.roles[0], UserRole)
+
+    async def test_cached_user_has_no_password(self):
+        await self.database.users.get_by_id(str(self.user.id))
+
+        assert 'password' not in await self.principals.get(str(self.user.id))
+        cached = await self.database.users.get_by_id(str(self.user.id))
+        assert cached.password == ''
+        assert cached.get_changes() == {}
+
+    async def test_create_invalidates_cached_user(self):
+        await self.principals.set(str(self.user.id), {'_id': self.user.id})
+        self.memory.users.clear()
+        await self.database.users.create(self.user)
+
+        assert await self.principals.get(str(self.user.id)) is None
+
+    async def test_update_invalidates_cached_user(self):
+        await self.database.users.get_by_id(str(self.user.id))
+        await self.database.users.update(self.user)
+
+        assert await self.principals.get(str(self.user.id)) is None
@@ -1,4 +1,15 @@
-from unittest import IsolatedAsyncioTestCase
+import asyncio
+import csv
+import gzip
+import json
+import tempfile
+from os import path
+from unittest import IsolatedAsyncioTestCase, TestCase, mock
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import (
+    Encoding, NoEncryption, PrivateFormat, PublicFormat)
 
 from app.models.auth import RealUserAuthenticationIn
 from app.models.verification import RealUserCodeVerificationIn, RealUserSendSMSCodeIn
@@ -6,21 +17,34 @@ from app.models.base import PlatformSpecificationIn
 from app.models.province import Province, City
 from app.models.role import Role, UserRole
 from app.models.user import RealUser, RealUserRegistrationIn
-from app.database import MemoryDatabase, errors
-from app.cache import MemoryCache
+from app.database import MemoryDatabase, ThreadedDatabase, errors
+from app.cache import MemoryCache, ThreadedCache
 from app.types.fields import NationalCodeField, ObjectId, ObjectIdField, PhoneNumberField, VerificationCodeField
 from app.services import MemoryBroker, FakeVerificationService
 from app.services.authentication import UnAuthorizedError, AuthService
+from app.services.lockout import TooManyFailedAttemptsError
 from app.services.verification import SMSVerificationService, VerificationCodeAlreadySendError, InvalidVerificationCodeError
 from app.services.notification import FakeSMSNotification, SMSNotification
+from app.core.keys import KeyRing, UnknownKeyError
+from app.core.security import PasswordHasher, PasswordHasherSaturatedError
+from app.services.broker import JsonSerializer
+from app.services.exporter import (
+    UserExporter, open_export, read_checkpoint, resume_point, scan_export, write_checkpoint)
+from app.services.rpc import call_service
+from app.services.rpc import client as rpc_client
+from app.services.rpc.client import (
+    AuthenticationRpcClient, RpcClientClosedError, RpcTimeoutError, close_rpc_client, get_rpc_client)
+from app.services.token import VerifiedTokenCache, decode_access_token, get_access_token, token_cache
+from tests.fake import FakeRpcConnection, fake_rpc_client
 
 
 class TestAuthService(IsolatedAsyncioTestCase):
     def setUp(self) -> None:
+        self.database = MemoryDatabase()
         self.service = AuthService(
             broker=MemoryBroker(delay=0.1),
-            db=MemoryDatabase(),
-            cache=MemoryCache(),
+            db=ThreadedDatabase(self.database),
+            cache=ThreadedCache(MemoryCache()),
             verification=FakeVerificationService()
         )
         self.province = Province(
@@ -31,21 +55,21 @@ class TestAuthService(IsolatedAsyncioTestCase):
                 City(_id=ObjectIdField(ObjectId()), name='c12')
             ]
         )
-        self.service.database.provinces.create(self.province)
+        self.database.provinces.create(self.province)
 
         role = Role(
             _id=ObjectIdField(ObjectId()),
             platform="*",
             names=['admin', 'staff']
         )
-        self.service.database.roles.create(role)
+        self.database.roles.create(role)
 
     def tearDown(self) -> None:
-        self.service.database.drop()
+        self.database.drop()
 
-    def test_authenticate_unknown_user(self):
+    async def test_authenticate_unknown_user(self):
         try:
-            self.service.authenticate(
+            await self.service.authenticate(
                 RealUserAuthenticationIn(
                     national_code=NationalCodeField('1111111111'),
                     password='test',
@@ -59,7 +83,7 @@ class TestAuthService(IsolatedAsyncioTestCase):
             assert isinstance(exc, UnAuthorizedError)
             assert str(exc) == "invalid credentials"
 
-    def test_authenticate_wrong_password(self):
+    async def test_authenticate_wrong_password(self):
         user = RealUser.new_user(
             national_code=NationalCodeField('1111111111'),
             first_name='first_name',
@@ -70,10 +94,10 @@ class TestAuthService(IsolatedAsyncioTestCase):
                 UserRole(platform='*', names=['admin'])
             ],
         )
-        self.service.database.users.create(user)
+        self.database.users.create(user)
 
         try:
-            self.service.authenticate(
+            await self.service.authenticate(
                 RealUserAuthenticationIn(
                     national_code=NationalCodeField(user.national_code),
                     password='test',
@@ -88,7 +112,7 @@ class TestAuthService(IsolatedAsyncioTestCase):
             assert isinstance(exc, UnAuthorizedError)
             assert str(exc) == "invalid credentials"
 
-    def test_authenticate_none_existent_platform(self):
+    async def test_authenticate_none_existent_platform(self):
         user = RealUser.new_user(
             national_code=NationalCodeField('1111111111'),
             first_name='first_name',
@@ -99,10 +123,10 @@ class TestAuthService(IsolatedAsyncioTestCase):
                 UserRole(platform='*', names=['admin'])
             ],
         )
-        self.service.database.users.create(user)
+        self.database.users.create(user)
 
         try:
-            self.service.authenticate(
+            await self.service.authenticate(
                 RealUserAuthenticationIn(
                     national_code=NationalCodeField(user.national_code),
                     password='plain_password',
@@ -117,7 +141,7 @@ class TestAuthService(IsolatedAsyncioTestCase):
             assert isinstance(exc, UnAuthorizedError)
             assert str(exc) == "you don't have this role in the given platform"
 
-    def test_authenticate_with_correct_credentials(self):
+    async def test_authenticate_with_correct_credentials(self):
         user = RealUser.new_user(
             national_code=NationalCodeField('1111111111'),
             first_name='first_name',
@@ -128,9 +152,9 @@ class TestAuthService(IsolatedAsyncioTestCase):
                 UserRole(platform='*', names=['admin'])
             ],
         )
-        self.service.database.users.create(user)
+        self.database.users.create(user)
 
-        db_user = self.service.authenticate(
+        db_user = await self.service.authenticate(
             RealUserAuthenticationIn(
                 national_code=NationalCodeField(user.national_code),
                 password='plain_password',
@@ -143,6 +167,65 @@ class TestAuthService(IsolatedAsyncioTestCase):
 
         assert user == db_user
 
+    async def test_authenticate_locked_out_identity(self):
+        user = RealUser.new_user(
+            national_code=NationalCodeField('1111111111'),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1111111111'),
+            plain_password='plain_password',
+            roles=[
+                UserRole(platform='*', names=['admin'])
+            ],
+        )
+        self.database.users.create(user)
+
+        def credentials(password: str):
+            return RealUserAuthenticationIn(
+                national_code=NationalCodeField(user.national_code),
+                password=password,
+                current_platform=PlatformSpecificationIn(
+                    platform='*',
+                    role='admin'
+                )
+            )
+
+        for _ in range(self.service.lockout.max_failed_attempts):
+            with self.assertRaises(UnAuthorizedError):
+                await self.service.authenticate(credentials('wrong'), '127.0.0.1')
+
+        with self.assertRaises(TooManyFailedAttemptsError):
+            await self.service.authenticate(credentials('plain_password'), '127.0.0.1')
+
+    async def test_authenticate_resets_failures_on_success(self):
+        user = RealUser.new_user(
+            national_code=NationalCodeField('1111111111'),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1111111111'),
+            plain_password='plain_password',
+            roles=[
+                UserRole(platform='*', names=['admin'])
+            ],
+        )
+        self.database.users.create(user)
+        credentials = RealUserAuthenticationIn(
+            national_code=NationalCodeField(user.national_code),
+            password='wrong',
+            current_platform=PlatformSpecificationIn(
+                platform='*',
+                role='admin'
+            )
+        )
+
+        with self.assertRaises(UnAuthorizedError):
+            await self.service.authenticate(credentials)
+        credentials.password = 'plain_password'
+        await self.service.authenticate(credentials)
+
+        assert await self.service.cache.count_events(
+            'lockout:identity:1111111111', 60) == 0
+
     async def test_register_real_user(self):
         user = RealUser.new_user(
             national_code=NationalCodeField('1111111111'),
@@ -180,10 +263,11 @@ class TestAuthService(IsolatedAsyncioTestCase):
 
 class TestVerification(IsolatedAsyncioTestCase):
     def setUp(self) -> None:
+        self.database = MemoryDatabase()
         self.service = SMSVerificationService(
             notification=FakeSMSNotification(),
-            cache=MemoryCache(),
-            db=MemoryDatabase()
+            cache=ThreadedCache(MemoryCache()),
+            db=ThreadedDatabase(self.database)
         )
         self.province = Province(
             _id=ObjectIdField(ObjectId()),
@@ -193,17 +277,17 @@ class TestVerification(IsolatedAsyncioTestCase):
                 City(_id=ObjectIdField(ObjectId()), name='c12')
             ]
         )
-        self.service.database.provinces.create(self.province)
+        self.database.provinces.create(self.province)
 
         role = Role(
             _id=ObjectIdField(ObjectId()),
             platform="*",
             names=['admin', 'staff']
         )
-        self.service.database.roles.create(role)
+        self.database.roles.create(role)
 
     def tearDown(self) -> None:
-        self.service.database.drop()
+        self.database.drop()
 
     async def test_verify_as_new_user_first_message(self):
         await self.service.send(
@@ -213,7 +297,7 @@ class TestVerification(IsolatedAsyncioTestCase):
                 verify_as='NEW_USER'
             )
         )
-        assert self.service.cache.get('1111111111')
+        assert await self.service.cache.get('1111111111')
 
     async def test_verify_as_new_user_second_message(self):
         await self.service.send(
@@ -247,7 +331,7 @@ class TestVerification(IsolatedAsyncioTestCase):
                 UserRole(platform='*', names=['admin'])
             ],
         )
-        self.service.database.users.create(user)
+        self.database.users.create(user)
 
         try:
             await self.service.send(
@@ -283,7 +367,7 @@ class TestVerification(IsolatedAsyncioTestCase):
             )
         )
 
-        info = self.service.cache.get('1111111111')
+        info = await self.service.cache.get('1111111111')
         assert info
         correct_code = info.get('code')
         assert correct_code
@@ -307,7 +391,7 @@ class TestVerification(IsolatedAsyncioTestCase):
             )
         )
 
-        info = self.service.cache.get('1111111111')
+        info = await self.service.cache.get('1111111111')
         assert info
         correct_code = info.get('code')
         assert correct_code
@@ -320,3 +404,349 @@ class TestVerification(IsolatedAsyncioTestCase):
                 code=VerificationCodeField(correct_code)
             )
         )
+
+
+class TestRpcHandler(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.user = RealUser.new_user(
+            national_code=NationalCodeField('1111111111'),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1111111111'),
+            plain_password='plain_password',
+            roles=[
+                UserRole(platform='*', names=['admin'])
+            ],
+        )
+        self.user.id = ObjectIdField(ObjectId())
+
+    def test_batch_verification_keeps_order(self):
+        token = get_access_token(self.user, '*', 'admin')
+
+        response = call_service({
+            'service_name': 'jwt_batch_verification',
+            'tokens': ['invalid', token, 'invalid']
+        })
+
+        results = response['message']
+        assert [r['valid'] for r in results] == [False, True, False]
+        assert results[0]['payload'] is None
+        assert str(results[1]['payload']['user']['id']) == str(self.user.id)
+        assert results[1]['payload']['current_platform']['role'] == 'admin'
+
+    def test_batch_verification_response_is_serializable(self):
+        token = get_access_token(self.user, '*', 'admin')
+
+        response = call_service({
+            'service_name': 'jwt_batch_verification',
+            'tokens': [token]
+        })
+
+        decoded = JsonSerializer().decode(JsonSerializer().encode(response))
+        assert decoded['message'][0]['payload']['user']['id'] == str(
+            self.user.id)
+
+    def test_batch_verification_without_tokens(self):
+        response = call_service({'service_name': 'jwt_batch_verification'})
+        assert response['message'][0]['loc'] == ('tokens',)
+
+
+class TestAuthenticationRpcClient(IsolatedAsyncioTestCase):
+    async def asyncTearDown(self) -> None:
+        await close_rpc_client()
+
+    async def test_call(self):
+        client = fake_rpc_client(lambda request: {'message': request['token']})
+
+        assert await client.call({'token': 'token'}) == {'message': 'token'}
+        assert client.futures == {}
+
+    async def test_timeout(self):
+        client = fake_rpc_client(lambda request: None, timeout=0.05)
+
+        with self.assertRaises(RpcTimeoutError):
+            await client.call({'token': 'token'})
+        assert client.futures == {}
+
+    async def test_late_reply_is_dropped(self):
+        client = fake_rpc_client(lambda request: {'message': 'late'}, delay=0.1, timeout=0.05)
+
+        with self.assertRaises(RpcTimeoutError):
+            await client.call({'token': 'token'})
+        await asyncio.sleep(0.1)
+        assert client.futures == {}
+
+    async def test_callers_wait_for_in_flight_requests(self):
+        client = fake_rpc_client(
+            lambda request: {'message': request['token']}, delay=0.05, max_in_flight=2)
+        exchange = client.channel.default_exchange
+
+        calls = asyncio.gather(*(client.call({'token': str(i)}) for i in range(3)))
+        await asyncio.sleep(0.02)
+        assert len(exchange.published) == 2
+
+        assert await calls == [{'message': str(i)} for i in range(3)]
+        assert len(exchange.published) == 3
+
+    async def test_verify_batches_concurrent_tokens(self):
+        client = fake_rpc_client(lambda request: {'message': request['tokens']})
+        exchange = client.channel.default_exchange
+
+        assert await asyncio.gather(client.verify('a'), client.verify('b')) == ['a', 'b']
+        assert len(exchange.published) == 1
+
+    async def test_batch_tasks_are_released(self):
+        client = fake_rpc_client(lambda request: {'message': request['tokens']})
+
+        assert await client.verify('a') == 'a'
+        await asyncio.sleep(0)
+        assert client.batch_tasks == set()
+
+    async def test_close_cancels_pending_batches(self):
+        client = fake_rpc_client(lambda request: None, timeout=10)
+        verify = asyncio.create_task(client.verify('a'))
+        while not client.batch_tasks:
+            await asyncio.sleep(0.01)
+
+        await client.close()
+        with self.assertRaises(asyncio.CancelledError):
+            await verify
+        assert client.batch_tasks == set()
+        assert client.futures == {}
+
+    async def test_calls_after_close_are_rejected(self):
+        client = fake_rpc_client(lambda request: {'message': request['tokens']})
+        await client.close()
+
+        with self.assertRaises(RpcClientClosedError):
+            await client.verify('a')
+        with self.assertRaises(RpcClientClosedError):
+            await client.verify_many(['a'])
+        assert client.batch == []
+
+    async def test_client_is_shared(self):
+        connects = []
+
+        async def connect(client):
+            connects.append(client)
+            client.connection = FakeRpcConnection()
+            return client
+
+        with mock.patch.object(AuthenticationRpcClient, 'connect', connect):
+            clients = await asyncio.gather(*(get_rpc_client() for _ in range(5)))
+        assert len(connects) == 1
+        assert all(client is connects[0] for client in clients)
+
+    async def test_client_of_another_loop_is_replaced(self):
+        with mock.patch.object(rpc_client, '__client_loop', object()), \
+                mock.patch.object(rpc_client, '__client', fake_rpc_client(lambda request: None)):
+            with mock.patch.object(AuthenticationRpcClient, 'connect', lambda client: self.connect(client)):
+                client = await get_rpc_client()
+            assert client.loop is asyncio.get_running_loop()
+
+    async def connect(self, client):
+        client.connection = FakeRpcConnection()
+        return client
+
+
+class TestVerifiedTokenCache(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.user = RealUser.new_user(
+            national_code=NationalCodeField('1111111111'),
+            first_name='first_name',
+            last_name='last_name',
+            phone_number=PhoneNumberField('1111111111'),
+            plain_password='plain_password',
+            roles=[
+                UserRole(platform='*', names=['admin'])
+            ],
+        )
+        self.user.id = ObjectIdField(ObjectId())
+        token_cache.clear()
+
+    def test_decode_is_served_from_cache(self):
+        token = get_access_token(self.user, '*', 'admin')
+
+        first = decode_access_token(token)
+        second = decode_access_token(token)
+
+        assert first is second
+        assert token_cache.stats()['hits'] == 1
+        assert token_cache.stats()['misses'] == 1
+
+    def test_expired_entry_is_dropped(self):
+        cache = VerifiedTokenCache(max_size=10)
+        token = get_access_token(self.user, '*', 'admin')
+        payload = decode_access_token(token)
+        expired = payload.copy(
+            update={'expiration': payload.expiration.replace(year=2000)})
+
+        cache.set(token, expired)
+
+        assert cache.get(token) is None
+        assert cache.stats()['size'] == 0
+
+    def test_least_recently_used_is_evicted(self):
+        cache = VerifiedTokenCache(max_size=2)
+        payload = decode_access_token(
+            get_access_token(self.user, '*', 'admin'))
+
+        cache.set('token1', payload)
+        cache.set('token2', payload)
+        cache.get('token1')
+        cache.set('token3', payload)
+
+        assert cache.get('token1') is payload
+        assert cache.get('token2') is None
+        assert cache.get('token3') is payload
+
+
+class TestKeyRing(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.old_key = rsa.generate_private_key(65537, 2048)
+        self.new_key = rsa.generate_private_key(65537, 2048)
+
+        # Retired key is kept as a public key only
+        self.write_key('old', self.old_key.public_key().public_bytes(
+            Encoding.PEM, PublicFormat.SubjectPublicKeyInfo))
+        self.write_key('new', self.new_key.private_bytes(
+            Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()))
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def write_key(self, kid: str, pem: bytes):
+        with open(path.join(self.directory.name, f'{kid}.pem'), 'wb') as f:
+            f.write(pem)
+
+    def test_sign_with_active_key(self):
+        key_ring = KeyRing.from_directory(self.directory.name, 'RS256', 'new')
+        token = jwt.encode({'sub': 'user'}, key_ring.signing_key,
+                           algorithm='RS256', headers={'kid': 'new'})
+
+        kid = jwt.get_unverified_header(token)['kid']
+        payload = jwt.decode(
+            token, key_ring.get_verification_key(kid), ['RS256'])
+        assert payload == {'sub': 'user'}
+
+    def test_verify_token_of_rotated_key(self):
+        key_ring = KeyRing.from_directory(self.directory.name, 'RS256', 'new')
+        token = jwt.encode({'sub': 'user'}, self.old_key,
+                           algorithm='RS256', headers={'kid': 'old'})
+
+        payload = jwt.decode(
+            token, key_ring.get_verification_key('old'), ['RS256'])
+        assert payload == {'sub': 'user'}
+
+    def test_unknown_kid(self):
+        key_ring = KeyRing.from_directory(self.directory.name, 'RS256', 'new')
+        with self.assertRaises(UnknownKeyError):
+            key_ring.get_verification_key('unknown')
+
+    def test_active_key_must_be_private(self):
+        with self.assertRaises(UnknownKeyError):
+            KeyRing.from_directory(self.directory.name, 'RS256', 'old')
+
+    def test_jwks(self):
+        key_ring = KeyRing.from_directory(self.directory.name, 'RS256', 'new')
+        keys = key_ring.jwks()['keys']
+
+        assert sorted(key['kid'] for key in keys) == ['new', 'old']
+        assert all(key['kty'] == 'RSA' and 'd' not in key for key in keys)
+
+
+class TestPasswordHasher(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.hasher = PasswordHasher(max_workers=1, max_queue_size=0)
+
+    def tearDown(self) -> None:
+        self.hasher.shutdown()
+
+    async def test_hash_and_verify(self):
+        hashed_password = await self.hasher.hash('password')
+
+        assert await self.hasher.verify('password', hashed_password)
+        assert not await self.hasher.verify('wrong', hashed_password)
+        assert self.hasher.stats()['completed'] == 3
+
+    async def test_reject_when_saturated(self):
+        results = await asyncio.gather(
+            self.hasher.hash('password'),
+            self.hasher.hash('password'),
+            return_exceptions=True
+        )
+
+        assert isinstance(results[0], str)
+        assert isinstance(results[1], PasswordHasherSaturatedError)
+        assert self.hasher.stats()['rejected'] == 1
+
+    async def test_failures_are_counted_apart(self):
+        with self.assertRaises(ValueError):
+            await self.hasher.verify('password', 'not a hash')
+
+        stats = self.hasher.stats()
+        assert stats['failed'] == 1
+        assert stats['completed'] == 0
+        assert stats['average_time'] == 0.0 and stats['max_time'] == 0.0
+        assert stats['in_progress'] == 0
+
+
+class TestUserExporter(IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.database = MemoryDatabase()
+        self.database.load_synthetic_users(3)
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    async def test_resume_ndjson(self):
+        output = path.join(self.directory.name, 'users.ndjson.gz')
+        exporter = UserExporter(ThreadedDatabase(self.database), fields=['phone_number'])
+        with open_export(output, compress=True) as out:
+            await exporter.run(out)
+        ids = [str(i) for i in self.database.users.ids]
+        assert scan_export(output, 'ndjson', compress=True)['last_id'] == ids[-1]
+
+        self.database.load_synthetic_users(2)
+        exporter = UserExporter(ThreadedDatabase(self.database), fields=['phone_number'])
+        with open_export(output, compress=True, append=True) as out:
+            await exporter.run(out, after=ids[-1])
+
+        with gzip.open(output, 'rt') as file:
+            rows = [json.loads(line) for line in file]
+        assert [r['_id'] for r in rows] == [str(i) for i in self.database.users.ids]
+        assert set(rows[0]) == {'_id', 'type', 'phone_number'}
+
+    async def test_csv(self):
+        output = path.join(self.directory.name, 'users.csv')
+        exporter = UserExporter(ThreadedDatabase(self.database), 'csv', ['roles', 'created_at'])
+        with open_export(output) as out:
+            assert await exporter.run(out) == 3
+
+        with open(output, newline='') as file:
+            rows = list(csv.DictReader(file))
+        assert len(rows) == 3
+        assert rows[0]['roles'] == 'load.test:user'
+        assert scan_export(output, 'csv', compress=False) == {
+            'last_id': rows[-1]['_id'], 'format': 'csv', 'columns': exporter.columns}
+
+    async def test_resume_point_from_checkpoint(self):
+        output = path.join(self.directory.name, 'users.csv')
+        exporter = UserExporter(ThreadedDatabase(self.database), 'csv', ['phone_number'])
+        with open_export(output) as out:
+            await exporter.run(out)
+        write_checkpoint(output, exporter)
+
+        assert resume_point(output, 'csv', compress=False) == read_checkpoint(output)
+        assert read_checkpoint(output)['last_id'] == exporter.last_id
+
+        # Rows written after the checkpoint make it stale
+        with open(output, 'a') as file:
+            file.write('x\n')
+        assert read_checkpoint(output) is None
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            UserExporter(self.database, fields=['password'])  # type: ignore